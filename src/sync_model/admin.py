@@ -1,10 +1,61 @@
+import datetime
+
 from django.contrib import admin
+from django.utils import timezone
 
 # Register your models here.
 
-from .models import SyncTask
+from .ledger import get_lag, get_rows_per_second, get_task_metrics
+from .models import SyncRun, SyncTask
+from .utils import estimate_backlog, get_shards
+
+
+METRICS_WINDOW = datetime.timedelta(days=7)
 
 
 @admin.register(SyncTask)
 class SyncTaskAdmin(admin.ModelAdmin):
-    list_display = ["name", "source", "target", "sync_method", "batch_size", "order_by", "last_sync", "filter_by"]
+    list_display = [
+            "name", "source", "target", "sync_method", "batch_size", "order_by", "last_sync", "filter_by",
+            "priority", "rows_per_second", "lag",
+    ]
+    readonly_fields = ["backlog"]
+
+    def get_queryset(self, request):
+        return get_task_metrics(timezone.now() - METRICS_WINDOW)
+
+    @admin.display(description="rows/s (7 days)")
+    def rows_per_second(self, obj):
+        rows_per_second = get_rows_per_second(obj)
+        if rows_per_second is None:
+            return "-"
+        return f"{rows_per_second:.1f}"
+
+    @admin.display(description="seconds since caught up", ordering="last_caught_up")
+    def lag(self, obj):
+        lag = get_lag(obj)
+        if lag is None:
+            return "-"
+        return f"{lag:.0f}"
+
+    @admin.display(description="backlog")
+    def backlog(self, obj):
+        """
+        estimated on the change page only, the list page would query the source of every task
+        """
+        if obj.pk is None:
+            return "-"
+        estimates = [estimate_backlog(obj, shard) for shard in get_shards(obj, create=False)]
+        rows = sum(estimate["rows"] or 0 for estimate in estimates)
+        time_lags = [estimate["time_lag"] for estimate in estimates if estimate["time_lag"] is not None]
+        methods = ", ".join(sorted({estimate["method"] for estimate in estimates}))
+        if time_lags:
+            return f"{rows} rows ({methods}), {max(time_lags):.0f} seconds behind"
+        return f"{rows} rows ({methods})"
+
+
+@admin.register(SyncRun)
+class SyncRunAdmin(admin.ModelAdmin):
+    list_display = ["sync_task", "shard", "outcome", "count", "batches", "start", "end", "duration", "cursor_after"]
+    list_filter = ["outcome", "sync_task"]
+    date_hierarchy = "end"
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+trigger based change capture
+
+the triggers write every insert/update/delete of the source table into SyncChangeLog,
+a task with capture="trigger" consumes the log in sequence order instead of polling the source table
+
+on postgresql the concurrent transactions commit their entries out of id order, so the triggers also write the
+transaction id: the log is consumed in (txid, id) order and only the entries of the transactions older than
+the snapshot xmin are consumed, a transaction still running can not add an entry before the cursor
+"""
+
+
+import logging
+
+from typing import List, Optional, Union
+
+from django.db import connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .checkpoint import save_checkpoint
+from .fingerprint import forget_fingerprints
+from .models import SyncChangeLog, SyncShard, SyncTask
+from .types import SyncResult
+from .utils import get_change_filter, get_load_fields, get_source_model, get_sync_function
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_trigger_sql(sync_task: SyncTask) -> List[str]:
+    """
+    the statements creating the triggers of the source table on source_db
+    """
+    source_model = get_source_model(sync_task)
+    connection = connections[sync_task.source_db]
+    quote = connection.ops.quote_name
+    table = source_model._meta.db_table
+    pk_column = quote(source_model._meta.pk.column)
+    log_table = quote(SyncChangeLog._meta.db_table)
+    name = f"sync_model_capture_{table}"
+    if connection.vendor == "sqlite":
+        insert = f"INSERT INTO {log_table} (table_name, row_pk, operation)"
+        return [
+                f"CREATE TRIGGER IF NOT EXISTS {quote(name + '_insert')} AFTER INSERT ON {quote(table)} BEGIN "
+                f"{insert} VALUES ('{table}', NEW.{pk_column}, 'I'); END",
+                f"CREATE TRIGGER IF NOT EXISTS {quote(name + '_update')} AFTER UPDATE ON {quote(table)} BEGIN "
+                f"{insert} SELECT '{table}', OLD.{pk_column}, 'D' WHERE OLD.{pk_column} <> NEW.{pk_column}; "
+                f"{insert} VALUES ('{table}', NEW.{pk_column}, 'U'); END",
+                f"CREATE TRIGGER IF NOT EXISTS {quote(name + '_delete')} AFTER DELETE ON {quote(table)} BEGIN "
+                f"{insert} VALUES ('{table}', OLD.{pk_column}, 'D'); END",
+        ]
+    if connection.vendor == "postgresql":
+        return [
+                f"CREATE OR REPLACE FUNCTION {quote(name)}() RETURNS trigger AS $$ BEGIN "
+                f"IF TG_OP = 'DELETE' THEN "
+                f"INSERT INTO {log_table} (table_name, row_pk, operation, txid) "
+                f"VALUES ('{table}', OLD.{pk_column}::text, 'D', txid_current()); RETURN OLD; "
+                f"END IF; "
+                f"IF TG_OP = 'UPDATE' AND OLD.{pk_column} <> NEW.{pk_column} THEN "
+                f"INSERT INTO {log_table} (table_name, row_pk, operation, txid) "
+                f"VALUES ('{table}', OLD.{pk_column}::text, 'D', txid_current()); "
+                f"END IF; "
+                f"INSERT INTO {log_table} (table_name, row_pk, operation, txid) "
+                f"VALUES ('{table}', NEW.{pk_column}::text, left(TG_OP, 1), txid_current()); RETURN NEW; "
+                f"END; $$ LANGUAGE plpgsql",
+                f"DROP TRIGGER IF EXISTS {quote(name)} ON {quote(table)}",
+                f"CREATE TRIGGER {quote(name)} AFTER INSERT OR UPDATE OR DELETE ON {quote(table)} "
+                f"FOR EACH ROW EXECUTE PROCEDURE {quote(name)}()",
+        ]
+    raise ValueError(f"trigger capture does not support {connection.vendor}")
+
+
+def get_drop_trigger_sql(sync_task: SyncTask) -> List[str]:
+    source_model = get_source_model(sync_task)
+    connection = connections[sync_task.source_db]
+    quote = connection.ops.quote_name
+    table = source_model._meta.db_table
+    name = f"sync_model_capture_{table}"
+    if connection.vendor == "sqlite":
+        return [
+                f"DROP TRIGGER IF EXISTS {quote(name + '_' + operation)}"
+                for operation in ("insert", "update", "delete")
+        ]
+    if connection.vendor == "postgresql":
+        return [
+                f"DROP TRIGGER IF EXISTS {quote(name)} ON {quote(table)}",
+                f"DROP FUNCTION IF EXISTS {quote(name)}()",
+        ]
+    raise ValueError(f"trigger capture does not support {connection.vendor}")
+
+
+def execute_sql(sync_task: SyncTask, statements: List[str]) -> None:
+    with transaction.atomic(using=sync_task.source_db):
+        with connections[sync_task.source_db].cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+
+
+def get_xmin(sync_task: SyncTask) -> Optional[int]:
+    """
+    postgresql: the oldest transaction still running on source_db, None on the other databases
+    """
+    connection = connections[sync_task.source_db]
+    if connection.vendor != "postgresql":
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+        return cursor.fetchone()[0]
+
+
+def get_cursor_key(last_sync: dict) -> tuple:
+    """
+    sort the cursors of the trigger tasks, the entries without txid come first
+    """
+    if last_sync.get("txid") is None:
+        return (0, 0, last_sync.get("seq", 0))
+    return (1, last_sync["txid"], last_sync["seq"])
+
+
+def sync_changes(sync_task: SyncTask, cursor: Union[SyncTask, SyncShard]) -> SyncResult:
+    """
+    consume one batch of SyncChangeLog after the cursor {"seq": id} ({"txid": txid, "seq": id} on postgresql)
+    * the rows still in the source and matching filter_by are passed to the sync method
+    * the other changed pks are deleted from the target
+    the target model should use the pk of the source model
+    """
+    sync_result: SyncResult = {
+            "finished": False,
+            "count": 0,
+            "start": timezone.now(),
+            "last_sync_model": None,
+            "end": timezone.now(),
+    }
+    source_model = get_source_model(sync_task)
+    target_model = sync_task.target.model_class()
+    table = source_model._meta.db_table
+    changes = SyncChangeLog.objects.using(sync_task.source_db).filter(
+            get_change_filter(cursor.last_sync), table_name=table,
+    )
+    xmin = get_xmin(sync_task)
+    if xmin is not None:
+        # the entries of the running transactions are consumed once they committed
+        changes = changes.filter(Q(txid__isnull=True) | Q(txid__lt=xmin))
+    entries = list(changes.order_by(
+        F("txid").asc(nulls_first=True), "id",
+    ).values_list("id", "txid", "row_pk")[:sync_task.batch_size])
+    sync_result["count"] = len(entries)
+    sync_result["finished"] = len(entries) < sync_task.batch_size
+    if not entries:
+        sync_result["end"] = timezone.now()
+        return sync_result
+    pk_field = source_model._meta.pk
+    changed_pks = {pk_field.to_python(row_pk) for _, _, row_pk in entries}
+    queryset = source_model.objects.using(sync_task.source_db).filter(  # type: ignore[attr-defined]
+            **sync_task.filter_by
+    ).filter(pk__in=changed_pks)
+    if sync_task.source_fields:
+        queryset = queryset.only(*get_load_fields(source_model, sync_task))
+    instances = list(queryset)
+    get_sync_function(sync_task.sync_method)(instances, target_model, sync_task)
+    deleted_pks = changed_pks - {instance.pk for instance in instances}
+    if deleted_pks:
+        target_model.objects.using(sync_task.target_db).filter(pk__in=deleted_pks).delete()
+        if sync_task.fingerprint:
+            forget_fingerprints(sync_task, deleted_pks)
+        LOGGER.info("%s delete %d target rows", sync_task, len(deleted_pks))
+    seq, txid, _ = entries[-1]
+    cursor.last_sync = {"seq": seq} if txid is None else {"txid": txid, "seq": seq}
+    save_checkpoint(sync_task, cursor)
+    transaction.on_commit(
+            lambda: truncate_changes(sync_task),
+            using=sync_task.target_db,
+    )
+    sync_result["end"] = timezone.now()
+    return sync_result
+
+
+def truncate_changes(sync_task: SyncTask) -> int:
+    """
+    delete the log entries consumed by every trigger task of this source table
+    """
+    source_model = get_source_model(sync_task)
+    consumers = SyncTask.objects.filter(
+            source=sync_task.source, source_db=sync_task.source_db, capture="trigger",
+    ).values_list("last_sync", flat=True)
+    consumed = min(consumers, key=get_cursor_key, default={})
+    deleted, _ = SyncChangeLog.objects.using(sync_task.source_db).filter(
+            table_name=source_model._meta.db_table,
+    ).exclude(get_change_filter(consumed)).delete()
+    return deleted
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+save the cursor of a batch together with the target writes
+"""
+
+
+import logging
+
+from typing import Union
+
+from django.db import transaction
+
+from .exceptions import LeaseLostException
+from .models import SyncCheckpoint, SyncShard, SyncTask
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_checkpoint_name(cursor: Union[SyncTask, SyncShard]) -> str:
+    return f"{cursor._meta.model_name}.{cursor.pk}"
+
+
+def use_checkpoint_table(sync_task: SyncTask, cursor: Union[SyncTask, SyncShard]) -> bool:
+    """
+    an atomic task whose cursor can not be saved in the target transaction
+    """
+    return sync_task.atomic and cursor._state.db != sync_task.target_db
+
+
+def load_checkpoint(sync_task: SyncTask, cursor: Union[SyncTask, SyncShard]) -> None:
+    """
+    the checkpoint on target_db is committed with the data, so it wins over the cursor
+    """
+    if not use_checkpoint_table(sync_task, cursor):
+        return
+    checkpoint = SyncCheckpoint.objects.using(sync_task.target_db).filter(
+            name=get_checkpoint_name(cursor),
+    ).first()
+    if checkpoint is not None and checkpoint.last_sync != cursor.last_sync:
+        LOGGER.warning("%s resume from the checkpoint %s instead of %s",
+                       cursor, checkpoint.last_sync, cursor.last_sync)
+        cursor.last_sync = checkpoint.last_sync
+        cursor.save(update_fields=["last_sync"])
+
+
+def get_fence(sync_task: SyncTask, cursor: Union[SyncTask, SyncShard]) -> dict:
+    """
+    the filter of the cursor row, with the lease owner if this process leased the task
+    """
+    fence: dict = {"pk": cursor.pk}
+    if sync_task.leased_by:
+        if isinstance(cursor, SyncTask):
+            fence["lease_owner"] = sync_task.leased_by
+        else:
+            fence["sync_task__lease_owner"] = sync_task.leased_by
+    return fence
+
+
+def save_cursor(sync_task: SyncTask, cursor: Union[SyncTask, SyncShard]) -> None:
+    """
+    save cursor.last_sync, raise LeaseLostException if another worker took the lease of the task
+    """
+    updated = type(cursor).objects.using(cursor._state.db).filter(
+            **get_fence(sync_task, cursor),
+    ).update(last_sync=cursor.last_sync)
+    if updated == 0:
+        raise LeaseLostException(f"{cursor} is leased by another worker, the cursor is not saved")
+
+
+def save_checkpoint(sync_task: SyncTask, cursor: Union[SyncTask, SyncShard]) -> None:
+    """
+    save cursor.last_sync
+    atomic task: inside the transaction of target_db, in the checkpoint table if the cursor lives elsewhere
+    """
+    if not use_checkpoint_table(sync_task, cursor):
+        save_cursor(sync_task, cursor)
+        return
+    if not type(cursor).objects.using(cursor._state.db).filter(**get_fence(sync_task, cursor)).exists():
+        raise LeaseLostException(f"{cursor} is leased by another worker, the checkpoint is not saved")
+    SyncCheckpoint.objects.using(sync_task.target_db).update_or_create(
+            name=get_checkpoint_name(cursor),
+            defaults={"last_sync": cursor.last_sync},
+    )
+    transaction.on_commit(
+            lambda: save_cursor(sync_task, cursor),
+            using=sync_task.target_db,
+    )
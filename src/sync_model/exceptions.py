@@ -7,3 +7,15 @@ class StepTooSmallException(Exception):
     """
     if the step is too small, the last_value will not update
     """
+
+
+class LeaseLostException(Exception):
+    """
+    another worker took the lease of the task, so the cursor must not move
+    """
+
+
+class DependencyCycleException(Exception):
+    """
+    the dependencies of the sync tasks contain a cycle, so these tasks will never be ready
+    """
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+check the query plan of the batch query of a sync task and suggest the index serving it
+
+the keyset query of a task is fast only with an index on the equality filter_by keys followed by the order_by keys
+"""
+
+
+import logging
+import re
+
+from typing import List, Tuple
+
+from django.db import connections, models
+from django.db.migrations import Migration
+from django.db.migrations.autodetector import MigrationAutodetector
+from django.db.migrations.loader import MigrationLoader
+from django.db.migrations.operations import AddIndex, SeparateDatabaseAndState
+from django.db.migrations.writer import MigrationWriter
+
+from .models import SyncTask
+from .types import ExplainReport
+from .utils import get_queryset, get_source_model
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_plan_warnings(vendor: str, plan: str) -> List[str]:
+    """
+    the full table scans and the sorts of a plan printed by queryset.explain()
+    """
+    warnings = []
+    for line in plan.splitlines():
+        line = line.strip()
+        if vendor == "postgresql":
+            if "Seq Scan" in line:
+                warnings.append(f"full scan: {line}")
+            elif re.search(r"(^|->\s+)(Incremental )?Sort\b", line):
+                warnings.append(f"sort: {line}")
+        elif vendor == "mysql":
+            if re.search(r"\bALL\b", line):
+                warnings.append(f"full scan: {line}")
+            if "Using filesort" in line:
+                warnings.append(f"sort: {line}")
+        elif vendor == "sqlite":
+            if re.search(r"\bSCAN \S+$", line):
+                warnings.append(f"full scan: {line}")
+            elif "TEMP B-TREE" in line:
+                warnings.append(f"sort: {line}")
+    return warnings
+
+
+def get_index_fields(sync_task: SyncTask) -> List[str]:
+    """
+    the equality filter_by fields, then the order_by fields with their directions
+    the filters on related fields or with other lookups can not lead a keyset index and are skipped
+    """
+    source_model = get_source_model(sync_task)
+    fields: List[str] = []
+    for key in sync_task.filter_by:
+        name = key[:-len("__exact")] if key.endswith("__exact") else key
+        if "__" in name:
+            continue
+        field = source_model._meta.pk if name == "pk" else source_model._meta.get_field(name)
+        if field.name not in fields:
+            fields.append(field.name)
+    for key in sync_task.order_by:
+        name = key.lstrip("-")
+        if "__" in name:
+            break
+        field = source_model._meta.pk if name == "pk" else source_model._meta.get_field(name)
+        if field.name not in [existing.lstrip("-") for existing in fields]:
+            fields.append(f"-{field.name}" if key.startswith("-") else field.name)
+    return fields
+
+
+def has_index(sync_task: SyncTask, fields: List[str]) -> bool:
+    """
+    whether an index of the source table starts with these fields, the directions are ignored
+    """
+    source_model = get_source_model(sync_task)
+    columns = [source_model._meta.get_field(field.lstrip("-")).column for field in fields]
+    connection = connections[sync_task.source_db]
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, source_model._meta.db_table)
+    return any(
+            (constraint["index"] or constraint["primary_key"] or constraint["unique"])
+            and constraint["columns"][:len(columns)] == columns
+            for constraint in constraints.values()
+    )
+
+
+def explain(sync_task: SyncTask) -> ExplainReport:
+    """
+    the plan of the next batch query, its warnings and the suggested index (None if an index exists)
+    """
+    queryset = get_queryset(sync_task)[0:sync_task.batch_size]
+    plan = queryset.explain()
+    fields = get_index_fields(sync_task)
+    return {
+            "plan": plan,
+            "warnings": get_plan_warnings(connections[sync_task.source_db].vendor, plan),
+            "index": None if not fields or has_index(sync_task, fields) else fields,
+    }
+
+
+def get_index_migration(sync_task: SyncTask, fields: List[str]) -> Tuple[str, str]:
+    """
+    the path and the content of a migration creating the index in the source app
+    the index is only added to the database, not to the migration state, so makemigrations will not remove it
+    """
+    source_model = get_source_model(sync_task)
+    if not source_model._meta.managed:
+        raise ValueError(f"the source model {source_model} of {sync_task} is not managed")
+    index = models.Index(fields=fields)
+    index.set_name_with_model(source_model)
+    app_label = source_model._meta.app_label
+    loader = MigrationLoader(None, ignore_no_migrations=True)
+    leaves = loader.graph.leaf_nodes(app_label)
+    if not leaves:
+        raise ValueError(f"the app {app_label} has no migrations")
+    number = max(MigrationAutodetector.parse_number(name) or 0 for _, name in leaves) + 1
+    migration = Migration(f"{number:04d}_{index.name}", app_label)
+    migration.dependencies = leaves
+    migration.operations = [
+            SeparateDatabaseAndState(database_operations=[
+                AddIndex(source_model._meta.model_name, index),
+            ]),
+    ]
+    writer = MigrationWriter(migration)
+    return writer.path, writer.as_string()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+shared scan: the tasks reading the same source in the same order share one batch query
+
+the batch is read once with the filters of all tasks OR-ed, each row is flagged by the database
+with the filter_by of every task, and each task gets the rows of its flag.
+All tasks of a group move their cursor to the last row of the shared batch, so they stay together.
+"""
+
+
+import json
+import logging
+
+from typing import Dict, Iterable, List, Optional
+
+from django.db import connections, transaction
+from django.db.models import BooleanField, ExpressionWrapper, Model, Q, Value
+from django.utils import timezone
+
+from .checkpoint import load_checkpoint, save_checkpoint
+from .exceptions import LeaseLostException, StepTooSmallException
+from .ledger import record_run
+from .models import SyncTask
+from .profiling import phase
+from .throttle import get_limiter
+from .types import SyncResult
+from .utils import get_keyset_filter, get_load_fields, get_queryset, get_source_model, get_sync_function, get_value
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_scan_key(sync_task: SyncTask) -> Optional[tuple]:
+    """
+    the tasks with the same key can share a scan, None if the task can not share
+    """
+    if sync_task.capture != "poll" or sync_task.shards > 1:
+        return None
+    return (sync_task.source_id, sync_task.source_db, tuple(sync_task.order_by))
+
+
+def can_join(sync_task: SyncTask, last_sync: dict) -> bool:
+    """
+    the task has no row left before last_sync, so its cursor can move to last_sync
+    """
+    source_model = get_source_model(sync_task)
+    return not get_queryset(sync_task).exclude(get_keyset_filter(
+        source_model, sync_task.order_by, last_sync, connections[sync_task.source_db],
+    )).exists()
+
+
+def group_tasks(sync_tasks: Iterable[SyncTask]) -> List[List[SyncTask]]:
+    """
+    group the tasks sharing a scan key and a cursor
+    a task with another cursor joins the group if it has no row before the group cursor,
+    otherwise it catches up alone
+    """
+    groups: List[List[SyncTask]] = []
+    candidates: Dict[tuple, List[SyncTask]] = {}
+    for sync_task in sync_tasks:
+        key = get_scan_key(sync_task)
+        if key is None:
+            groups.append([sync_task])
+            continue
+        load_checkpoint(sync_task, sync_task)
+        candidates.setdefault(key, []).append(sync_task)
+    for members in candidates.values():
+        clusters: Dict[str, List[SyncTask]] = {}
+        for sync_task in members:
+            clusters.setdefault(json.dumps(sync_task.last_sync, sort_keys=True), []).append(sync_task)
+        group = max(clusters.values(), key=len)
+        last_sync = group[0].last_sync
+        for sync_task in members:
+            if sync_task in group:
+                continue
+            if last_sync and can_join(sync_task, last_sync):
+                LOGGER.info("%s join the shared scan at %s", sync_task, last_sync)
+                sync_task.last_sync = last_sync
+                group.append(sync_task)
+            else:
+                groups.append([sync_task])
+        groups.append(group)
+    return groups
+
+
+def sync_shared_batch(sync_tasks: List[SyncTask]) -> Dict[SyncTask, SyncResult]:
+    """
+    sync one shared batch of a group from group_tasks
+    the batch size is the smallest batch_size of the group, a task failing does not stop the others,
+    the first error is raised after all tasks were synced
+    a task whose lease was taken by another worker gets no result
+    """
+    leader = sync_tasks[0]
+    source_model = get_source_model(leader)
+    batch_size = min(sync_task.batch_size for sync_task in sync_tasks)
+    with phase("query", leader, None):
+        queryset = source_model.objects.using(leader.source_db).order_by(  # type: ignore[attr-defined]
+                *leader.order_by
+        )
+        if all(sync_task.filter_by for sync_task in sync_tasks):
+            union = Q()
+            for sync_task in sync_tasks:
+                union |= Q(**sync_task.filter_by)
+            queryset = queryset.filter(union)
+        if all(sync_task.source_fields for sync_task in sync_tasks):
+            queryset = queryset.only(*{
+                field
+                for sync_task in sync_tasks
+                for field in get_load_fields(source_model, sync_task)
+            })
+        queryset = queryset.annotate(**{
+            f"sync_match_{index}": (
+                ExpressionWrapper(Q(**sync_task.filter_by), output_field=BooleanField())
+                if sync_task.filter_by else Value(True)
+            )
+            for index, sync_task in enumerate(sync_tasks)
+        }).filter(get_keyset_filter(
+            source_model, leader.order_by, leader.last_sync, connections[leader.source_db],
+        ))
+    limiter = get_limiter(leader.source_db)
+    with phase("throttle", leader, None):
+        limiter.acquire()
+    try:
+        with phase("fetch", leader, None):
+            rows = list(queryset[0:batch_size])
+    finally:
+        limiter.release()
+    limiter.consume(len(rows))
+    finished = len(rows) < batch_size
+    last_sync = get_value(rows[-1], leader.order_by, datetime2str=True) if rows else leader.last_sync
+    if not finished and last_sync == leader.last_sync:
+        raise StepTooSmallException
+    results: Dict[SyncTask, SyncResult] = {}
+    errors: List[Exception] = []
+    for index, sync_task in enumerate(sync_tasks):
+        batch = [row for row in rows if getattr(row, f"sync_match_{index}")]
+        cursor_before = sync_task.last_sync
+        start = timezone.now()
+        try:
+            if sync_task.atomic:
+                with transaction.atomic(using=sync_task.target_db):
+                    sync_result = fan_out(sync_task, batch, last_sync, finished)
+            else:
+                sync_result = fan_out(sync_task, batch, last_sync, finished)
+        except Exception as error:  # pylint: disable=broad-except
+            LOGGER.exception("%s failed in the shared scan", sync_task)
+            sync_task.last_sync = cursor_before
+            record_run(sync_task, None, cursor_before, cursor_before, start=start)
+            if not isinstance(error, LeaseLostException):
+                errors.append(error)
+            continue
+        with phase("ledger", sync_task, None):
+            record_run(sync_task, None, cursor_before, sync_task.last_sync, sync_result)
+        results[sync_task] = sync_result
+    if errors:
+        raise errors[0]
+    LOGGER.info("shared scan of %d rows for %s, last_sync: %s", len(rows), sync_tasks, last_sync)
+    return results
+
+
+def fan_out(sync_task: SyncTask, batch: List[Model], last_sync: dict, finished: bool) -> SyncResult:
+    """
+    sync the rows of one task and move its cursor to the end of the shared batch
+    """
+    with phase("sync", sync_task, None):
+        sync_result = get_sync_function(sync_task.sync_method)(
+                batch, sync_task.target.model_class(), sync_task,
+        )
+    # the task has seen the whole shared batch, not only its rows
+    sync_result["finished"] = finished
+    if last_sync != sync_task.last_sync:
+        sync_task.last_sync = last_sync
+        with phase("checkpoint", sync_task, None):
+            save_checkpoint(sync_task, sync_task)
+    return sync_result
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+skip the target writes of the rows whose mapped fields did not change
+
+the digest of the mapped fields of every written row is kept in SyncFingerprint on the target_db,
+so it is committed together with the rows of an atomic task
+"""
+
+
+import hashlib
+import json
+import logging
+
+from typing import Any, Dict, Iterable, List, Tuple
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Model
+
+from .models import SyncFingerprint, SyncTask
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_digest(values: List[Any]) -> str:
+    return hashlib.blake2b(
+            json.dumps(values, cls=DjangoJSONEncoder).encode(),
+            digest_size=8,
+    ).hexdigest()
+
+
+def get_values(instance: Model, fields: Iterable[str]) -> List[Any]:
+    """
+    the database values of the fields, the id of a foreign key instead of the related instance
+    """
+    return [instance._meta.get_field(field).value_from_object(instance) for field in fields]
+
+
+def filter_changed(
+        instances: List[Model],
+        sync_task: SyncTask) -> Tuple[List[Model], Dict[str, str]]:
+    """
+    the target instances whose digest changed, and the new digests by pk
+    """
+    digests = {
+            str(instance.pk): get_digest(get_values(instance, sync_task.field_map))
+            for instance in instances
+    }
+    saved = dict(SyncFingerprint.objects.using(sync_task.target_db).filter(
+        task=sync_task.pk, row_pk__in=list(digests),
+    ).values_list("row_pk", "digest"))
+    changed = [
+            instance for instance in instances
+            if saved.get(str(instance.pk)) != digests[str(instance.pk)]
+    ]
+    return changed, {
+            row_pk: digest for row_pk, digest in digests.items()
+            if saved.get(row_pk) != digest
+    }
+
+
+def save_fingerprints(sync_task: SyncTask, digests: Dict[str, str]) -> None:
+    if not digests:
+        return
+    fingerprints = [
+            SyncFingerprint(task=sync_task.pk, row_pk=row_pk, digest=digest)
+            for row_pk, digest in digests.items()
+    ]
+    manager = SyncFingerprint.objects.using(sync_task.target_db)
+    if connections[sync_task.target_db].features.supports_update_conflicts_with_target:
+        manager.bulk_create(
+                fingerprints,
+                update_conflicts=True,
+                unique_fields=["task", "row_pk"],
+                update_fields=["digest"],
+        )
+        return
+    manager.filter(task=sync_task.pk, row_pk__in=list(digests)).delete()
+    manager.bulk_create(fingerprints)
+
+
+def forget_fingerprints(sync_task: SyncTask, pks: Iterable[Any]) -> None:
+    """
+    the target rows were deleted or must be written again
+    """
+    SyncFingerprint.objects.using(sync_task.target_db).filter(
+            task=sync_task.pk, row_pk__in=[str(pk) for pk in pks],
+    ).delete()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+lease a SyncTask so the workers on many nodes can share the tasks safely
+
+the cursor of a leased task is only saved while the lease is still owned (see checkpoint.save_cursor),
+so a worker whose lease expired and was taken by another worker can not move the cursor any more
+"""
+
+
+import datetime
+import logging
+import os
+import socket
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import SyncTask
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def default_owner() -> str:
+    """
+    e.g.
+        >>> default_owner()
+        "host1:12345"
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def acquire_lease(sync_task: SyncTask, owner: str, seconds: float) -> bool:
+    """
+    lease the sync_task if it is free, expired, or already leased by owner
+    the row is locked with skip_locked, so a task being acquired by another worker is skipped instead of waited
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        free = SyncTask.objects.select_for_update(skip_locked=True).filter(
+                Q(lease_expires__isnull=True) | Q(lease_expires__lt=now) | Q(lease_owner=owner),
+                pk=sync_task.pk,
+        ).values_list("lease_owner", flat=True).first()
+        if free is None:
+            LOGGER.info("%s is leased by another worker", sync_task)
+            return False
+        if free and free != owner:
+            LOGGER.warning("%s reclaim the expired lease of %s", owner, free)
+        sync_task.lease_owner = owner
+        sync_task.leased_by = owner
+        sync_task.lease_expires = now + datetime.timedelta(seconds=seconds)
+        SyncTask.objects.filter(pk=sync_task.pk).update(
+                lease_owner=sync_task.lease_owner,
+                lease_expires=sync_task.lease_expires,
+        )
+    return True
+
+
+def renew_lease(sync_task: SyncTask, owner: str, seconds: float) -> bool:
+    """
+    heartbeat, return False if the lease was lost
+    """
+    sync_task.lease_expires = timezone.now() + datetime.timedelta(seconds=seconds)
+    return SyncTask.objects.filter(pk=sync_task.pk, lease_owner=owner).update(
+            lease_expires=sync_task.lease_expires,
+    ) == 1
+
+
+def release_lease(sync_task: SyncTask, owner: str) -> None:
+    SyncTask.objects.filter(pk=sync_task.pk, lease_owner=owner).update(
+            lease_owner="", lease_expires=None,
+    )
+    sync_task.lease_owner = ""
+    sync_task.leased_by = ""
+    sync_task.lease_expires = None
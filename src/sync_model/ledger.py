@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+record every batch in SyncRun and aggregate the throughput and lag of the tasks
+"""
+
+
+import datetime
+import logging
+
+from typing import Dict, Iterable, Optional
+
+from django.db import transaction
+from django.db.models import Count, Max, Min, Q, QuerySet, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import SyncRun, SyncShard, SyncTask
+from .types import SyncResult
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def record_run(
+        sync_task: SyncTask,
+        shard: Optional[SyncShard],
+        cursor_before: dict,
+        cursor_after: dict,
+        sync_result: Optional[SyncResult] = None,
+        start: Optional[datetime.datetime] = None) -> SyncRun:
+    """
+    save one batch into the ledger, a batch without sync_result is an error
+    """
+    if sync_result is None:
+        outcome = "error"
+        count = 0
+        start = start or timezone.now()
+        end = timezone.now()
+    else:
+        count = sync_result["count"]
+        start = sync_result["start"]
+        end = sync_result["end"]
+        if sync_result["finished"] is False:
+            outcome = "partial"
+        elif count == 0:
+            outcome = "empty"
+        else:
+            outcome = "finished"
+    return SyncRun.objects.create(
+            sync_task=sync_task,
+            shard=None if shard is None else shard.index,
+            count=count,
+            start=start,
+            end=end,
+            duration=(end - start).total_seconds(),
+            cursor_before=cursor_before,
+            cursor_after=cursor_after,
+            outcome=outcome,
+            caught_up=end if outcome in ("finished", "empty") else None,
+    )
+
+
+def get_task_metrics(since: datetime.datetime) -> QuerySet:
+    """
+    SyncTask annotated with
+    * rows, duration, batches, errors: the runs ended after since
+    * last_run: the end of the last run
+    * last_caught_up: the end of the last run which reached the end of the source
+    """
+    recent = Q(syncrun__end__gte=since)
+    return SyncTask.objects.annotate(
+            rows=Sum("syncrun__count", filter=recent),
+            duration=Sum("syncrun__duration", filter=recent),
+            batches=Sum("syncrun__batches", filter=recent),
+            errors=Count("syncrun", filter=recent & Q(syncrun__outcome="error")),
+            last_run=Max("syncrun__end"),
+            last_caught_up=Max("syncrun__caught_up"),
+    )
+
+
+def get_rows_per_second(sync_task: SyncTask) -> Optional[float]:
+    """
+    rows per busy second of a task annotated by get_task_metrics
+    """
+    if not sync_task.duration:
+        return None
+    return (sync_task.rows or 0) / sync_task.duration
+
+
+def get_lag(sync_task: SyncTask, now: Optional[datetime.datetime] = None) -> Optional[float]:
+    """
+    seconds since the task annotated by get_task_metrics last caught up
+    """
+    if sync_task.last_caught_up is None:
+        return None
+    return ((now or timezone.now()) - sync_task.last_caught_up).total_seconds()
+
+
+def get_lags(sync_tasks: Iterable[SyncTask], now: Optional[datetime.datetime] = None) -> Dict[int, Optional[float]]:
+    """
+    seconds since each task last caught up by task pk, None if it never caught up, with one query
+    """
+    pks = [sync_task.pk for sync_task in sync_tasks]
+    caught_up = dict(SyncRun.objects.filter(
+        sync_task__in=pks, caught_up__isnull=False,
+    ).values("sync_task").annotate(last_caught_up=Max("caught_up")).values_list("sync_task", "last_caught_up"))
+    now = now or timezone.now()
+    return {
+            pk: (now - caught_up[pk]).total_seconds() if pk in caught_up else None
+            for pk in pks
+    }
+
+
+def rollup_runs(before: datetime.datetime) -> int:
+    """
+    merge the runs ended before `before` into one rollup run per task, shard and day
+    return the number of runs removed
+    """
+    with transaction.atomic():
+        old_runs = SyncRun.objects.filter(end__lt=before)
+        groups = list(old_runs.annotate(
+            day=TruncDate("end"),
+        ).values("sync_task", "shard", "day").annotate(
+            rows=Sum("count"),
+            total_batches=Sum("batches"),
+            total_duration=Sum("duration"),
+            first_start=Min("start"),
+            last_end=Max("end"),
+            last_caught_up=Max("caught_up"),
+            runs=Count("id"),
+        ))
+        removed, _ = old_runs.delete()
+        SyncRun.objects.bulk_create([
+            SyncRun(
+                sync_task_id=group["sync_task"],
+                shard=group["shard"],
+                count=group["rows"],
+                batches=group["total_batches"],
+                start=group["first_start"],
+                end=group["last_end"],
+                duration=group["total_duration"],
+                outcome="rollup",
+                caught_up=group["last_caught_up"],
+            )
+            for group in groups
+        ])
+    LOGGER.info("rollup %d runs into %d", removed, len(groups))
+    return removed - len(groups)
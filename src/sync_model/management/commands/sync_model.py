@@ -8,56 +8,816 @@ handle sync model task
 """
 
 
-import importlib
+import cProfile
 import logging
+import math
+import os
+import signal
+import time
 
-from django.core.management import BaseCommand
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple, Union, cast
 
-from sync_model.exceptions import StepTooSmallException
-from sync_model.models import SyncTask
+from django.core.management import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+
+from sync_model.capture import sync_changes
+from sync_model.checkpoint import load_checkpoint, save_checkpoint
+from sync_model.exceptions import LeaseLostException, StepTooSmallException
+from sync_model.fanout import group_tasks, sync_shared_batch
+from sync_model.explain import explain, get_index_migration
+from sync_model.ledger import get_lags, record_run
+from sync_model.lease import acquire_lease, default_owner, release_lease, renew_lease
+from sync_model.models import SyncShard, SyncTask
+from sync_model.pipeline import Prefetcher
+from sync_model.plan import SyncPlan
+from sync_model.profiling import PhaseReport, phase
+from sync_model.signals import sync_phase
+from sync_model.throttle import SourceSlot, get_limiter
+from sync_model.transport import export, import_chunks
 from sync_model.types import SyncResult
 from sync_model.utils import (
-        get_queryset, get_value,
+        estimate_backlog, get_adapted_batch_size, get_queryset, get_shards, get_sync_function, get_value,
+        sync_in_database,
         )
+from sync_model.verify import LEAF_SIZE, repair, verify
 
 
 LOGGER = logging.getLogger(__name__)
 
 
+def critical_path(
+        timings: Dict[SyncTask, float],
+        dependencies: Dict[SyncTask, List[SyncTask]]) -> Tuple[List[SyncTask], float]:
+    """
+    the longest chain of dependent tasks weighted by wall time, it bounds the whole run
+    """
+    longest: Dict[SyncTask, Tuple[List[SyncTask], float]] = {}
+
+    def visit(sync_task: SyncTask) -> Tuple[List[SyncTask], float]:
+        if sync_task not in longest:
+            path: List[SyncTask] = []
+            seconds = 0.0
+            for dependency in dependencies.get(sync_task, []):
+                if dependency in timings:
+                    dependency_path, dependency_seconds = visit(dependency)
+                    if dependency_seconds > seconds:
+                        path, seconds = dependency_path, dependency_seconds
+            longest[sync_task] = (path + [sync_task], seconds + timings[sync_task])
+        return longest[sync_task]
+
+    return max(
+            (visit(sync_task) for sync_task in timings),
+            key=lambda item: item[1],
+            default=([], 0.0),
+    )
+
+
+def order_units(
+        units: Iterable[Tuple[SyncTask, Optional[SyncShard]]]) -> List[Tuple[SyncTask, Optional[SyncShard]]]:
+    """
+    higher priority first, then the tasks which never caught up, then the longest lag
+    """
+    units = list(units)
+    lags = get_lags({sync_task for sync_task, _ in units})
+
+    def key(unit: Tuple[SyncTask, Optional[SyncShard]]) -> Tuple[int, float]:
+        lag = lags[unit[0].pk]
+        return (-unit[0].priority, -(math.inf if lag is None else lag))
+
+    return sorted(units, key=key)
+
+
+def close_broken_connections() -> None:
+    """
+    close the connections broken by an error, the next query reconnects
+    unlike close_old_connections the age (CONN_MAX_AGE) is not checked, so the follow loop keeps its connections
+    between the polls. A connection in a transaction of the caller is kept
+    """
+    for connection in connections.all(initialized_only=True):
+        if connection.connection is None or connection.in_atomic_block or not connection.errors_occurred:
+            continue
+        if connection.is_usable():
+            connection.errors_occurred = False
+        else:
+            connection.close()
+
+
+def merge_results(results: List[SyncResult]) -> SyncResult:
+    """
+    merge the results of all shards of a task
+    """
+    merged: SyncResult = {
+            "finished": all(result["finished"] for result in results),
+            "count": sum(result["count"] for result in results),
+            "start": min(result["start"] for result in results),
+            "end": max(result["end"] for result in results),
+            "last_sync_model": results[-1]["last_sync_model"],
+    }
+    if any("skipped" in result for result in results):
+        merged["skipped"] = sum(result.get("skipped", 0) for result in results)
+    return merged
+
+
 class Command(BaseCommand):
     """run sync model task"""
 
+    drain = False
+    report = False
+    workers = 1
+    deadline: Optional[float] = None
+    max_batches: Optional[int] = None
+    lease: Optional[float] = None
+    lease_owner = ""
+    stopping = False
+    profile_dir: Optional[str] = None
+    prefetch = 0
+    shared_scan = False
+
     def add_arguments(self, parser):
         parser.add_argument("--name", type=str)
+        parser.add_argument(
+                "--drain", action="store_true",
+                help="keep syncing each task until it is finished or the budget is used up",
+        )
+        parser.add_argument(
+                "--timeout", type=float,
+                help="seconds, no new batch is started after the timeout",
+        )
+        parser.add_argument(
+                "--max-batches", type=int,
+                help="max batches of each task in drain mode",
+        )
+        parser.add_argument(
+                "--workers", type=int, default=1,
+                help="run the ready tasks concurrently in N threads",
+        )
+        parser.add_argument(
+                "--lease", type=float,
+                help="seconds, lease each task before syncing it so many workers can share the tasks",
+        )
+        parser.add_argument(
+                "--follow", action="store_true",
+                help="stay resident and keep polling the tasks until SIGTERM",
+        )
+        parser.add_argument(
+                "--poll-interval", type=float, default=1.0,
+                help="seconds, the interval after a task caught up",
+        )
+        parser.add_argument(
+                "--max-poll-interval", type=float, default=60.0,
+                help="seconds, the interval of an idle task doubles up to this value",
+        )
+        parser.add_argument(
+                "--profile", action="store_true",
+                help="print the time and queries of each phase "
+                     "(throttle, resolve, query, fetch, sync, checkpoint, ledger)",
+        )
+        parser.add_argument(
+                "--profile-dir", type=str,
+                help="dump the cProfile stats of each task into this directory",
+        )
+        parser.add_argument(
+                "--status", action="store_true",
+                help="print the estimated backlog of every task without syncing",
+        )
+        parser.add_argument(
+                "--plan", action="store_true",
+                help="print the dependency plan without running anything",
+        )
+        parser.add_argument(
+                "--verify", action="store_true",
+                help="compare the target rows with the source rows by pk ranges, print the drift",
+        )
+        parser.add_argument(
+                "--repair", action="store_true",
+                help="with --verify, sync the missing and changed rows again",
+        )
+        parser.add_argument(
+                "--delete-extra", action="store_true",
+                help="with --verify --repair, also delete the extra target rows, needs --name",
+        )
+        parser.add_argument(
+                "--leaf-size", type=int, default=LEAF_SIZE,
+                help="with --verify, the ranges with fewer rows are compared row by row",
+        )
+        parser.add_argument(
+                "--explain", action="store_true",
+                help="print the query plan of the next batch of each task and suggest the missing index",
+        )
+        parser.add_argument(
+                "--make-index-migration", action="store_true",
+                help="with --explain, write a migration creating each suggested index of a managed source model",
+        )
+        parser.add_argument(
+                "--shared-scan", action="store_true",
+                help="the ready tasks reading the same source in the same order share one batch query",
+        )
+        parser.add_argument(
+                "--prefetch", type=int, default=0,
+                help="in drain mode, fetch up to N next batches in a background thread while writing the current one",
+        )
+        parser.add_argument(
+                "--export", type=str, dest="export_dir",
+                help="with --name, write the batches after the cursor into chunk files in this directory",
+        )
+        parser.add_argument(
+                "--import", type=str, dest="import_dir",
+                help="with --name, sync the chunk files of this directory exported by --export",
+        )
 
     def handle(self, *args, **kwargs):  # pylint: disable=unused-argument
+        self.drain = kwargs.get("drain", False)
+        if kwargs.get("timeout") is not None:
+            self.deadline = time.monotonic() + kwargs["timeout"]
+        self.max_batches = kwargs.get("max_batches")
+        self.workers = kwargs.get("workers") or 1
+        self.report = self.workers > 1 or kwargs.get("verbosity", 1) >= 2
+        self.lease = kwargs.get("lease")
+        self.lease_owner = default_owner()
+        self.profile_dir = kwargs.get("profile_dir")
+        self.prefetch = kwargs.get("prefetch") or 0
+        self.shared_scan = kwargs.get("shared_scan", False)
+        if not kwargs.get("profile"):
+            self.dispatch(kwargs)
+            return
+        report = PhaseReport()
+        sync_phase.connect(report.receiver, sender=SyncTask, weak=False)
+        try:
+            self.dispatch(kwargs)
+        finally:
+            sync_phase.disconnect(report.receiver, sender=SyncTask)
+            for line in report.lines():
+                self.stdout.write(line)
+
+    def dispatch(self, kwargs: dict) -> None:
+        if kwargs.get("verify"):
+            self.write_verify(kwargs)
+            return
+        if kwargs.get("explain"):
+            self.write_explain(kwargs)
+            return
+        if kwargs.get("export_dir") or kwargs.get("import_dir"):
+            self.transport(kwargs)
+            return
+        if kwargs.get("plan") or kwargs.get("status"):
+            # read only, never sync even with --name
+            plan = SyncPlan.load()
+            if kwargs.get("plan"):
+                self.write_plan(plan, kwargs.get("name"))
+            else:
+                self.write_status(plan, kwargs.get("name"))
+            return
         if kwargs.get("name"):
-            self.run_sync_task(
-                    SyncTask.objects.get(name=kwargs["name"])
-            )
+            sync_task = SyncTask.objects.get(name=kwargs["name"])
+            try:
+                for shard in get_shards(sync_task):
+                    if self.sync(sync_task, shard) is None:
+                        break
+            finally:
+                self.release(sync_task)
+            return
+        plan = SyncPlan.load()
+        if kwargs.get("follow"):
+            self.follow(plan, kwargs["poll_interval"], kwargs["max_poll_interval"])
             return
-        synced_tasks = set()
-        finished_tasks = set()
-        next_tasks = set(SyncTask.objects.filter(dependencies=None))
-        while next_tasks:
-            sync_task = next_tasks.pop()
-            result = self.run_sync_task(sync_task)
+        self.run_graph(plan)
+
+    def follow(self, plan: SyncPlan, poll_interval: float, max_poll_interval: float) -> None:
+        """
+        poll the tasks forever in one process
+        * a full batch is polled again immediately
+        * an empty batch doubles the interval of the task up to max_poll_interval
+        * a task is polled only when all its dependencies caught up
+        * the connections are kept between the rounds, a connection broken by an error is closed every round
+          and after a failure, so a restarted database is reconnected
+        SIGTERM/SIGINT stop the loop after the current batch was checkpointed
+        """
+        def stop(signum, frame):  # pylint: disable=unused-argument
+            LOGGER.info("receive signal %s, stop after the current batch", signum)
+            self.stopping = True
+
+        handlers = {
+                signum: signal.signal(signum, stop)
+                for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        units = [
+                (sync_task, shard)
+                for level in plan.levels
+                for sync_task in level
+                for shard in get_shards(sync_task)
+        ]
+        next_polls = {unit: 0.0 for unit in units}
+        intervals = {unit: poll_interval for unit in units}
+        caught_up: Dict[SyncTask, Dict[Optional[SyncShard], bool]] = {
+                sync_task: {} for sync_task, _ in units
+        }
+        for sync_task, shard in units:
+            caught_up[sync_task][shard] = False
+        try:
+            while not self.stopping and not self.timeout_reached():
+                close_broken_connections()
+                for unit in units:
+                    sync_task, shard = unit
+                    if self.stopping or self.timeout_reached():
+                        break
+                    if next_polls[unit] > time.monotonic():
+                        continue
+                    if not all(
+                            all(caught_up[dependency].values())
+                            for dependency in plan.dependencies[sync_task]
+                    ):
+                        continue
+                    if not self.acquire(sync_task):
+                        next_polls[unit] = time.monotonic() + max_poll_interval
+                        continue
+                    try:
+                        result = self.run_sync_task(sync_task, shard)
+                    except Exception:  # pylint: disable=broad-except
+                        LOGGER.exception("%s failed in follow mode", sync_task)
+                        close_broken_connections()
+                        intervals[unit] = max_poll_interval
+                    else:
+                        caught_up[sync_task][shard] = result["finished"]
+                        if not result["finished"]:
+                            intervals[unit] = 0
+                        elif result["count"] == 0:
+                            intervals[unit] = min(max(intervals[unit] * 2, poll_interval), max_poll_interval)
+                        else:
+                            intervals[unit] = poll_interval
+                    next_polls[unit] = time.monotonic() + intervals[unit]
+                if units:
+                    sleep = min(next_polls.values()) - time.monotonic()
+                else:
+                    sleep = poll_interval
+                if self.deadline is not None:
+                    sleep = min(sleep, self.deadline - time.monotonic())
+                if sleep > 0 and not self.stopping:
+                    time.sleep(min(sleep, 1.0))
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+            for sync_task in caught_up:
+                self.release(sync_task)
+
+    def run_graph(self, plan: SyncPlan) -> None:
+        """
+        run the tasks of the dependencies graph, a task is released once all its dependencies finished
+        a sharded task is split into one unit per shard and finished only when all shards finished
+        with --shared-scan, the ready tasks of a shared scan group are one unit
+        the ready units run by priority and lag, see order_units
+        with --lease, a task is leased when its unit starts, a task leased by another worker is skipped
+        """
+        next_tasks = plan.roots()
+        synced_tasks: Set[SyncTask] = set()
+        finished_tasks: Set[SyncTask] = set()
+        timings: Dict[SyncTask, float] = {}
+        units: Deque[Tuple[SyncTask, Optional[SyncShard]]] = deque()
+        groups: Dict[SyncTask, List[SyncTask]] = {}
+        shard_results: Dict[SyncTask, List[Optional[SyncResult]]] = {}
+        shard_counts: Dict[SyncTask, int] = {}
+        started: Dict[SyncTask, float] = {}
+
+        def fill_units() -> None:
+            shared: List[SyncTask] = []
+            filled = bool(next_tasks)
+            while next_tasks:
+                sync_task = next_tasks.pop()
+                shards = get_shards(sync_task)
+                shard_results[sync_task] = []
+                shard_counts[sync_task] = len(shards)
+                started[sync_task] = time.monotonic()
+                if self.shared_scan and shards == [None]:
+                    shared.append(sync_task)
+                else:
+                    units.extend((sync_task, shard) for shard in shards)
+            for group in group_tasks(shared):
+                if len(group) > 1:
+                    groups[group[0]] = group
+                units.append((group[0], None))
+            if filled and len(units) > 1:
+                ordered = order_units(units)
+                units.clear()
+                units.extend(ordered)
+
+        def on_result(sync_task: SyncTask, result: Optional[SyncResult]) -> None:
+            """
+            result is None if the task was leased by another worker
+            """
+            shard_results[sync_task].append(result)
+            if len(shard_results[sync_task]) < shard_counts[sync_task]:
+                return
+            results = shard_results.pop(sync_task)
+            self.release(sync_task)
             synced_tasks.add(sync_task)
+            timings[sync_task] = time.monotonic() - started.pop(sync_task)
+            if None in results:
+                return
+            result = merge_results(cast(List[SyncResult], results))
             if result["finished"] is True:
                 finished_tasks.add(sync_task)
-                for nomination_task in SyncTask.objects.filter(
-                        dependencies=sync_task
-                        ):
-                    if nomination_task in synced_tasks:
-                        continue
-                    if set(nomination_task.dependencies.all()) - finished_tasks:
-                        continue
-                    next_tasks.add(nomination_task)
+                next_tasks.update(plan.ready(sync_task, finished_tasks) - synced_tasks)
+
+        try:
+            self.execute_units(units, groups, fill_units, on_result)
+        finally:
+            for sync_task in shard_results:
+                self.release(sync_task)
+        if self.report:
+            self.write_report(timings, plan)
+
+    def execute_units(self, units, groups, fill_units, on_result) -> None:
+        """
+        run the units inline, or in a thread pool with --workers
+        a unit of groups syncs the whole group and gives a result of each task
+        """
+        fill_units()
+        if self.workers <= 1:
+            while units:
+                if self.timeout_reached():
+                    LOGGER.info("timeout, skip tasks: %s", {sync_task for sync_task, _ in units})
+                    break
+                sync_task, shard = units.popleft()
+                for result_task, result in self.run_unit(sync_task, shard, groups.pop(sync_task, None)):
+                    on_result(result_task, result)
+                fill_units()
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                running: Set[Future] = set()
+                while units or running:
+                    while units and len(running) < self.workers and not self.timeout_reached():
+                        sync_task, shard = units.popleft()
+                        running.add(executor.submit(
+                            self.thread_run_unit, sync_task, shard, groups.pop(sync_task, None),
+                        ))
+                    if not running:
+                        LOGGER.info("timeout, skip tasks: %s", {sync_task for sync_task, _ in units})
+                        break
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        running.remove(future)
+                        for result_task, result in future.result():
+                            on_result(result_task, result)
+                    fill_units()
+
+    def run_unit(
+            self,
+            sync_task: SyncTask,
+            shard: Optional[SyncShard],
+            group: Optional[List[SyncTask]] = None) -> List[Tuple[SyncTask, Optional[SyncResult]]]:
+        if group is None:
+            return [(sync_task, self.sync(sync_task, shard))]
+        return self.sync_group(group)
+
+    def thread_run_unit(
+            self,
+            sync_task: SyncTask,
+            shard: Optional[SyncShard],
+            group: Optional[List[SyncTask]] = None) -> List[Tuple[SyncTask, Optional[SyncResult]]]:
+        """
+        run in a worker thread, django opens connections per thread so close them at the end
+        """
+        try:
+            return self.run_unit(sync_task, shard, group)
+        finally:
+            connections.close_all()
+
+    def sync_group(self, sync_tasks: List[SyncTask]) -> List[Tuple[SyncTask, Optional[SyncResult]]]:
+        """
+        sync a shared scan group, loop the shared batches in drain mode
+        the tasks are synced alone if the shared batch is too small for the cursor
+        the tasks leased by another worker get no result
+        """
+        results: Dict[SyncTask, Optional[SyncResult]] = {sync_task: None for sync_task in sync_tasks}
+        sync_tasks = [sync_task for sync_task in sync_tasks if self.acquire(sync_task)]
+        if not sync_tasks:
+            return list(results.items())
+        try:
+            results.update(sync_shared_batch(sync_tasks))
+        except StepTooSmallException:
+            LOGGER.info("shared batch of %s is too small, sync the tasks alone", sync_tasks)
+            return [
+                    (sync_task, self.sync(sync_task) if sync_task in sync_tasks else None)
+                    for sync_task in results
+            ]
+        batches = 1
+        while self.drain:
+            # a task which lost its lease in the shared batch has no new result
+            sync_tasks = [
+                    sync_task for sync_task in sync_tasks
+                    if results[sync_task] is not None and not results[sync_task]["finished"]
+            ]
+            if not sync_tasks:
+                break
+            if self.max_batches and batches >= self.max_batches:
+                LOGGER.info("%s reach max batches %d", sync_tasks, batches)
+                break
+            if self.timeout_reached():
+                LOGGER.info("%s timeout after %d batches", sync_tasks, batches)
+                break
+            if self.lease is not None:
+                sync_tasks = [
+                        sync_task for sync_task in sync_tasks
+                        if renew_lease(sync_task, self.lease_owner, self.lease)
+                ]
+                if not sync_tasks:
+                    break
+            try:
+                batch_results = sync_shared_batch(sync_tasks)
+            except StepTooSmallException:
+                LOGGER.info("shared batch of %s is too small, stop the shared scan", sync_tasks)
+                break
+            for sync_task in sync_tasks:
+                if sync_task not in batch_results:
+                    results[sync_task] = None
+            results.update(batch_results)
+            batches += 1
+        return list(results.items())
+
+    def write_plan(self, plan: SyncPlan, name: Optional[str] = None) -> None:
+        for index, level in enumerate(plan.levels):
+            level = [sync_task for sync_task in level if name is None or sync_task.name == name]
+            if not level:
+                continue
+            self.stdout.write(f"level {index}:")
+            for sync_task in level:
+                dependencies = ",".join(
+                        str(dependency.pk) for dependency in sorted(
+                            plan.dependencies[sync_task], key=lambda dependency: dependency.pk
+                        )
+                )
+                self.stdout.write(
+                        f"  {sync_task.pk}\t{sync_task}\t{sync_task.source.model} -> {sync_task.target.model}"
+                        f"\tdepends on: {dependencies or '-'}"
+                )
+
+    def write_status(self, plan: SyncPlan, name: Optional[str] = None) -> None:
+        self.stdout.write("id\tname\tbacklog\ttime lag")
+        for level in plan.levels:
+            for sync_task in level:
+                if name is not None and sync_task.name != name:
+                    continue
+                estimates = [
+                        estimate_backlog(sync_task, shard)
+                        for shard in get_shards(sync_task, create=False)
+                ]
+                rows = sum(estimate["rows"] or 0 for estimate in estimates)
+                methods = {estimate["method"] for estimate in estimates}
+                if "at_least" in methods:
+                    backlog = f">={rows}"
+                elif "planner" in methods:
+                    backlog = f"~{rows}"
+                else:
+                    backlog = str(rows)
+                time_lags = [estimate["time_lag"] for estimate in estimates if estimate["time_lag"] is not None]
+                time_lag = f"{max(time_lags):.0f}s" if time_lags else "-"
+                self.stdout.write(f"{sync_task.pk}\t{sync_task}\t{backlog}\t{time_lag}")
+
+    def write_verify(self, kwargs: dict) -> None:
+        if kwargs.get("delete_extra") and not kwargs.get("name"):
+            raise CommandError("--delete-extra needs --name")
+        if kwargs.get("name"):
+            sync_tasks = [SyncTask.objects.get(name=kwargs["name"])]
+        else:
+            sync_tasks = list(SyncTask.objects.order_by("pk"))
+        self.stdout.write("id\tname\tmissing\textra\tchanged\tpending\tranges")
+        for sync_task in sync_tasks:
+            report = verify(sync_task, kwargs.get("leaf_size") or LEAF_SIZE)
+            self.stdout.write(
+                    f"{sync_task.pk}\t{sync_task}\t{len(report['missing'])}\t{len(report['extra'])}"
+                    f"\t{len(report['changed'])}\t{len(report['pending'])}\t{report['ranges']}"
+            )
+            if kwargs.get("verbosity", 1) >= 2:
+                for key, pks in (
+                        ("missing", report["missing"]),
+                        ("extra", report["extra"]),
+                        ("changed", report["changed"])):
+                    if pks:
+                        self.stdout.write(f"  {key}: {pks}")
+            if kwargs.get("repair") and (report["missing"] or report["extra"] or report["changed"]):
+                repair(sync_task, report, kwargs.get("delete_extra", False))
+
+    def write_explain(self, kwargs: dict) -> None:
+        if kwargs.get("name"):
+            sync_tasks = [SyncTask.objects.get(name=kwargs["name"])]
+        else:
+            sync_tasks = list(SyncTask.objects.filter(capture="poll").order_by("pk"))
+        # tasks of the same source may suggest the same index
+        written: Set[Tuple[int, Tuple[str, ...]]] = set()
+        for sync_task in sync_tasks:
+            report = explain(sync_task)
+            self.stdout.write(f"{sync_task.pk}\t{sync_task}")
+            for line in report["plan"].splitlines():
+                self.stdout.write(f"  {line}")
+            for warning in report["warnings"]:
+                self.stdout.write(f"  warning: {warning}")
+            if report["index"] is None:
+                continue
+            self.stdout.write(f"  suggest: models.Index(fields={report['index']})")
+            if not kwargs.get("make_index_migration"):
+                continue
+            key = (sync_task.source_id, tuple(report["index"]))
+            if key in written:
+                continue
+            path, content = get_index_migration(sync_task, report["index"])
+            with open(path, "w", encoding="utf-8") as migration_file:
+                migration_file.write(content)
+            written.add(key)
+            self.stdout.write(f"  write migration: {path}")
+
+    def transport(self, kwargs: dict) -> None:
+        """
+        --export or --import the chunk files of one task, --max-batches and --timeout limit the chunks
+        """
+        if not kwargs.get("name"):
+            raise CommandError("--export and --import need --name")
+        sync_task = SyncTask.objects.get(name=kwargs["name"])
+        if not self.acquire(sync_task):
+            return
+        try:
+            if kwargs.get("export_dir"):
+                chunks = export(sync_task, kwargs["export_dir"], self.max_batches, self.deadline)
+                rows = sum(chunk["rows"] for chunk in chunks)
+                self.stdout.write(f"{sync_task.pk}\t{sync_task}\texport {len(chunks)} chunks, {rows} rows")
+            else:
+                results = import_chunks(sync_task, kwargs["import_dir"], self.max_batches, self.deadline)
+                rows = sum(result["count"] for result in results)
+                self.stdout.write(f"{sync_task.pk}\t{sync_task}\timport {len(results)} chunks, {rows} rows")
+        finally:
+            self.release(sync_task)
+
+    def write_report(self, timings: Dict[SyncTask, float], plan: SyncPlan) -> None:
+        """
+        print the wall time of every task and the critical path
+        """
+        for sync_task, seconds in sorted(timings.items(), key=lambda item: -item[1]):
+            self.stdout.write(f"{sync_task.pk}\t{sync_task}\t{seconds:.3f}s")
+        path, seconds = critical_path(timings, {
+            sync_task: list(plan.dependencies[sync_task])
+            for sync_task in timings
+        })
+        self.stdout.write(
+                "critical path: "
+                + " -> ".join(str(sync_task.pk) for sync_task in path)
+                + f" ({seconds:.3f}s)"
+        )
+
+    def acquire(self, sync_task: SyncTask) -> bool:
+        if self.lease is None:
+            return True
+        return acquire_lease(sync_task, self.lease_owner, self.lease)
+
+    def release(self, sync_task: SyncTask) -> None:
+        if self.lease is not None:
+            release_lease(sync_task, self.lease_owner)
+
+    def timeout_reached(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def sync(self, sync_task: SyncTask, shard: Optional[SyncShard] = None) -> Optional[SyncResult]:
+        """
+        sync one batch, or loop the batches in drain mode
+        None if the task is leased by another worker
+        with --profile-dir, the cProfile stats are dumped into <dir>/<task pk>[-<shard>].prof
+        """
+        if not self.profile_dir:
+            return self.sync_batches(sync_task, shard)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return self.sync_batches(sync_task, shard)
+        finally:
+            profiler.disable()
+            name = str(sync_task.pk) if shard is None else f"{sync_task.pk}-{shard.index}"
+            profiler.dump_stats(os.path.join(self.profile_dir, f"{name}.prof"))
+
+    def sync_batches(self, sync_task: SyncTask, shard: Optional[SyncShard] = None) -> Optional[SyncResult]:
+        """
+        with --prefetch, the next batches are fetched in a background thread while the current one is written
+        with --lease, the task is leased before the first batch and the lease is renewed before every batch,
+        the loop stops once another worker took the lease
+        """
+        if not self.acquire(sync_task):
+            return None
+        prefetcher: Optional[Prefetcher] = None
+        if self.drain and self.prefetch > 0 and sync_task.capture == "poll":
+            prefetcher = Prefetcher(sync_task, shard, self.prefetch)
+        cursor: Union[SyncTask, SyncShard] = sync_task if shard is None else shard
+        result: Optional[SyncResult] = None
+        batches = 0
+        try:
+            while True:
+                if batches and self.lease is not None and not renew_lease(sync_task, self.lease_owner, self.lease):
+                    LOGGER.warning("%s lost the lease after %d batches", sync_task, batches)
+                    return result
+                prefetched = None
+                if prefetcher is not None:
+                    with phase("fetch", sync_task, shard):
+                        prefetched = prefetcher.get(cursor.last_sync, sync_task.batch_size)
+                try:
+                    result = self.run_sync_task(sync_task, shard, prefetched)
+                except LeaseLostException:
+                    LOGGER.warning("%s lost the lease in batch %d, the cursor was not moved", sync_task, batches + 1)
+                    return result
+                batches += 1
+                if not self.drain or result["finished"]:
+                    return result
+                if self.max_batches and batches >= self.max_batches:
+                    LOGGER.info("%s reach max batches %d", sync_task, batches)
+                    return result
+                if self.timeout_reached():
+                    LOGGER.info("%s timeout after %d batches", sync_task, batches)
+                    return result
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+
+    @classmethod
+    def run_sync_task(
+            cls,
+            sync_task: SyncTask,
+            shard: Optional[SyncShard] = None,
+            prefetched: Optional[Tuple[dict, list]] = None) -> SyncResult:
+        """
+        sync a single SyncTask, or a single shard of it
+        with adaptive_batch_size, the batch_size is tuned after the batch, and enlarged until the step is big enough
+        prefetched: (last_sync, rows) fetched ahead by a Prefetcher
+        a step too small batch is saved as an error in the ledger only if it is not retried
+        """
+        while True:
+            try:
+                sync_result = cls.run_batch(sync_task, shard, prefetched)
+            except StepTooSmallException:
+                if not sync_task.adaptive_batch_size or sync_task.batch_size >= sync_task.max_batch_size:
+                    cursor: Union[SyncTask, SyncShard] = sync_task if shard is None else shard
+                    record_run(sync_task, shard, cursor.last_sync, cursor.last_sync)
+                    raise
+                prefetched = None
+                sync_task.batch_size = min(sync_task.batch_size * 2, sync_task.max_batch_size)
+                LOGGER.info("%s step too small, enlarge batch_size to %d", sync_task, sync_task.batch_size)
+                sync_task.save(update_fields=["batch_size"])
+                continue
+            if sync_task.adaptive_batch_size and sync_result["count"]:
+                batch_size = get_adapted_batch_size(sync_task, sync_result)
+                if batch_size != sync_task.batch_size:
+                    LOGGER.info("%s adapt batch_size %d -> %d", sync_task, sync_task.batch_size, batch_size)
+                    sync_task.batch_size = batch_size
+                    sync_task.save(update_fields=["batch_size"])
+            return sync_result
+
+    @classmethod
+    def run_batch(
+            cls,
+            sync_task: SyncTask,
+            shard: Optional[SyncShard] = None,
+            prefetched: Optional[Tuple[dict, list]] = None) -> SyncResult:
+        """
+        sync one batch and save the cursor, in one transaction of target_db if sync_task.atomic
+        """
+        cursor: Union[SyncTask, SyncShard] = sync_task if shard is None else shard
+        if sync_task.atomic:
+            # the checkpoint committed with the last batch wins over a cursor not saved before a crash
+            load_checkpoint(sync_task, cursor)
+        cursor_before = cursor.last_sync
+        limiter = get_limiter(sync_task.source_db)
+        slot = SourceSlot(limiter)
+        with phase("throttle", sync_task, shard):
+            slot.acquire()
+        start = timezone.now()
+        try:
+            if not sync_task.atomic:
+                sync_result = cls.sync_batch(sync_task, cursor, shard, prefetched, slot)
+            else:
+                with transaction.atomic(using=sync_task.target_db):
+                    sync_result = cls.sync_batch(sync_task, cursor, shard, prefetched, slot)
+        except StepTooSmallException:
+            # recorded by run_sync_task unless the batch is retried with a larger batch_size
+            raise
+        except Exception:
+            record_run(sync_task, shard, cursor.last_sync, cursor.last_sync, start=start)
+            raise
+        finally:
+            slot.release()
+        limiter.consume(sync_result["count"])
+        with phase("ledger", sync_task, shard):
+            record_run(sync_task, shard, cursor_before, cursor.last_sync, sync_result)
+        return sync_result
 
     @staticmethod
-    def run_sync_task(sync_task: SyncTask) -> SyncResult:
+    def sync_batch(
+            sync_task: SyncTask,
+            cursor: Union[SyncTask, SyncShard],
+            shard: Optional[SyncShard],
+            prefetched: Optional[Tuple[dict, list]] = None,
+            slot: Optional[SourceSlot] = None) -> SyncResult:
         """
-        sync a single SyncTask
+        sync one batch from cursor.last_sync
+        the prefetched rows are used only if they were fetched after the same cursor
+        the slot of the source_db is released once the batch is read, before the sync method writes it.
+        A streamed batch (chunk_size), a trigger capture and sync_in_database read the source while they write,
+        so they keep the slot until the batch is synced.
 
         previous version: the queryset.count() will be very slow, so I require the sync_method to return a syncresult
 
@@ -74,32 +834,58 @@ class Command(BaseCommand):
         ```
 
         """
-        LOGGER.info("start sync: %s", sync_task)
-        queryset = get_queryset(sync_task)
-        module, function = sync_task.sync_method.rsplit(".", 1)
-        sync_function = getattr(
-            importlib.import_module(module),
-            function
-        )
+        LOGGER.info("start sync: %s", cursor)
+        if sync_task.capture == "trigger":
+            if shard is not None:
+                raise ValueError(f"A sync task {sync_task} can not use shards with trigger capture")
+            with phase("sync", sync_task, shard):
+                return sync_changes(sync_task, cursor)
+        with phase("resolve", sync_task, shard):
+            sync_function = get_sync_function(sync_task.sync_method)
+            target_model = sync_task.target.model_class()
         LOGGER.debug("sync_function realized")
-        sync_result: SyncResult = sync_function(
-                queryset[0:sync_task.batch_size],
-                sync_task.target.model_class(),
-                sync_task)
+        if prefetched is not None and prefetched[0] == cursor.last_sync:
+            # already loaded by the Prefetcher
+            batch = prefetched[1]
+            if slot is not None:
+                slot.release()
+        else:
+            with phase("query", sync_task, shard):
+                queryset = get_queryset(sync_task, shard)
+                batch = queryset[0:sync_task.batch_size]
+            # sync_in_database reads the rows in its INSERT ... SELECT, loading them first would read them twice
+            release_slot = (
+                    slot is not None and slot.limiter.semaphore is not None
+                    and sync_function is not sync_in_database
+            )
+            if sync_task.chunk_size:
+                batch = batch.iterator(chunk_size=sync_task.chunk_size)
+            elif release_slot or sync_phase.has_listeners(SyncTask):
+                # load the batch before the sync method, to free the slot and to time the source read alone
+                with phase("fetch", sync_task, shard):
+                    len(batch)
+                if release_slot:
+                    cast(SourceSlot, slot).release()
+        with phase("sync", sync_task, shard):
+            sync_result: SyncResult = sync_function(
+                    batch,
+                    target_model,
+                    sync_task)
         if sync_result["last_sync_model"] is None:
             if sync_result["count"] == 0:
                 LOGGER.info("Origin model has deleted the last model")
                 LOGGER.info("%s finished %s, last_sync: %s",
-                            sync_task, sync_result, sync_task.last_sync)
+                            cursor, sync_result, cursor.last_sync)
                 return sync_result
             raise ValueError("sync count is not None, but the last_sync_model is empty")
         last_value = get_value(sync_result["last_sync_model"],
                                sync_task.order_by,
                                datetime2str=True)
-        if sync_result["finished"] is False and sync_task.last_sync == last_value:
+        if sync_result["finished"] is False and cursor.last_sync == last_value:
             raise StepTooSmallException
-        sync_task.last_sync = last_value
-        sync_task.save()
+        cursor.last_sync = last_value
+        with phase("checkpoint", sync_task, shard):
+            save_checkpoint(sync_task, cursor)
         LOGGER.info("%s finished %s, last_sync: %s",
-                    sync_task, sync_result, sync_task.last_sync)
+                    cursor, sync_result, cursor.last_sync)
         return sync_result
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+benchmark the sync throughput on synthetic RawStockAction rows
+"""
+
+
+import datetime
+import itertools
+import json
+import logging
+import random
+import time
+import tracemalloc
+
+from typing import List
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import BaseCommand, CommandError
+from django.db import connections
+
+from sync_model.management.commands.sync_model import Command as SyncCommand
+from sync_model.models import RawStockAction, StockAction, SyncTask
+from sync_model.profiling import QueryCounter
+
+
+LOGGER = logging.getLogger(__name__)
+BENCH_FIELD_MAP = {
+        "id": "id",
+        "update_datetime": "update_datetime",
+        "sender": "sender",
+        "stock_number": "stock_number",
+}
+
+
+def split(value: str) -> List[str]:
+    return [item for item in value.split(",") if item]
+
+
+def percentile(values: List[float], percent: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+
+class Command(BaseCommand):
+    """generate RawStockAction rows and sync them with several task shapes, print the result as json"""
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=100000)
+        parser.add_argument(
+                "--database", type=str, default="default",
+                help="source_db and target_db of the benchmark tasks",
+        )
+        parser.add_argument("--batch-sizes", type=split, default=["100", "1000"])
+        parser.add_argument(
+                "--order-by", type=split, action="append",
+                help="e.g. --order-by update_datetime,pk --order-by update_datetime,-sender",
+        )
+        parser.add_argument(
+                "--sync-methods", type=split,
+                default=["sync_model.utils.sync_raw_stock_action", "sync_model.utils.bulk_sync"],
+        )
+        parser.add_argument(
+                "--ties", type=int, default=5,
+                help="average number of rows sharing the same update_datetime",
+        )
+        parser.add_argument("--senders", type=int, default=1000)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+                "--clear", action="store_true",
+                help="delete the existing RawStockAction and StockAction rows of the database first",
+        )
+        parser.add_argument(
+                "--no-memory", action="store_true",
+                help="do not trace the peak memory, tracemalloc slows the sync down",
+        )
+        parser.add_argument("--output", type=str, help="write the json into this file instead of stdout")
+
+    def handle(self, *args, **kwargs):  # pylint: disable=unused-argument
+        database = kwargs["database"]
+        if RawStockAction.objects.using(database).exists() or StockAction.objects.using(database).exists():
+            if not kwargs["clear"]:
+                raise CommandError("the benchmark deletes RawStockAction and StockAction, use --clear")
+            RawStockAction.objects.using(database).all().delete()
+            StockAction.objects.using(database).all().delete()
+        start = time.perf_counter()
+        self.generate(database, kwargs["rows"], kwargs["ties"], kwargs["senders"], kwargs["seed"])
+        results = {
+                "vendor": connections[database].vendor,
+                "rows": kwargs["rows"],
+                "ties": kwargs["ties"],
+                "generate_seconds": time.perf_counter() - start,
+                "runs": [],
+        }
+        order_bys = kwargs["order_by"] or [["update_datetime", "pk"], ["update_datetime", "-sender", "pk"]]
+        for sync_method, batch_size, order_by in itertools.product(
+                kwargs["sync_methods"], kwargs["batch_sizes"], order_bys):
+            StockAction.objects.using(database).all().delete()
+            results["runs"].append(self.bench(
+                database, sync_method, int(batch_size), order_by,
+                trace_memory=not kwargs["no_memory"],
+            ))
+        RawStockAction.objects.using(database).all().delete()
+        StockAction.objects.using(database).all().delete()
+        output = json.dumps(results, indent=2)
+        if kwargs.get("output"):
+            with open(kwargs["output"], "w", encoding="utf-8") as output_file:
+                output_file.write(output)
+        else:
+            self.stdout.write(output)
+
+    @staticmethod
+    def generate(database: str, rows: int, ties: int, senders: int, seed: int) -> None:
+        """
+        rows ordered in time, the number of rows sharing one update_datetime is random around ties
+        """
+        generator = random.Random(seed)
+        update_datetime = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        tie_left = 0
+        chunk = []
+        for _ in range(rows):
+            if tie_left <= 0:
+                update_datetime += datetime.timedelta(milliseconds=generator.randint(1, 1000))
+                tie_left = generator.randint(1, max(ties * 2 - 1, 1))
+            tie_left -= 1
+            chunk.append(RawStockAction(
+                sender=f"sender{generator.randrange(senders)}",
+                action_type=generator.choice(["buy", "sell", "cancel"]),
+                update_datetime=update_datetime,
+                canceled=generator.random() < 0.1,
+                stock_number=f"STOCK{generator.randrange(5000)}",
+            ))
+            if len(chunk) >= 10000:
+                RawStockAction.objects.using(database).bulk_create(chunk)
+                chunk = []
+        RawStockAction.objects.using(database).bulk_create(chunk)
+
+    @staticmethod
+    def bench(database: str, sync_method: str, batch_size: int, order_by: List[str], trace_memory: bool) -> dict:
+        """
+        drain a new task, measure every batch
+        """
+        sync_task = SyncTask.objects.create(
+                name=f"bench {sync_method} {batch_size} {','.join(order_by)}",
+                source=ContentType.objects.get_for_model(RawStockAction),
+                source_db=database,
+                target=ContentType.objects.get_for_model(StockAction),
+                target_db=database,
+                sync_method=sync_method,
+                batch_size=batch_size,
+                order_by=order_by,
+                field_map=BENCH_FIELD_MAP,
+        )
+        result = {
+                "sync_method": sync_method,
+                "batch_size": batch_size,
+                "order_by": order_by,
+                "error": None,
+        }
+        latencies = []
+        rows = 0
+        counter = QueryCounter()
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            with connections[database].execute_wrapper(counter.wrapper(database)):
+                while True:
+                    batch_start = time.perf_counter()
+                    sync_result = SyncCommand.run_sync_task(sync_task)
+                    latencies.append(time.perf_counter() - batch_start)
+                    rows += sync_result["count"]
+                    if sync_result["finished"]:
+                        break
+        except Exception as error:  # pylint: disable=broad-except
+            LOGGER.exception("benchmark %s failed", sync_task)
+            result["error"] = repr(error)
+        seconds = time.perf_counter() - start
+        peak_memory = None
+        if trace_memory:
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        sync_task.delete()
+        # the last batch is partial
+        full_latencies = latencies[:-1] or latencies
+        tenth = max(len(full_latencies) // 10, 1)
+        result.update({
+            "rows": rows,
+            "batches": len(latencies),
+            "seconds": seconds,
+            "rows_per_second": rows / seconds if seconds else 0,
+            "latency_p50": percentile(latencies, 50),
+            "latency_p90": percentile(latencies, 90),
+            "latency_p99": percentile(latencies, 99),
+            "latency_max": max(latencies, default=0),
+            # > 1 means the batches get slower as the cursor advances
+            "latency_trend": (
+                sum(full_latencies[-tenth:]) / sum(full_latencies[:tenth])
+                if full_latencies and sum(full_latencies[:tenth]) else None
+            ),
+            "queries": sum(counter.queries.values()),
+            "peak_memory_bytes": peak_memory,
+        })
+        return result
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+install the change capture triggers of a sync task
+"""
+
+
+from django.core.management import BaseCommand
+
+from sync_model.capture import execute_sql, get_drop_trigger_sql, get_trigger_sql
+from sync_model.models import SyncTask
+
+
+class Command(BaseCommand):
+    """install (or uninstall) the triggers filling SyncChangeLog for the source table of a task"""
+
+    def add_arguments(self, parser):
+        parser.add_argument("name", type=str)
+        parser.add_argument("--uninstall", action="store_true")
+        parser.add_argument("--print", action="store_true", help="only print the sql")
+
+    def handle(self, *args, **kwargs):  # pylint: disable=unused-argument
+        sync_task = SyncTask.objects.get(name=kwargs["name"])
+        if kwargs["uninstall"]:
+            statements = get_drop_trigger_sql(sync_task)
+        else:
+            statements = get_trigger_sql(sync_task)
+        if kwargs["print"]:
+            for statement in statements:
+                self.stdout.write(f"{statement};")
+            return
+        execute_sql(sync_task, statements)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+print the metrics of the sync tasks in prometheus text format
+"""
+
+
+import datetime
+
+from django.core.management import BaseCommand
+from django.utils import timezone
+
+from sync_model.ledger import get_lag, get_rows_per_second, get_task_metrics, rollup_runs
+from sync_model.models import SyncRun
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Command(BaseCommand):
+    """print the metrics of the sync tasks, and keep the ledger small"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+                "--window", type=float, default=3600,
+                help="seconds, the rows and throughput are computed on the runs of this window",
+        )
+        parser.add_argument(
+                "--rollup-days", type=float,
+                help="merge the runs older than N days into one run per task and day",
+        )
+        parser.add_argument(
+                "--retention-days", type=float,
+                help="delete the runs older than N days",
+        )
+
+    def handle(self, *args, **kwargs):  # pylint: disable=unused-argument
+        now = timezone.now()
+        if kwargs.get("retention_days") is not None:
+            SyncRun.objects.filter(
+                    end__lt=now - datetime.timedelta(days=kwargs["retention_days"]),
+            ).delete()
+        if kwargs.get("rollup_days") is not None:
+            rollup_runs(now - datetime.timedelta(days=kwargs["rollup_days"]))
+        metrics = {
+                "sync_model_rows": ("gauge", "rows synced in the window"),
+                "sync_model_batches": ("gauge", "batches synced in the window"),
+                "sync_model_errors": ("gauge", "failed batches in the window"),
+                "sync_model_rows_per_second": ("gauge", "rows per busy second in the window"),
+                "sync_model_seconds_since_caught_up": (
+                    "gauge", "seconds since the task last reached the end of the source",
+                ),
+                "sync_model_last_run_timestamp_seconds": ("gauge", "end of the last batch"),
+        }
+        values: dict = {name: [] for name in metrics}
+        for sync_task in get_task_metrics(now - datetime.timedelta(seconds=kwargs["window"])):
+            labels = f'{{task="{escape(sync_task.name)}",id="{sync_task.pk}"}}'
+            values["sync_model_rows"].append((labels, sync_task.rows or 0))
+            values["sync_model_batches"].append((labels, sync_task.batches or 0))
+            values["sync_model_errors"].append((labels, sync_task.errors))
+            rows_per_second = get_rows_per_second(sync_task)
+            if rows_per_second is not None:
+                values["sync_model_rows_per_second"].append((labels, rows_per_second))
+            lag = get_lag(sync_task, now)
+            if lag is not None:
+                values["sync_model_seconds_since_caught_up"].append((labels, lag))
+            if sync_task.last_run is not None:
+                values["sync_model_last_run_timestamp_seconds"].append((labels, sync_task.last_run.timestamp()))
+        for name, (metric_type, description) in metrics.items():
+            self.stdout.write(f"# HELP {name} {description}")
+            self.stdout.write(f"# TYPE {name} {metric_type}")
+            for labels, value in values[name]:
+                self.stdout.write(f"{name}{labels} {value}")
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync_model', '0007_broker_rawstockaction_broker'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='synctask',
+            name='field_map',
+            field=models.JSONField(blank=True, default=dict, help_text='target field -> source field, used by sync_model.utils.bulk_sync'),
+        ),
+        migrations.AddField(
+            model_name='synctask',
+            name='update_existing',
+            field=models.BooleanField(default=True, help_text='bulk_sync: update the existing target rows, otherwise ignore them'),
+        ),
+    ]
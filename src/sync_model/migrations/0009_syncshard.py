@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync_model', '0008_synctask_field_map'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='synctask',
+            name='shard_by',
+            field=models.TextField(default='pk', help_text='an integer field of the source model'),
+        ),
+        migrations.AddField(
+            model_name='synctask',
+            name='shards',
+            field=models.IntegerField(default=1, help_text='split the task into N shards by shard_by % N, each shard has its own cursor'),
+        ),
+        migrations.CreateModel(
+            name='SyncShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.IntegerField()),
+                ('last_sync', models.JSONField(default=dict)),
+                ('sync_task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='sync_model.synctask')),
+            ],
+            options={
+                'unique_together': {('sync_task', 'index')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync_model', '0009_syncshard'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='synctask',
+            name='lease_expires',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='synctask',
+            name='lease_owner',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
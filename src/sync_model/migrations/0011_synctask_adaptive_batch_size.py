@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync_model', '0010_synctask_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='synctask',
+            name='adaptive_batch_size',
+            field=models.BooleanField(default=False, help_text='tune batch_size toward target_batch_duration, and enlarge it instead of raising StepTooSmallException'),
+        ),
+        migrations.AddField(
+            model_name='synctask',
+            name='max_batch_size',
+            field=models.IntegerField(default=100000),
+        ),
+        migrations.AddField(
+            model_name='synctask',
+            name='target_batch_duration',
+            field=models.FloatField(default=1.0, help_text='seconds'),
+        ),
+    ]
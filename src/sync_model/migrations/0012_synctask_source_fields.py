@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync_model', '0011_synctask_adaptive_batch_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='synctask',
+            name='chunk_size',
+            field=models.IntegerField(blank=True, help_text='stream the batch with queryset.iterator(chunk_size) instead of loading it at once', null=True),
+        ),
+        migrations.AddField(
+            model_name='synctask',
+            name='source_fields',
+            field=models.JSONField(blank=True, default=list, help_text='only load these source fields (the order_by keys are always loaded), empty means all'),
+        ),
+    ]
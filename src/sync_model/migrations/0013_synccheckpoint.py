@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync_model', '0012_synctask_source_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.TextField(unique=True)),
+                ('last_sync', models.JSONField(default=dict)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='synctask',
+            name='atomic',
+            field=models.BooleanField(default=False, help_text='commit the target writes and the cursor of a batch in one transaction on target_db'),
+        ),
+    ]
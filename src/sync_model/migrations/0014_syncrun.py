@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync_model', '0013_synccheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.IntegerField(blank=True, null=True)),
+                ('count', models.IntegerField(default=0)),
+                ('batches', models.IntegerField(default=1)),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField()),
+                ('duration', models.FloatField(default=0, help_text='seconds')),
+                ('cursor_before', models.JSONField(default=dict)),
+                ('cursor_after', models.JSONField(default=dict)),
+                ('outcome', models.CharField(choices=[('finished', 'finished'), ('partial', 'partial'), ('empty', 'empty'), ('error', 'error'), ('rollup', 'rollup')], max_length=10)),
+                ('sync_task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='sync_model.synctask')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['sync_task', 'end'], name='sync_model__sync_ta_7d3914_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync_model', '0014_syncrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='synctask',
+            name='capture',
+            field=models.CharField(choices=[('poll', 'poll'), ('trigger', 'trigger')], default='poll', help_text='trigger: consume the SyncChangeLog filled by the triggers of `sync_model_capture`', max_length=10),
+        ),
+        migrations.CreateModel(
+            name='SyncChangeLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('table_name', models.TextField()),
+                ('row_pk', models.TextField()),
+                ('operation', models.CharField(choices=[('I', 'insert'), ('U', 'update'), ('D', 'delete')], max_length=1)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['table_name', 'id'], name='sync_model__table_n_169bda_idx')],
+            },
+        ),
+    ]
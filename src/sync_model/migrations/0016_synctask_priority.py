@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync_model', '0015_syncchangelog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='synctask',
+            name='priority',
+            field=models.IntegerField(default=0, help_text='the ready tasks with a higher priority run first, then the tasks lagging most'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync_model', '0016_synctask_priority'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='synctask',
+            name='fingerprint',
+            field=models.BooleanField(default=False, help_text='bulk_sync: skip the rows whose mapped fields did not change since they were written'),
+        ),
+        migrations.CreateModel(
+            name='SyncFingerprint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task', models.IntegerField()),
+                ('row_pk', models.TextField()),
+                ('digest', models.CharField(max_length=16)),
+            ],
+            options={
+                'unique_together': {('task', 'row_pk')},
+            },
+        ),
+    ]
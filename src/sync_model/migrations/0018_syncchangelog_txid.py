@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync_model', '0017_syncfingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncchangelog',
+            name='txid',
+            field=models.BigIntegerField(blank=True, help_text='postgresql: the writing transaction, the entries are consumed in (txid, id) order', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='syncchangelog',
+            index=models.Index(fields=['table_name', 'txid', 'id'], name='sync_model__table_n_e78734_idx'),
+        ),
+    ]
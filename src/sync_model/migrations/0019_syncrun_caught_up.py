@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:02
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def fill_caught_up(apps, schema_editor):
+    SyncRun = apps.get_model("sync_model", "SyncRun")
+    SyncRun.objects.using(schema_editor.connection.alias).filter(
+        outcome__in=["finished", "empty"],
+    ).update(caught_up=F("end"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync_model', '0018_syncchangelog_txid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncrun',
+            name='caught_up',
+            field=models.DateTimeField(blank=True, help_text='the end of the last batch which reached the end of the source, kept by the rollups', null=True),
+        ),
+        migrations.RunPython(fill_caught_up, migrations.RunPython.noop),
+    ]
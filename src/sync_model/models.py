@@ -3,6 +3,7 @@ sync model
 """
 
 
+from django.core.exceptions import ValidationError
 from django.db import models
 from django.contrib.contenttypes.models import ContentType
 
@@ -31,10 +32,185 @@ class SyncTask(models.Model):
             "self", symmetrical=False,
     )
     filter_by = models.JSONField(default=dict)
+    field_map = models.JSONField(
+            default=dict, blank=True,
+            help_text="target field -> source field, used by sync_model.utils.bulk_sync",
+    )
+    source_fields = models.JSONField(
+            default=list, blank=True,
+            help_text="only load these source fields (the order_by keys are always loaded), empty means all",
+    )
+    chunk_size = models.IntegerField(
+            null=True, blank=True,
+            help_text="stream the batch with queryset.iterator(chunk_size) instead of loading it at once",
+    )
+    update_existing = models.BooleanField(
+            default=True,
+            help_text="bulk_sync: update the existing target rows, otherwise ignore them",
+    )
+
+    fingerprint = models.BooleanField(
+            default=False,
+            help_text="bulk_sync: skip the rows whose mapped fields did not change since they were written",
+    )
+
+    CAPTURE_CHOICES = (
+            ("poll", "poll"),
+            ("trigger", "trigger"),
+    )
+    capture = models.CharField(
+            choices=CAPTURE_CHOICES, max_length=10, default="poll",
+            help_text="trigger: consume the SyncChangeLog filled by the triggers of `sync_model_capture`",
+    )
+    atomic = models.BooleanField(
+            default=False,
+            help_text="commit the target writes and the cursor of a batch in one transaction on target_db",
+    )
+    shards = models.IntegerField(
+            default=1,
+            help_text="split the task into N shards by shard_by % N, each shard has its own cursor",
+    )
+    shard_by = models.TextField(default="pk", help_text="an integer field of the source model")
+    adaptive_batch_size = models.BooleanField(
+            default=False,
+            help_text=(
+                "tune batch_size toward target_batch_duration, "
+                "and enlarge it instead of raising StepTooSmallException"
+            ),
+    )
+    target_batch_duration = models.FloatField(default=1.0, help_text="seconds")
+    max_batch_size = models.IntegerField(default=100000)
+    priority = models.IntegerField(
+            default=0,
+            help_text="the ready tasks with a higher priority run first, then the tasks lagging most",
+    )
+    lease_owner = models.TextField(blank=True, default="")
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    # not a field: the owner of the lease taken by this process, see sync_model.lease
+    leased_by = ""
 
     def __str__(self):
         return self.name
 
+    def clean(self):
+        """
+        the rows move to other shards when shards changes, the old shard cursors would skip them
+        """
+        super().clean()
+        if self.pk is None:
+            return
+        shards = SyncTask.objects.filter(pk=self.pk).values_list("shards", flat=True).first()
+        if shards is not None and shards != self.shards and self.syncshard_set.exists():
+            raise ValidationError({
+                "shards": "the shards of this task have cursors, delete its SyncShard rows to sync it "
+                          "again from the start before changing shards",
+            })
+
+
+class SyncShard(models.Model):
+    """
+    the cursor of one shard of a SyncTask
+    """
+    sync_task = models.ForeignKey(SyncTask, on_delete=models.CASCADE)
+    index = models.IntegerField()
+    last_sync = models.JSONField(default=dict)
+
+    class Meta:
+        unique_together = [("sync_task", "index")]
+
+    def __str__(self):
+        return f"{self.sync_task}[{self.index}]"
+
+
+class SyncRun(models.Model):
+    """
+    the ledger of the synced batches, old runs are rolled up per day by `sync_model_metrics --rollup-days`
+    """
+    OUTCOME_CHOICES = (
+            ("finished", "finished"),
+            ("partial", "partial"),
+            ("empty", "empty"),
+            ("error", "error"),
+            ("rollup", "rollup"),
+    )
+    sync_task = models.ForeignKey(SyncTask, on_delete=models.CASCADE)
+    shard = models.IntegerField(null=True, blank=True)
+    count = models.IntegerField(default=0)
+    batches = models.IntegerField(default=1)
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    duration = models.FloatField(default=0, help_text="seconds")
+    cursor_before = models.JSONField(default=dict)
+    cursor_after = models.JSONField(default=dict)
+    outcome = models.CharField(choices=OUTCOME_CHOICES, max_length=10)
+    caught_up = models.DateTimeField(
+            null=True, blank=True,
+            help_text="the end of the last batch which reached the end of the source, kept by the rollups",
+    )
+
+    class Meta:
+        indexes = [
+                models.Index(fields=["sync_task", "end"]),
+        ]
+
+    def __str__(self):
+        return f"{self.sync_task} {self.outcome} {self.count}"
+
+
+class SyncChangeLog(models.Model):
+    """
+    the changes of a source table written by the triggers, it lives on the source_db
+    """
+    OPERATION_CHOICES = (
+            ("I", "insert"),
+            ("U", "update"),
+            ("D", "delete"),
+    )
+    table_name = models.TextField()
+    row_pk = models.TextField()
+    operation = models.CharField(choices=OPERATION_CHOICES, max_length=1)
+    txid = models.BigIntegerField(
+            null=True, blank=True,
+            help_text="postgresql: the writing transaction, the entries are consumed in (txid, id) order",
+    )
+
+    class Meta:
+        indexes = [
+                models.Index(fields=["table_name", "id"]),
+                models.Index(fields=["table_name", "txid", "id"]),
+        ]
+
+    def __str__(self):
+        return f"{self.table_name} {self.operation} {self.row_pk}"
+
+
+class SyncCheckpoint(models.Model):
+    """
+    the cursor of an atomic SyncTask saved on target_db, when the SyncTask lives in another database
+    name: synctask.<pk> or syncshard.<pk>
+    """
+    name = models.TextField(unique=True)
+    last_sync = models.JSONField(default=dict)
+
+    def __str__(self):
+        return self.name
+
+
+class SyncFingerprint(models.Model):
+    """
+    the digest of the mapped fields of a target row written by bulk_sync, it lives on the target_db
+    task: pk of the SyncTask
+    """
+    task = models.IntegerField()
+    row_pk = models.TextField()
+    digest = models.CharField(max_length=16)
+
+    class Meta:
+        unique_together = [("task", "row_pk")]
+
+    def __str__(self):
+        return f"{self.task} {self.row_pk}"
+
 
 class Broker(models.Model):
     name = models.TextField(default="")
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+prefetch the next batches of a task in a background thread while the current batch is written
+
+the cursor of the next batch is predicted from the last row of the fetched batch,
+a batch whose cursor is not the real cursor any more is dropped and the pipeline restarts
+"""
+
+
+import logging
+import queue
+import threading
+
+from typing import List, Optional, Tuple
+
+from django.db import connections
+from django.db.models import Model
+
+from .models import SyncShard, SyncTask
+from .throttle import get_limiter
+from .utils import get_queryset, get_value
+
+
+LOGGER = logging.getLogger(__name__)
+# seconds, how often a blocked thread checks whether the pipeline is stopped
+POLL_INTERVAL = 0.1
+
+
+class Prefetcher:
+    """
+    >>> prefetcher = Prefetcher(sync_task, shard, depth=2)
+    >>> last_sync, batch = prefetcher.get(cursor.last_sync, sync_task.batch_size)
+    >>> prefetcher.close()
+    """
+
+    def __init__(self, sync_task: SyncTask, shard: Optional[SyncShard] = None, depth: int = 1):
+        self.sync_task = sync_task
+        self.shard = shard
+        self.depth = depth
+        self.queue: queue.Queue = queue.Queue(maxsize=depth)
+        self.stopping = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self, last_sync: dict, batch_size: int) -> None:
+        self.queue = queue.Queue(maxsize=self.depth)
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(
+                target=self.run,
+                args=(last_sync, batch_size, self.queue, self.stopping),
+                name=f"prefetch-{self.sync_task.pk}",
+                daemon=True,
+        )
+        self.thread.start()
+
+    def close(self) -> None:
+        if self.thread is None:
+            return
+        self.stopping.set()
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        self.thread.join()
+        self.thread = None
+
+    def run(self, last_sync: dict, batch_size: int, batches: queue.Queue, stopping: threading.Event) -> None:
+        """
+        the background thread, fetch batch after batch until a batch is not full
+        """
+        # the rows are counted by the rate limit when the batch is synced
+        limiter = get_limiter(self.sync_task.source_db)
+        try:
+            while not stopping.is_set():
+                limiter.acquire()
+                try:
+                    batch: List[Model] = list(
+                            get_queryset(self.sync_task, self.shard, last_sync)[0:batch_size]
+                    )
+                except Exception as error:  # pylint: disable=broad-except
+                    self.put(batches, stopping, (last_sync, batch_size, error))
+                    return
+                finally:
+                    limiter.release()
+                LOGGER.debug("%s prefetch %d rows after %s", self.sync_task, len(batch), last_sync)
+                if not self.put(batches, stopping, (last_sync, batch_size, batch)):
+                    return
+                if len(batch) < batch_size:
+                    return
+                next_sync = get_value(batch[-1], self.sync_task.order_by, datetime2str=True)
+                if next_sync == last_sync:
+                    # the step is too small, the sync will raise StepTooSmallException
+                    return
+                last_sync = next_sync
+        finally:
+            connections.close_all()
+
+    @staticmethod
+    def put(batches: queue.Queue, stopping: threading.Event, item: tuple) -> bool:
+        """
+        block until the queue has room, return False if the pipeline is stopped
+        """
+        while not stopping.is_set():
+            try:
+                batches.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, last_sync: dict, batch_size: int) -> Tuple[dict, List[Model]]:
+        """
+        the prefetched batch after last_sync, restart the pipeline if the prediction was wrong
+        """
+        if self.thread is None:
+            self.start(last_sync, batch_size)
+        while True:
+            try:
+                item = self.queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if self.thread is not None and not self.thread.is_alive() and self.queue.empty():
+                    self.close()
+                    self.start(last_sync, batch_size)
+                continue
+            if item[0] != last_sync or item[1] != batch_size:
+                LOGGER.info("%s prefetched batch after %s is stale, restart after %s",
+                            self.sync_task, item[0], last_sync)
+                self.close()
+                self.start(last_sync, batch_size)
+                continue
+            if isinstance(item[2], Exception):
+                self.close()
+                raise item[2]
+            return item[0], item[2]
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+build the dependency plan of all sync tasks in memory
+"""
+
+
+from typing import Dict, Iterable, List, Set
+
+from .exceptions import DependencyCycleException
+from .models import SyncTask
+
+
+class SyncPlan:
+    """
+    all the SyncTask and their dependencies, loaded with two queries
+    """
+
+    def __init__(self, tasks: Iterable[SyncTask], edges: Iterable[tuple]):
+        """
+        edges: (task_id, dependency_id)
+        """
+        self.tasks: Dict[int, SyncTask] = {sync_task.pk: sync_task for sync_task in tasks}
+        self.dependencies: Dict[SyncTask, Set[SyncTask]] = {
+                sync_task: set() for sync_task in self.tasks.values()
+        }
+        self.dependents: Dict[SyncTask, Set[SyncTask]] = {
+                sync_task: set() for sync_task in self.tasks.values()
+        }
+        for task_id, dependency_id in edges:
+            sync_task = self.tasks[task_id]
+            dependency = self.tasks[dependency_id]
+            self.dependencies[sync_task].add(dependency)
+            self.dependents[dependency].add(sync_task)
+        self.levels = self.get_levels()
+
+    @classmethod
+    def load(cls) -> "SyncPlan":
+        through = SyncTask.dependencies.through
+        return cls(
+                SyncTask.objects.select_related("source", "target"),
+                through.objects.values_list("from_synctask_id", "to_synctask_id"),
+        )
+
+    def get_levels(self) -> List[List[SyncTask]]:
+        """
+        topological levels, the tasks of a level only depend on the previous levels
+        """
+        levels = []
+        waiting = {
+                sync_task: len(dependencies)
+                for sync_task, dependencies in self.dependencies.items()
+        }
+        level = [sync_task for sync_task, count in waiting.items() if count == 0]
+        while level:
+            levels.append(sorted(level, key=lambda sync_task: sync_task.pk))
+            next_level = []
+            for sync_task in level:
+                del waiting[sync_task]
+                for dependent in self.dependents[sync_task]:
+                    waiting[dependent] -= 1
+                    if waiting[dependent] == 0:
+                        next_level.append(dependent)
+            level = next_level
+        if waiting:
+            raise DependencyCycleException(
+                    "dependencies cycle in tasks: "
+                    + ", ".join(f"{sync_task.pk}({sync_task})" for sync_task in waiting)
+            )
+        return levels
+
+    def roots(self) -> Set[SyncTask]:
+        return set(self.levels[0]) if self.levels else set()
+
+    def ready(self, sync_task: SyncTask, finished_tasks: Set[SyncTask]) -> Set[SyncTask]:
+        """
+        the dependents of sync_task whose dependencies all finished
+        """
+        return {
+                dependent for dependent in self.dependents[sync_task]
+                if not self.dependencies[dependent] - finished_tasks
+        }
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+time the phases of a batch and send them with the sync_phase signal
+"""
+
+
+import contextlib
+import threading
+import time
+
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from django.db import connections
+
+from .models import SyncShard, SyncTask
+from .signals import sync_phase
+
+
+class QueryCounter:
+    """
+    database execute wrapper counting the queries and their time per alias
+    """
+
+    def __init__(self):
+        self.queries: Dict[str, int] = defaultdict(int)
+        self.query_time: Dict[str, float] = defaultdict(float)
+
+    def wrapper(self, alias: str):
+        def execute(execute, sql, params, many, context):  # pylint: disable=too-many-arguments
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                self.queries[alias] += 1
+                self.query_time[alias] += time.perf_counter() - start
+        return execute
+
+
+@contextlib.contextmanager
+def phase(name: str, sync_task: SyncTask, shard: Optional[SyncShard] = None) -> Iterator[None]:
+    """
+    with phase("query", sync_task):
+        ...
+    does nothing if no receiver is connected to sync_phase
+    """
+    if not sync_phase.has_listeners(SyncTask):
+        yield
+        return
+    counter = QueryCounter()
+    with contextlib.ExitStack() as stack:
+        for alias in {sync_task._state.db or "default", sync_task.source_db, sync_task.target_db}:
+            stack.enter_context(connections[alias].execute_wrapper(counter.wrapper(alias)))
+        start = time.perf_counter()
+        yield
+        duration = time.perf_counter() - start
+    sync_phase.send(
+            sender=SyncTask,
+            sync_task=sync_task,
+            shard=shard,
+            phase=name,
+            duration=duration,
+            queries=dict(counter.queries),
+            query_time=dict(counter.query_time),
+    )
+
+
+class PhaseReport:
+    """
+    sum the sync_phase signals per task and phase
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.batches: Dict[Tuple[SyncTask, str], int] = defaultdict(int)
+        self.durations: Dict[Tuple[SyncTask, str], float] = defaultdict(float)
+        self.queries: Dict[Tuple[SyncTask, str], int] = defaultdict(int)
+
+    def receiver(self, sender, sync_task: SyncTask, phase: str,  # pylint: disable=unused-argument,redefined-outer-name
+                 duration: float, queries: Dict[str, int], **kwargs) -> None:
+        key = (sync_task, phase)
+        with self.lock:
+            self.batches[key] += 1
+            self.durations[key] += duration
+            self.queries[key] += sum(queries.values())
+
+    def lines(self) -> List[str]:
+        lines = ["task\tphase\tcalls\tseconds\tqueries"]
+        for (sync_task, name), duration in sorted(
+                self.durations.items(), key=lambda item: (item[0][0].pk, -item[1])):
+            key = (sync_task, name)
+            lines.append(f"{sync_task.pk}\t{name}\t{self.batches[key]}\t{duration:.6f}\t{self.queries[key]}")
+        return lines
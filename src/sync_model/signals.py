@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+signals sent while syncing
+"""
+
+
+from django.dispatch import Signal
+
+
+# sent after each phase of a batch, only timed when there is a receiver
+# sender: SyncTask
+# kwargs:
+#   sync_task, shard
+#   phase: resolve, query, fetch, sync, checkpoint, ledger
+#   duration: seconds
+#   queries: {db alias: number of queries}
+#   query_time: {db alias: seconds spent in these queries}
+sync_phase = Signal()
@@ -1,17 +1,53 @@
 import datetime
+import json
+import os
+import tempfile
+import unittest
+from io import StringIO
+from unittest import mock
 
+from django.conf import settings
+from django.contrib import admin
 from django.contrib.contenttypes.models import ContentType
-from django.core.management import call_command
-from django.test import TestCase
+from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models import QuerySet
+from django.test import TestCase, TransactionTestCase
 from django.utils import timezone
 
-from sync_model.exceptions import StepTooSmallException
+from sync_model.admin import SyncTaskAdmin
+from sync_model.exceptions import DependencyCycleException, StepTooSmallException
+from sync_model.explain import explain, get_index_migration
+from sync_model.fanout import sync_shared_batch
+from sync_model.fingerprint import filter_changed, save_fingerprints
+from sync_model.ledger import get_lags, get_task_metrics, rollup_runs
+from sync_model.lease import acquire_lease
+from sync_model.management.commands.sync_model import (
+        Command, close_broken_connections, critical_path, order_units,
+)
 from sync_model.models import (
         RawStockAction, StockAction,
-        SyncTask, Broker,
+        SyncChangeLog, SyncCheckpoint, SyncFingerprint, SyncRun, SyncTask, SyncShard, Broker,
+)
+from sync_model.pipeline import Prefetcher
+from sync_model.plan import SyncPlan
+from sync_model.signals import sync_phase
+from sync_model.throttle import TokenBucket, get_limiter
+from sync_model.transport import load_manifest, read_records
+from sync_model.utils import (
+        ForeignKeyResolver, bulk_sync, estimate_backlog, get_adapted_batch_size, get_queryset, get_sync_function,
+        get_value, sync_raw_stock_action,
 )
-from sync_model.utils import get_value
+from sync_model.verify import verify
+
 
+def broken_sync(queryset, target_model, sync_task):
+    """
+    write the batch then fail, to check the writes are rolled back
+    """
+    sync_raw_stock_action(queryset, target_model, sync_task)
+    raise RuntimeError("broken")
 
 
 class Test(TestCase):
@@ -143,3 +179,1330 @@ class Test(TestCase):
                 value2["update_datetime"],
                 first_stock.update_datetime.isoformat(),
         )
+
+    def test_bulk_sync(self):
+        now = timezone.make_aware(
+                datetime.datetime(2024, 1, 1, 2, 3, 4)
+        )
+        for index, sender in enumerate(["alice", "bob", "charlie"]):
+            RawStockAction.objects.create(
+                    sender=sender,
+                    action_type="buy",
+                    update_datetime=now + datetime.timedelta(seconds=index),
+                    canceled=False,
+                    stock_number="LUCK",
+            )
+        sync_task = SyncTask.objects.create(
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.utils.bulk_sync",
+                batch_size=2,
+                order_by=["update_datetime", "pk"],
+                field_map={
+                    "id": "id",
+                    "update_datetime": "update_datetime",
+                    "sender": "sender",
+                    "stock_number": "stock_number",
+                },
+        )
+        call_command("sync_model")
+        self.assertEqual(StockAction.objects.count(), 2)
+        RawStockAction.objects.filter(sender="bob").update(stock_number="LUCK_NEW")
+        sync_task.last_sync = {}
+        sync_task.save()
+        call_command("sync_model")
+        call_command("sync_model")
+        self.assertEqual(StockAction.objects.count(), 3)
+        self.assertEqual(
+                StockAction.objects.get(sender="bob").stock_number,
+                "LUCK_NEW",
+        )
+        # a backend without upsert: the existing pks are updated, the others inserted
+        StockAction.objects.filter(sender="charlie").delete()
+        RawStockAction.objects.filter(sender="alice").update(stock_number="LUCK_OLD")
+        sync_task.last_sync = {}
+        sync_task.save()
+        with mock.patch.object(connection.features, "supports_update_conflicts", False), \
+                mock.patch.object(connection.features, "supports_update_conflicts_with_target", False), \
+                mock.patch.object(QuerySet, "bulk_update", autospec=True, side_effect=QuerySet.bulk_update) as update:
+            call_command("sync_model", drain=True)
+        update.assert_called()
+        self.assertEqual(
+                dict(StockAction.objects.values_list("sender", "stock_number")),
+                {"alice": "LUCK_OLD", "bob": "LUCK_NEW", "charlie": "LUCK"},
+        )
+
+    def test_fingerprint(self):
+        now = timezone.now()
+        for index in range(5):
+            RawStockAction.objects.create(
+                    sender=f"sender{index}",
+                    action_type="buy",
+                    update_datetime=now + datetime.timedelta(seconds=index),
+                    canceled=False,
+                    stock_number="LUCK",
+            )
+        sync_task = SyncTask.objects.create(
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.utils.bulk_sync",
+                batch_size=10,
+                order_by=["update_datetime", "pk"],
+                field_map={"id": "id", "update_datetime": "update_datetime", "sender": "sender"},
+                fingerprint=True,
+        )
+        result = Command.run_sync_task(sync_task)
+        self.assertEqual(result["skipped"], 0)
+        self.assertEqual(SyncFingerprint.objects.filter(task=sync_task.pk).count(), 5)
+        # the same rows synced again are not written
+        sync_task.last_sync = {}
+        with self.assertNumQueries(4):
+            result = Command.run_sync_task(sync_task)
+        self.assertEqual((result["count"], result["skipped"]), (5, 5))
+        first = RawStockAction.objects.order_by("pk").first()
+        RawStockAction.objects.filter(pk=first.pk).update(sender="alice")
+        StockAction.objects.filter(pk=first.pk + 1).update(sender="mallory")
+        sync_task.last_sync = {}
+        result = Command.run_sync_task(sync_task)
+        self.assertEqual(result["skipped"], 4)
+        self.assertEqual(StockAction.objects.get(pk=first.pk).sender, "alice")
+        # a target row changed by someone else is only fixed by verify --repair
+        self.assertEqual(StockAction.objects.get(pk=first.pk + 1).sender, "mallory")
+        call_command("sync_model", verify=True, repair=True, stdout=StringIO())
+        self.assertEqual(StockAction.objects.get(pk=first.pk + 1).sender, "sender1")
+        # a foreign key is digested by its id
+        sync_task.field_map = {"id": "id", "broker": "broker", "sender": "sender"}
+        first.broker = Broker.objects.create(name="alice")
+        changed, digests = filter_changed([first], sync_task)
+        self.assertEqual(changed, [first])
+        save_fingerprints(sync_task, digests)
+        first.broker = Broker.objects.get(name="alice")
+        self.assertEqual(filter_changed([first], sync_task), ([], {}))
+        first.broker = Broker.objects.create(name="bob")
+        self.assertEqual(filter_changed([first], sync_task)[0], [first])
+
+    def test_transport(self):
+        now = timezone.now()
+
+        def create(index):
+            RawStockAction.objects.create(
+                    sender=f"sender{index}",
+                    action_type="buy",
+                    update_datetime=now + datetime.timedelta(seconds=index),
+                    canceled=False,
+                    stock_number="LUCK",
+            )
+
+        for index in range(5):
+            create(index)
+        sync_task = SyncTask.objects.create(
+                name="transport",
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.utils.sync_in_database",
+                batch_size=2,
+                order_by=["update_datetime", "pk"],
+                field_map={"id": "id", "update_datetime": "update_datetime", "sender": "sender"},
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            out = StringIO()
+            call_command("sync_model", name="transport", export_dir=directory, stdout=out)
+            # every row is exported once, the last row of a chunk does not start the next chunk
+            self.assertIn("export 3 chunks, 5 rows", out.getvalue())
+            manifest = load_manifest(directory)
+            self.assertEqual(manifest["start"], {})
+            self.assertEqual([chunk["rows"] for chunk in manifest["chunks"]], [2, 2, 1])
+            self.assertEqual(
+                    [json.loads(record)["fields"]["sender"] for record in read_records(
+                        os.path.join(directory, manifest["chunks"][1]["file"]))],
+                    ["sender2", "sender3"],
+            )
+            # the export does not move the cursor
+            sync_task.refresh_from_db()
+            self.assertEqual(sync_task.last_sync, {})
+            self.assertFalse(StockAction.objects.exists())
+            # an interrupted import resumes at the next chunk
+            call_command("sync_model", name="transport", import_dir=directory, max_batches=2, stdout=StringIO())
+            sync_task.refresh_from_db()
+            self.assertEqual(sync_task.last_sync, manifest["chunks"][1]["last"])
+            self.assertEqual(StockAction.objects.count(), 4)
+            out = StringIO()
+            call_command("sync_model", name="transport", import_dir=directory, stdout=out)
+            self.assertIn("import 1 chunks, 1 rows", out.getvalue())
+            self.assertEqual(
+                    list(StockAction.objects.order_by("pk").values_list("sender", flat=True)),
+                    [f"sender{index}" for index in range(5)],
+            )
+            # a new export appends the new rows
+            create(5)
+            out = StringIO()
+            call_command("sync_model", name="transport", export_dir=directory, stdout=out)
+            self.assertIn("export 1 chunks, 1 rows", out.getvalue())
+            call_command("sync_model", name="transport", import_dir=directory, stdout=StringIO())
+            self.assertEqual(StockAction.objects.count(), 6)
+            sync_task.refresh_from_db()
+            self.assertEqual(sync_task.last_sync, load_manifest(directory)["chunks"][-1]["last"])
+            self.assertEqual(
+                    SyncRun.objects.filter(sync_task=sync_task).last().outcome,
+                    "finished",
+            )
+
+    def test_keyset_filter(self):
+        now = timezone.make_aware(
+                datetime.datetime(2024, 1, 1, 2, 3, 4)
+        )
+        sync_task = SyncTask(
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                order_by=["update_datetime", "pk"],
+                last_sync={"update_datetime": "2024-01-01T02:03:04+00:00", "pk": 3},
+        )
+        sql = str(get_queryset(sync_task).query)
+        self.assertIn(
+                '("sync_model_rawstockaction"."update_datetime", "sync_model_rawstockaction"."id") >= ',
+                sql,
+        )
+        with mock.patch("sync_model.utils.supports_row_values", return_value=False):
+            sql = str(get_queryset(sync_task).query)
+        self.assertNotIn(") >= (", sql)
+        self.assertIn(" OR ", sql)
+        sync_task.order_by = ["update_datetime", "-sender"]
+        sync_task.last_sync = {"update_datetime": now.isoformat(), "-sender": "bob"}
+        sql = str(get_queryset(sync_task).query)
+        self.assertIn('"sync_model_rawstockaction"."update_datetime" >= ', sql)
+        self.assertIn(" OR ", sql)
+        for sender in ["alice", "bob", "charlie"]:
+            RawStockAction.objects.create(
+                    sender=sender,
+                    action_type="buy",
+                    update_datetime=now,
+                    canceled=False,
+                    stock_number="LUCK",
+            )
+        self.assertEqual(
+                [stock.sender for stock in get_queryset(sync_task)],
+                ["bob", "alice"],
+        )
+        sync_task.order_by = ["update_datetime", "sender"]
+        sync_task.last_sync = {"update_datetime": now.isoformat(), "sender": "bob"}
+        self.assertEqual(
+                [stock.sender for stock in get_queryset(sync_task)],
+                ["bob", "charlie"],
+        )
+
+    def test_drain(self):
+        now = timezone.make_aware(
+                datetime.datetime(2024, 1, 1, 2, 3, 4)
+        )
+        for index in range(5):
+            RawStockAction.objects.create(
+                    sender="alice",
+                    action_type="buy",
+                    update_datetime=now + datetime.timedelta(seconds=index),
+                    canceled=False,
+                    stock_number="LUCK",
+            )
+        SyncTask.objects.create(
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.utils.sync_raw_stock_action",
+                batch_size=2,
+                order_by=["update_datetime"],
+        )
+        call_command("sync_model", drain=True, max_batches=2)
+        self.assertEqual(StockAction.objects.count(), 3)
+        call_command("sync_model", drain=True, timeout=0)
+        self.assertEqual(StockAction.objects.count(), 3)
+        call_command("sync_model", "--drain")
+        self.assertEqual(StockAction.objects.count(), 5)
+
+    def test_plan(self):
+        tasks = [
+                SyncTask.objects.create(
+                    name=f"task{index}",
+                    source=ContentType.objects.get_for_model(RawStockAction),
+                    target=ContentType.objects.get_for_model(StockAction),
+                    sync_method="sync_model.utils.sync_raw_stock_action",
+                )
+                for index in range(4)
+        ]
+        tasks[1].dependencies.set([tasks[0]])
+        tasks[2].dependencies.set([tasks[0], tasks[1]])
+        with self.assertNumQueries(2):
+            plan = SyncPlan.load()
+        self.assertEqual(
+                plan.levels,
+                [[tasks[0], tasks[3]], [tasks[1]], [tasks[2]]],
+        )
+        self.assertEqual(plan.ready(tasks[0], {tasks[0]}), {tasks[1]})
+        self.assertEqual(plan.ready(tasks[1], {tasks[0], tasks[1]}), {tasks[2]})
+        out = StringIO()
+        call_command("sync_model", plan=True, stdout=out)
+        self.assertIn("level 2:", out.getvalue())
+        out = StringIO()
+        call_command("sync_model", name="task1", plan=True, stdout=out)
+        self.assertEqual(out.getvalue().splitlines()[0], "level 1:")
+        self.assertNotIn("task0", out.getvalue())
+        self.assertFalse(StockAction.objects.exists())
+        tasks[0].dependencies.set([tasks[2]])
+        with self.assertRaises(DependencyCycleException):
+            call_command("sync_model")
+
+    def test_lease(self):
+        RawStockAction.objects.create(
+                sender="alice",
+                action_type="buy",
+                update_datetime=timezone.now(),
+                canceled=False,
+                stock_number="LUCK",
+        )
+        sync_task = SyncTask.objects.create(
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.utils.sync_raw_stock_action",
+                order_by=["update_datetime"],
+        )
+        self.assertTrue(acquire_lease(sync_task, "other:1", 60))
+        self.assertFalse(acquire_lease(sync_task, "other:2", 60))
+        call_command("sync_model", lease=60)
+        self.assertFalse(StockAction.objects.exists())
+        SyncTask.objects.filter(pk=sync_task.pk).update(
+                lease_expires=timezone.now() - datetime.timedelta(seconds=1),
+        )
+        call_command("sync_model", lease=60)
+        self.assertEqual(StockAction.objects.count(), 1)
+        sync_task.refresh_from_db()
+        self.assertEqual(sync_task.lease_owner, "")
+        self.assertIsNone(sync_task.lease_expires)
+
+    def test_lease_takeover(self):
+        now = timezone.now()
+        for index in range(4):
+            RawStockAction.objects.create(
+                    sender=f"sender{index}",
+                    action_type="buy",
+                    update_datetime=now + datetime.timedelta(seconds=index),
+                    canceled=False,
+                    stock_number="LUCK",
+            )
+        sync_task = SyncTask.objects.create(
+                name="lease",
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.utils.bulk_sync",
+                batch_size=2,
+                order_by=["update_datetime", "pk"],
+                field_map={"id": "id", "update_datetime": "update_datetime", "sender": "sender"},
+        )
+        bulk_sync = get_sync_function("sync_model.utils.bulk_sync")
+        batches = []
+
+        def slow_sync(queryset, target_model, task):
+            # the lease expires during the second batch and another worker takes the task
+            batches.append(task.last_sync)
+            if len(batches) == 2:
+                SyncTask.objects.filter(pk=task.pk).update(
+                        lease_expires=timezone.now() - datetime.timedelta(seconds=1),
+                )
+                self.assertTrue(acquire_lease(SyncTask.objects.get(pk=task.pk), "other:1", 60))
+            return bulk_sync(queryset, target_model, task)
+
+        with mock.patch("sync_model.management.commands.sync_model.get_sync_function", return_value=slow_sync):
+            call_command("sync_model", drain=True, lease=60)
+        self.assertEqual(len(batches), 2)
+        sync_task.refresh_from_db()
+        # the second batch was written but its cursor was rejected, the batch will be synced again
+        self.assertEqual(sync_task.last_sync, batches[1])
+        self.assertEqual(sync_task.lease_owner, "other:1")
+        # the first worker can not take the task back while the lease is valid
+        call_command("sync_model", drain=True, lease=60)
+        sync_task.refresh_from_db()
+        self.assertEqual(sync_task.last_sync, batches[1])
+        with mock.patch("sync_model.management.commands.sync_model.default_owner", return_value="other:1"):
+            call_command("sync_model", drain=True, lease=60)
+        sync_task.refresh_from_db()
+        self.assertEqual(sync_task.lease_owner, "")
+        self.assertEqual(StockAction.objects.count(), 4)
+        self.assertEqual(
+                sync_task.last_sync,
+                get_value(RawStockAction.objects.order_by("-update_datetime").first(), sync_task.order_by, True),
+        )
+
+    def test_follow(self):
+        now = timezone.make_aware(
+                datetime.datetime(2024, 1, 1, 2, 3, 4)
+        )
+        for index in range(5):
+            RawStockAction.objects.create(
+                    sender="alice",
+                    action_type="buy",
+                    update_datetime=now + datetime.timedelta(seconds=index),
+                    canceled=False,
+                    stock_number="LUCK",
+            )
+        sync_task = SyncTask.objects.create(
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.utils.sync_raw_stock_action",
+                batch_size=2,
+                order_by=["update_datetime"],
+        )
+        dependent = SyncTask.objects.create(
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.utils.sync_raw_stock_action",
+                order_by=["update_datetime"],
+        )
+        dependent.dependencies.set([sync_task])
+        call_command("sync_model", follow=True, timeout=0.3, poll_interval=0.05)
+        self.assertEqual(StockAction.objects.count(), 5)
+        dependent.refresh_from_db()
+        self.assertEqual(
+                datetime.datetime.fromisoformat(dependent.last_sync["update_datetime"]),
+                now + datetime.timedelta(seconds=4),
+        )
+
+    def test_adaptive_batch_size(self):
+        now = timezone.make_aware(
+                datetime.datetime(2024, 1, 1, 2, 3, 4)
+        )
+        for sender in ["alice", "bob", "charlie", "david"]:
+            RawStockAction.objects.create(
+                    sender=sender,
+                    action_type="buy",
+                    update_datetime=now,
+                    canceled=False,
+                    stock_number="LUCK",
+            )
+        sync_task = SyncTask.objects.create(
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.utils.sync_raw_stock_action",
+                batch_size=2,
+                order_by=["update_datetime"],
+                adaptive_batch_size=True,
+                target_batch_duration=3600,
+                max_batch_size=16,
+        )
+        call_command("sync_model")
+        sync_task.refresh_from_db()
+        self.assertEqual(StockAction.objects.count(), 2)
+        self.assertEqual(sync_task.batch_size, 4)
+        call_command("sync_model")
+        sync_task.refresh_from_db()
+        self.assertEqual(StockAction.objects.count(), 4)
+        self.assertEqual(sync_task.batch_size, 8)
+        self.assertEqual(
+                get_adapted_batch_size(sync_task, {
+                    "finished": False,
+                    "count": 8,
+                    "start": now,
+                    "end": now + datetime.timedelta(hours=4),
+                    "last_sync_model": None,
+                }),
+                4,
+        )
+        self.assertEqual(
+                get_adapted_batch_size(sync_task, {
+                    "finished": False,
+                    "count": 8,
+                    "start": now,
+                    "end": now,
+                    "last_sync_model": None,
+                }),
+                16,
+        )
+        # the batches retried with a larger batch_size are not errors
+        self.assertFalse(SyncRun.objects.filter(sync_task=sync_task, outcome="error").exists())
+        sync_task.max_batch_size = 8
+        sync_task.save()
+        RawStockAction.objects.update(update_datetime=now + datetime.timedelta(seconds=1))
+        for sender in ["eve", "frank", "grace", "heidi", "ivan"]:
+            RawStockAction.objects.create(
+                    sender=sender,
+                    action_type="buy",
+                    update_datetime=now + datetime.timedelta(seconds=1),
+                    canceled=False,
+                    stock_number="LUCK",
+            )
+        call_command("sync_model")
+        with self.assertRaises(StepTooSmallException):
+            call_command("sync_model")
+        self.assertEqual(
+                list(SyncRun.objects.filter(sync_task=sync_task).order_by("pk").values_list("outcome", flat=True)),
+                ["partial", "finished", "partial", "error"],
+        )
+
+    def test_source_fields(self):
+        now = timezone.make_aware(
+                datetime.datetime(2024, 1, 1, 2, 3, 4)
+        )
+        for index in range(3):
+            RawStockAction.objects.create(
+                    sender="alice",
+                    action_type="buy",
+                    update_datetime=now + datetime.timedelta(seconds=index),
+                    canceled=False,
+                    stock_number="LUCK",
+            )
+        sync_task = SyncTask.objects.create(
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.utils.bulk_sync",
+                batch_size=10,
+                order_by=["update_datetime", "pk"],
+                field_map={"id": "id", "sender": "sender"},
+                source_fields=["sender"],
+                chunk_size=2,
+        )
+        sql = str(get_queryset(sync_task).query)
+        self.assertIn('"sync_model_rawstockaction"."sender"', sql)
+        self.assertNotIn('"sync_model_rawstockaction"."action_type"', sql)
+        # plan, dependencies, batch, upsert, checkpoint, ledger
+        with self.assertNumQueries(6):
+            call_command("sync_model")
+        self.assertEqual(StockAction.objects.count(), 3)
+
+    def test_atomic(self):
+        now = timezone.make_aware(
+                datetime.datetime(2024, 1, 1, 2, 3, 4)
+        )
+        for sender in ["alice", "bob", "charlie"]:
+            RawStockAction.objects.create(
+                    sender=sender,
+                    action_type="buy",
+                    update_datetime=now,
+                    canceled=False,
+                    stock_number="LUCK",
+            )
+        sync_task = SyncTask.objects.create(
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.tests.broken_sync",
+                batch_size=2,
+                order_by=["update_datetime", "sender"],
+                atomic=True,
+        )
+        with self.assertRaises(RuntimeError):
+            call_command("sync_model")
+        self.assertFalse(StockAction.objects.exists())
+        sync_task.sync_method = "sync_model.utils.sync_raw_stock_action"
+        sync_task.save()
+        call_command("sync_model")
+        self.assertEqual(StockAction.objects.count(), 2)
+        sync_task.refresh_from_db()
+        self.assertEqual(sync_task.last_sync["sender"], "bob")
+
+    def test_shards_changed(self):
+        for index in range(4):
+            RawStockAction.objects.create(
+                    sender="alice",
+                    action_type="buy",
+                    update_datetime=timezone.now(),
+                    canceled=False,
+                    stock_number="LUCK",
+            )
+        sync_task = SyncTask.objects.create(
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.utils.sync_raw_stock_action",
+                order_by=["pk"],
+                shards=3,
+        )
+        call_command("sync_model")
+        self.assertEqual(StockAction.objects.count(), 4)
+        # the rows of the new shards are behind the cursors of the old shards
+        sync_task.shards = 2
+        with self.assertRaises(ValidationError):
+            sync_task.clean()
+        sync_task.save()
+        with self.assertRaises(ValueError):
+            call_command("sync_model")
+        SyncShard.objects.filter(sync_task=sync_task).delete()
+        sync_task.clean()
+        StockAction.objects.all().delete()
+        call_command("sync_model")
+        self.assertEqual(StockAction.objects.count(), 4)
+
+    def test_ledger(self):
+        now = timezone.make_aware(
+                datetime.datetime(2024, 1, 1, 2, 3, 4)
+        )
+        for index in range(3):
+            RawStockAction.objects.create(
+                    sender="alice",
+                    action_type="buy",
+                    update_datetime=now + datetime.timedelta(seconds=index),
+                    canceled=False,
+                    stock_number="LUCK",
+            )
+        sync_task = SyncTask.objects.create(
+                name="stock",
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.utils.sync_raw_stock_action",
+                batch_size=2,
+                order_by=["update_datetime"],
+        )
+        call_command("sync_model", "--drain")
+        self.assertEqual(
+                list(SyncRun.objects.order_by("id").values_list("outcome", "count")),
+                [("partial", 2), ("partial", 2), ("finished", 1)],
+        )
+        runs = list(SyncRun.objects.order_by("id"))
+        self.assertEqual(runs[0].cursor_before, {})
+        self.assertEqual(runs[0].cursor_after, runs[1].cursor_before)
+        metrics = get_task_metrics(timezone.now() - datetime.timedelta(days=1)).get(pk=sync_task.pk)
+        self.assertEqual(metrics.rows, 5)
+        self.assertEqual(metrics.batches, 3)
+        self.assertIsNotNone(metrics.last_caught_up)
+        out = StringIO()
+        call_command("sync_model_metrics", stdout=out)
+        self.assertIn(f'sync_model_rows{{task="stock",id="{sync_task.pk}"}} 5', out.getvalue())
+        self.assertIn("# TYPE sync_model_seconds_since_caught_up gauge", out.getvalue())
+        self.assertEqual(rollup_runs(timezone.now() + datetime.timedelta(seconds=1)), 2)
+        rollup = SyncRun.objects.get()
+        self.assertEqual((rollup.outcome, rollup.count, rollup.batches), ("rollup", 5, 3))
+        # the task caught up in the rolled up runs
+        self.assertEqual(rollup.caught_up, runs[2].end)
+        self.assertEqual(
+                get_task_metrics(timezone.now() - datetime.timedelta(days=1)).get(pk=sync_task.pk).last_caught_up,
+                runs[2].end,
+        )
+        self.assertIsNotNone(get_lags([sync_task])[sync_task.pk])
+        call_command("sync_model_metrics", retention_days=-1, stdout=StringIO())
+        self.assertFalse(SyncRun.objects.exists())
+
+    def test_profile(self):
+        RawStockAction.objects.create(
+                sender="alice",
+                action_type="buy",
+                update_datetime=timezone.now(),
+                canceled=False,
+                stock_number="LUCK",
+        )
+        sync_task = SyncTask.objects.create(
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.utils.sync_raw_stock_action",
+                order_by=["update_datetime"],
+        )
+        out = StringIO()
+        with tempfile.TemporaryDirectory() as profile_dir:
+            call_command("sync_model", profile=True, profile_dir=profile_dir, stdout=out)
+            self.assertTrue(os.path.exists(os.path.join(profile_dir, f"{sync_task.pk}.prof")))
+        phases = {
+                line.split("\t")[1]: int(line.split("\t")[4])
+                for line in out.getvalue().splitlines()[1:]
+        }
+        self.assertEqual(
+                set(phases),
+                {"throttle", "resolve", "query", "fetch", "sync", "checkpoint", "ledger"},
+        )
+        self.assertEqual(phases["fetch"], 1)
+        self.assertEqual(phases["checkpoint"], 1)
+        self.assertFalse(sync_phase.has_listeners(SyncTask))
+
+    def test_bench(self):
+        out = StringIO()
+        call_command(
+                "sync_model_bench", rows=50, ties=3, batch_sizes=["20"],
+                order_by=[["update_datetime", "pk"]], stdout=out,
+        )
+        result = json.loads(out.getvalue())
+        self.assertEqual(len(result["runs"]), 2)
+        for run in result["runs"]:
+            self.assertIsNone(run["error"])
+            self.assertGreaterEqual(run["rows"], 50)
+            self.assertGreater(run["queries"], 0)
+        self.assertFalse(RawStockAction.objects.exists())
+        self.assertFalse(SyncTask.objects.exists())
+
+    def test_backlog(self):
+        now = timezone.now()
+        for index in range(5):
+            RawStockAction.objects.create(
+                    sender="alice",
+                    action_type="buy",
+                    update_datetime=now - datetime.timedelta(hours=index),
+                    canceled=False,
+                    stock_number="LUCK",
+            )
+        sync_task = SyncTask.objects.create(
+                name="stock",
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.utils.sync_raw_stock_action",
+                batch_size=3,
+                order_by=["update_datetime", "pk"],
+        )
+        self.assertEqual(
+                estimate_backlog(sync_task),
+                {"rows": 5, "method": "count", "time_lag": None},
+        )
+        self.assertEqual(estimate_backlog(sync_task, limit=2)["method"], "at_least")
+        call_command("sync_model")
+        sync_task.refresh_from_db()
+        estimate = estimate_backlog(sync_task)
+        self.assertEqual(estimate["rows"], 3)
+        self.assertAlmostEqual(estimate["time_lag"], 2 * 3600, delta=60)
+        out = StringIO()
+        call_command("sync_model", status=True, stdout=out)
+        self.assertIn(f"{sync_task.pk}\tstock\t3\t", out.getvalue())
+        # postgresql: django returns the json plan of EXPLAIN (FORMAT JSON) without the outer list
+        with mock.patch("sync_model.utils.connections") as connections, \
+                mock.patch.object(QuerySet, "explain", return_value='{"Plan": {"Plan Rows": 42}}'):
+            connections.__getitem__.return_value.vendor = "postgresql"
+            estimate = estimate_backlog(sync_task)
+        self.assertEqual((estimate["rows"], estimate["method"]), (42, "planner"))
+        # the admin change page does not create the shards
+        sync_task.shards = 2
+        self.assertIn("rows", SyncTaskAdmin(SyncTask, admin.site).backlog(sync_task))
+        self.assertFalse(SyncShard.objects.filter(sync_task=sync_task).exists())
+        # --status is read only, with --name too: no sync and no shards
+        SyncTask.objects.filter(pk=sync_task.pk).update(shards=2, last_sync={})
+        rows = StockAction.objects.count()
+        out = StringIO()
+        call_command("sync_model", name="stock", status=True, stdout=out)
+        self.assertIn(f"{sync_task.pk}\tstock\t5\t", out.getvalue())
+        self.assertEqual(StockAction.objects.count(), rows)
+        self.assertFalse(SyncShard.objects.filter(sync_task=sync_task).exists())
+
+    def test_foreign_key_resolver(self):
+        Broker.objects.create(name="alice")
+        resolver = ForeignKeyResolver(Broker, "name", create=True, cache_size=2)
+        with self.assertNumQueries(3):
+            broker_ids = resolver.resolve(["alice", "bob", "alice", "charlie"])
+        self.assertEqual(
+                broker_ids,
+                dict(Broker.objects.filter(name__in=["alice", "bob", "charlie"]).values_list("name", "pk")),
+        )
+        self.assertEqual(Broker.objects.count(), 3)
+        # the cache keeps the last 2 keys
+        with self.assertNumQueries(0):
+            resolver.resolve(["bob", "charlie"])
+        with self.assertNumQueries(1):
+            resolver.resolve(["alice"])
+        # the duplicate keys are fetched once, in their order
+        with mock.patch.object(resolver, "fetch", wraps=resolver.fetch) as fetch:
+            resolver.resolve(["dave", "erin"] * 5000)
+        self.assertEqual(fetch.call_args_list[0].args[0], ["dave", "erin"])
+        resolver.invalidate(["alice"])
+        Broker.objects.filter(name="alice").delete()
+        self.assertEqual(ForeignKeyResolver(Broker, "name").resolve(["alice", "bob"]), {"bob": broker_ids["bob"]})
+
+    def test_explain(self):
+        RawStockAction.objects.create(
+                sender="alice",
+                action_type="buy",
+                update_datetime=timezone.now(),
+                canceled=False,
+                stock_number="LUCK",
+        )
+        sync_task = SyncTask.objects.create(
+                name="explain",
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.utils.sync_raw_stock_action",
+                order_by=["update_datetime", "pk"],
+                filter_by={"canceled": False},
+        )
+        call_command("sync_model")
+        sync_task.refresh_from_db()
+        report = explain(sync_task)
+        self.assertEqual(report["index"], ["canceled", "update_datetime", "id"])
+        if connection.vendor == "sqlite":
+            self.assertTrue(any(warning.startswith("full scan") for warning in report["warnings"]))
+        path, content = get_index_migration(sync_task, report["index"])
+        self.assertTrue(path.endswith(".py"))
+        self.assertIn("migrations.SeparateDatabaseAndState(", content)
+        self.assertIn("'canceled', 'update_datetime', 'id'", content)
+        out = StringIO()
+        call_command("sync_model", explain=True, name="explain", stdout=out)
+        self.assertIn("suggest: models.Index(fields=['canceled', 'update_datetime', 'id'])", out.getvalue())
+        # the primary key serves the default order_by
+        sync_task.order_by = ["pk"]
+        sync_task.filter_by = {}
+        sync_task.last_sync = {"pk": 1}
+        self.assertIsNone(explain(sync_task)["index"])
+
+    def test_shared_scan(self):
+        now = timezone.now()
+
+        def create_stocks(senders, start):
+            for index, sender in enumerate(senders):
+                RawStockAction.objects.create(
+                        sender=sender,
+                        action_type="buy",
+                        update_datetime=now + datetime.timedelta(seconds=start + index),
+                        canceled=False,
+                        stock_number="LUCK",
+                )
+
+        def create_task(sender):
+            return SyncTask.objects.create(
+                    name=sender,
+                    source=ContentType.objects.get_for_model(RawStockAction),
+                    target=ContentType.objects.get_for_model(StockAction),
+                    sync_method="sync_model.utils.bulk_sync",
+                    batch_size=4,
+                    order_by=["update_datetime", "pk"],
+                    filter_by={"sender": sender},
+                    field_map={"id": "id", "sender": "sender", "update_datetime": "update_datetime"},
+            )
+
+        create_stocks(["alice", "bob", "charlie"] * 2, 0)
+        alice, bob = create_task("alice"), create_task("bob")
+        with mock.patch(
+                "sync_model.management.commands.sync_model.sync_shared_batch",
+                wraps=sync_shared_batch) as shared_batch:
+            call_command("sync_model", shared_scan=True, drain=True)
+        # the last row is re-read by the second batch
+        self.assertEqual(shared_batch.call_count, 2)
+        self.assertEqual(StockAction.objects.count(), 4)
+        alice.refresh_from_db()
+        bob.refresh_from_db()
+        last_row = RawStockAction.objects.filter(sender__in=["alice", "bob"]).order_by("update_datetime", "pk").last()
+        self.assertEqual(alice.last_sync, get_value(last_row, alice.order_by, datetime2str=True))
+        self.assertEqual(bob.last_sync, alice.last_sync)
+        create_stocks(["alice", "bob"], 10)
+        # charlie has rows before the shared cursor and catches up alone, dave joins the scan
+        charlie, dave = create_task("charlie"), create_task("dave")
+        with mock.patch(
+                "sync_model.management.commands.sync_model.sync_shared_batch",
+                wraps=sync_shared_batch) as shared_batch:
+            call_command("sync_model", shared_scan=True, drain=True)
+        self.assertEqual(
+                {sync_task.name for sync_task in shared_batch.call_args.args[0]},
+                {"alice", "bob", "dave"},
+        )
+        self.assertEqual(StockAction.objects.count(), 8)
+        for sync_task in [alice, bob, charlie, dave]:
+            sync_task.refresh_from_db()
+        self.assertEqual(dave.last_sync, alice.last_sync)
+        self.assertNotEqual(charlie.last_sync, alice.last_sync)
+        self.assertEqual(SyncRun.objects.filter(sync_task=dave).count(), 1)
+
+    def test_sync_in_database(self):
+        now = timezone.now()
+        stocks = [
+                RawStockAction.objects.create(
+                    sender=f"sender{index}",
+                    action_type="buy",
+                    update_datetime=now + datetime.timedelta(seconds=index),
+                    canceled=index == 3,
+                    stock_number="LUCK",
+                )
+                for index in range(7)
+        ]
+        sync_task = SyncTask.objects.create(
+                name="in database",
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.utils.sync_in_database",
+                batch_size=3,
+                order_by=["update_datetime", "pk"],
+                filter_by={"canceled": False},
+                field_map={
+                    "id": "id", "sender": "sender",
+                    "update_datetime": "update_datetime", "stock_number": "stock_number",
+                },
+        )
+        # boundary row, count, INSERT ... SELECT, cursor and ledger
+        with self.assertNumQueries(5):
+            result = Command.run_sync_task(sync_task)
+        self.assertEqual(result["count"], 3)
+        self.assertFalse(result["finished"])
+        call_command("sync_model", drain=True)
+        self.assertEqual(
+                sorted(StockAction.objects.values_list("id", flat=True)),
+                [stock.pk for stock in stocks if not stock.canceled],
+        )
+        self.assertTrue(StockAction.objects.filter(create_datetime__isnull=False).exists())
+        RawStockAction.objects.filter(pk=stocks[0].pk).update(
+                sender="alice", update_datetime=now + datetime.timedelta(minutes=1),
+        )
+        call_command("sync_model", drain=True)
+        self.assertEqual(StockAction.objects.get(pk=stocks[0].pk).sender, "alice")
+        sync_task.refresh_from_db()
+        self.assertEqual(sync_task.last_sync["pk"], stocks[0].pk)
+        # an unmapped NOT NULL field gets its python default, like bulk_sync
+        StockAction.objects.all().delete()
+        for sync_method in ["sync_model.utils.sync_in_database", "sync_model.utils.bulk_sync"]:
+            SyncTask.objects.filter(pk=sync_task.pk).update(
+                    last_sync={}, sync_method=sync_method,
+                    field_map={"id": "id", "update_datetime": "update_datetime", "sender": "sender"},
+            )
+            call_command("sync_model", drain=True)
+            self.assertEqual(
+                    sorted(StockAction.objects.values_list("stock_number", flat=True).distinct()), [""],
+            )
+            self.assertEqual(StockAction.objects.count(), 6)
+            StockAction.objects.all().delete()
+
+    def test_schedule(self):
+        def create_task(name, priority=0):
+            return SyncTask.objects.create(
+                    name=name,
+                    source=ContentType.objects.get_for_model(RawStockAction),
+                    target=ContentType.objects.get_for_model(StockAction),
+                    sync_method="sync_model.utils.sync_raw_stock_action",
+                    priority=priority,
+            )
+
+        fresh, recent, old = create_task("fresh"), create_task("recent"), create_task("old")
+        urgent = create_task("urgent", priority=1)
+        now = timezone.now()
+        for sync_task, hours in [(recent, 1), (old, 5)]:
+            SyncRun.objects.create(
+                    sync_task=sync_task, start=now - datetime.timedelta(hours=hours),
+                    end=now - datetime.timedelta(hours=hours), outcome="finished",
+                    caught_up=now - datetime.timedelta(hours=hours),
+            )
+        self.assertEqual(get_lags([fresh, recent])[fresh.pk], None)
+        units = order_units([(recent, None), (fresh, None), (urgent, None), (old, None)])
+        self.assertEqual([sync_task.name for sync_task, _ in units], ["urgent", "fresh", "old", "recent"])
+        last_run = SyncRun.objects.order_by("pk").last()
+        call_command("sync_model")
+        runs = SyncRun.objects.filter(pk__gt=last_run.pk).order_by("pk")
+        self.assertEqual(
+                list(runs.values_list("sync_task__name", flat=True)),
+                ["urgent", "fresh", "old", "recent"],
+        )
+
+    def test_throttle(self):
+        bucket = TokenBucket(rate=10, burst=10)
+        bucket.consume(25)
+        self.assertAlmostEqual(bucket.get_wait(), 1.5, delta=0.1)
+        with mock.patch("sync_model.throttle.time.sleep") as sleep:
+            bucket.wait()
+        self.assertAlmostEqual(sleep.call_args.args[0], 1.5, delta=0.1)
+        limits = {"default": {"rows_per_second": 1000, "concurrency": 1}}
+        with self.settings(SYNC_MODEL_RATE_LIMITS=limits):
+            limiter = get_limiter("default")
+            self.assertIs(get_limiter("default"), limiter)
+            RawStockAction.objects.create(
+                    sender="alice",
+                    action_type="buy",
+                    update_datetime=timezone.now(),
+                    canceled=False,
+                    stock_number="LUCK",
+            )
+            SyncTask.objects.create(
+                    name="stock",
+                    source=ContentType.objects.get_for_model(RawStockAction),
+                    target=ContentType.objects.get_for_model(StockAction),
+                    sync_method="sync_model.utils.sync_raw_stock_action",
+            )
+            slot_free = []
+
+            def write(batch, target_model, sync_task):
+                # the batch was read, the slot is not held during the write
+                slot_free.append(limiter.semaphore.acquire(blocking=False))
+                limiter.semaphore.release()
+                return sync_raw_stock_action(batch, target_model, sync_task)
+
+            with mock.patch("sync_model.management.commands.sync_model.get_sync_function", return_value=write):
+                call_command("sync_model")
+            self.assertEqual(slot_free, [True])
+            self.assertAlmostEqual(limiter.bucket.tokens, 999, delta=1)
+            # the slot was released
+            self.assertTrue(limiter.semaphore.acquire(blocking=False))
+            limiter.semaphore.release()
+        self.assertIsNone(get_limiter("default").bucket)
+
+    def test_trigger_capture(self):
+        now = timezone.now()
+        sync_task = SyncTask.objects.create(
+                name="capture",
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.utils.bulk_sync",
+                batch_size=10,
+                filter_by={"canceled": False},
+                field_map={"id": "id", "sender": "sender", "update_datetime": "update_datetime"},
+                capture="trigger",
+        )
+        call_command("sync_model_capture", "capture")
+        stocks = [
+                RawStockAction.objects.create(
+                    sender=sender,
+                    action_type="buy",
+                    update_datetime=now,
+                    canceled=False,
+                    stock_number="LUCK",
+                )
+                for sender in ["alice", "bob", "charlie"]
+        ]
+        self.assertEqual(SyncChangeLog.objects.count(), 3)
+        out = StringIO()
+        call_command("sync_model", status=True, stdout=out)
+        self.assertIn(f"{sync_task.pk}\tcapture\t3\t-", out.getvalue())
+        # the consumed entries are truncated on commit
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("sync_model")
+        self.assertEqual(StockAction.objects.count(), 3)
+        self.assertFalse(SyncChangeLog.objects.exists())
+        stocks[0].delete()
+        RawStockAction.objects.filter(pk=stocks[1].pk).update(sender="bobby")
+        RawStockAction.objects.filter(pk=stocks[2].pk).update(canceled=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("sync_model")
+        self.assertEqual(
+                list(StockAction.objects.values_list("sender", flat=True)),
+                ["bobby"],
+        )
+        sync_task.refresh_from_db()
+        self.assertEqual(sync_task.last_sync, {"seq": 6})
+        call_command("sync_model_capture", "capture", "--uninstall")
+        RawStockAction.objects.filter(pk=stocks[1].pk).update(sender="bob")
+        self.assertFalse(SyncChangeLog.objects.exists())
+        # an unsupported backend is a configuration error
+        with mock.patch("sync_model.capture.connections") as connections:
+            connections.__getitem__.return_value.vendor = "oracle"
+            with self.assertRaises(ValueError):
+                call_command("sync_model_capture", "capture", stdout=StringIO())
+
+    def test_trigger_capture_commit_order(self):
+        now = timezone.now()
+        stocks = [
+                RawStockAction.objects.create(
+                    sender=sender,
+                    action_type="buy",
+                    update_datetime=now,
+                    canceled=False,
+                    stock_number="LUCK",
+                )
+                for sender in ["alice", "bob", "charlie"]
+        ]
+        sync_task = SyncTask.objects.create(
+                name="capture",
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.utils.bulk_sync",
+                batch_size=10,
+                field_map={"id": "id", "sender": "sender", "update_datetime": "update_datetime"},
+                capture="trigger",
+        )
+        table = RawStockAction._meta.db_table
+        # postgresql: the transaction 101 got the lower id but is still running while 100 and 102 committed
+        late = SyncChangeLog.objects.create(table_name=table, row_pk=str(stocks[0].pk), operation="I", txid=101)
+        SyncChangeLog.objects.create(table_name=table, row_pk=str(stocks[1].pk), operation="I", txid=100)
+        last = SyncChangeLog.objects.create(table_name=table, row_pk=str(stocks[2].pk), operation="I", txid=102)
+        with mock.patch("sync_model.capture.get_xmin", return_value=101):
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command("sync_model")
+        self.assertEqual(list(StockAction.objects.values_list("sender", flat=True)), ["bob"])
+        sync_task.refresh_from_db()
+        self.assertEqual(sync_task.last_sync, {"txid": 100, "seq": late.pk + 1})
+        self.assertEqual(SyncChangeLog.objects.count(), 2)
+        # the entry with the lower id is consumed once its transaction committed
+        with mock.patch("sync_model.capture.get_xmin", return_value=103):
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command("sync_model")
+        self.assertEqual(StockAction.objects.count(), 3)
+        sync_task.refresh_from_db()
+        self.assertEqual(sync_task.last_sync, {"txid": 102, "seq": last.pk})
+        self.assertFalse(SyncChangeLog.objects.exists())
+
+    def test_verify(self):
+        now = timezone.now()
+        stocks = [
+                RawStockAction.objects.create(
+                    sender=f"sender{index}",
+                    action_type="buy",
+                    update_datetime=now + datetime.timedelta(seconds=index),
+                    canceled=False,
+                    stock_number="LUCK",
+                )
+                for index in range(30)
+        ]
+        sync_task = SyncTask.objects.create(
+                name="verify",
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.utils.bulk_sync",
+                batch_size=100,
+                order_by=["update_datetime", "pk"],
+                field_map={"id": "id", "sender": "sender", "update_datetime": "update_datetime"},
+        )
+        call_command("sync_model")
+        sync_task.refresh_from_db()
+        self.assertEqual(verify(sync_task)["ranges"], 1)
+        StockAction.objects.filter(pk=stocks[5].pk).delete()
+        StockAction.objects.filter(pk=stocks[10].pk).update(sender="mallory")
+        StockAction.objects.create(id=stocks[-1].pk + 100, sender="ghost", update_datetime=now)
+        new_stock = RawStockAction.objects.create(
+                sender="new",
+                action_type="buy",
+                update_datetime=now + datetime.timedelta(minutes=1),
+                canceled=False,
+                stock_number="LUCK",
+        )
+        report = verify(sync_task, leaf_size=4)
+        self.assertEqual(report["missing"], [stocks[5].pk])
+        self.assertEqual(report["changed"], [stocks[10].pk])
+        self.assertEqual(report["extra"], [stocks[-1].pk + 100])
+        self.assertEqual(report["pending"], [new_stock.pk])
+        self.assertGreater(report["ranges"], 1)
+        out = StringIO()
+        call_command("sync_model", verify=True, repair=True, leaf_size=4, stdout=out)
+        self.assertIn(f"{sync_task.pk}\tverify\t1\t1\t1\t1\t", out.getvalue())
+        # the extra rows are kept without --delete-extra
+        self.assertEqual(verify(sync_task, leaf_size=4)["extra"], [stocks[-1].pk + 100])
+        with self.assertRaises(CommandError):
+            call_command("sync_model", verify=True, repair=True, delete_extra=True, stdout=StringIO())
+        call_command("sync_model", verify=True, repair=True, delete_extra=True, name="verify", stdout=StringIO())
+        report = verify(sync_task, leaf_size=4)
+        self.assertEqual(report["missing"] + report["extra"] + report["changed"], [])
+        self.assertEqual(StockAction.objects.get(pk=stocks[10].pk).sender, "sender10")
+
+    def test_verify_shared_target(self):
+        now = timezone.now()
+        for index in range(10):
+            RawStockAction.objects.create(
+                    sender=f"sender{index % 2}",
+                    action_type="buy",
+                    update_datetime=now + datetime.timedelta(seconds=index),
+                    canceled=False,
+                    stock_number="LUCK",
+            )
+        sync_tasks = [
+                SyncTask.objects.create(
+                    name=f"sender{index}",
+                    source=ContentType.objects.get_for_model(RawStockAction),
+                    target=ContentType.objects.get_for_model(StockAction),
+                    sync_method="sync_model.utils.bulk_sync",
+                    order_by=["update_datetime", "pk"],
+                    filter_by={"sender": f"sender{index}"},
+                    field_map={"id": "id", "sender": "sender", "update_datetime": "update_datetime"},
+                )
+                for index in range(2)
+        ]
+        call_command("sync_model")
+        self.assertEqual(StockAction.objects.count(), 10)
+        for sync_task in sync_tasks:
+            sync_task.refresh_from_db()
+            report = verify(sync_task, leaf_size=2)
+            self.assertEqual(report["missing"] + report["extra"] + report["changed"], [])
+        StockAction.objects.create(id=100, sender="sender0", update_datetime=now)
+        self.assertEqual(verify(sync_tasks[0], leaf_size=2)["extra"], [100])
+        self.assertEqual(verify(sync_tasks[1], leaf_size=2)["extra"], [])
+        call_command("sync_model", verify=True, repair=True, delete_extra=True, name="sender1", stdout=StringIO())
+        call_command("sync_model", verify=True, repair=True, delete_extra=True, name="sender0", stdout=StringIO())
+        self.assertEqual(StockAction.objects.count(), 10)
+        # a filter out of field_map can not tell the rows apart, the extra rows are not reported
+        sync_tasks[0].field_map = {"id": "id", "update_datetime": "update_datetime"}
+        report = verify(sync_tasks[0], leaf_size=2)
+        self.assertEqual(report["missing"] + report["extra"] + report["changed"], [])
+
+
+class ParallelTest(TransactionTestCase):
+
+    def require_file_database(self):
+        """
+        the in memory sqlite database locks a whole table and fails the concurrent writes at once,
+        set DATABASES["default"]["TEST"]["NAME"] to run the threads on a file
+        """
+        if connection.vendor == "sqlite" and connection.is_in_memory_db():
+            self.skipTest("concurrent writes need a file backed sqlite test database")
+
+    def test_workers(self):
+        self.require_file_database()
+        now = timezone.make_aware(
+                datetime.datetime(2024, 1, 1, 2, 3, 4)
+        )
+        for index in range(3):
+            RawStockAction.objects.create(
+                    sender=f"sender{index}",
+                    action_type="buy",
+                    update_datetime=now + datetime.timedelta(seconds=index),
+                    canceled=False,
+                    stock_number="LUCK",
+            )
+        tasks = [
+                SyncTask.objects.create(
+                    name=f"task{index}",
+                    source=ContentType.objects.get_for_model(RawStockAction),
+                    target=ContentType.objects.get_for_model(StockAction),
+                    sync_method="sync_model.utils.sync_raw_stock_action",
+                    batch_size=10,
+                    order_by=["update_datetime"],
+                    filter_by={"sender": f"sender{index}"},
+                )
+                for index in range(3)
+        ]
+        tasks[2].dependencies.set(tasks[:2])
+        out = StringIO()
+        call_command("sync_model", workers=2, stdout=out)
+        self.assertEqual(StockAction.objects.count(), 3)
+        for sync_task in tasks:
+            sync_task.refresh_from_db()
+            self.assertTrue(sync_task.last_sync)
+        self.assertIn("critical path: ", out.getvalue())
+        path, seconds = critical_path(
+                {tasks[0]: 1.0, tasks[1]: 3.0, tasks[2]: 2.0},
+                {tasks[2]: tasks[:2]},
+        )
+        self.assertEqual(path, [tasks[1], tasks[2]])
+        self.assertEqual(seconds, 5.0)
+
+    def test_shards(self):
+        self.require_file_database()
+        now = timezone.make_aware(
+                datetime.datetime(2024, 1, 1, 2, 3, 4)
+        )
+        for index in range(7):
+            RawStockAction.objects.create(
+                    sender="alice",
+                    action_type="buy",
+                    update_datetime=now + datetime.timedelta(seconds=index),
+                    canceled=False,
+                    stock_number="LUCK",
+            )
+        sync_task = SyncTask.objects.create(
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.utils.sync_raw_stock_action",
+                batch_size=2,
+                order_by=["update_datetime"],
+                shards=3,
+        )
+        dependent = SyncTask.objects.create(
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.utils.sync_raw_stock_action",
+                order_by=["update_datetime"],
+        )
+        dependent.dependencies.set([sync_task])
+        call_command("sync_model", "--workers", "3", stdout=StringIO())
+        self.assertEqual(StockAction.objects.count(), 6)
+        dependent.refresh_from_db()
+        self.assertEqual(dependent.last_sync, {})
+        call_command("sync_model", "--workers", "3", "--drain", stdout=StringIO())
+        self.assertEqual(StockAction.objects.count(), 7)
+        self.assertEqual(SyncShard.objects.filter(sync_task=sync_task).count(), 3)
+        sync_task.refresh_from_db()
+        self.assertEqual(sync_task.last_sync, {})
+        dependent.refresh_from_db()
+        self.assertTrue(dependent.last_sync)
+
+    def test_close_broken_connections(self):
+        # a working connection is kept between the polls, even with the default CONN_MAX_AGE=0
+        connection.ensure_connection()
+        with mock.patch.object(connection, "close") as close:
+            close_broken_connections()
+            # an error which did not break the connection
+            connection.errors_occurred = True
+            close_broken_connections()
+            self.assertFalse(connection.errors_occurred)
+            close.assert_not_called()
+            # e.g. the database server restarted
+            connection.errors_occurred = True
+            with mock.patch.object(connection, "is_usable", return_value=False):
+                close_broken_connections()
+            close.assert_called_once_with()
+        connection.errors_occurred = False
+        self.assertFalse(SyncTask.objects.exists())
+
+    def test_prefetch(self):
+        now = timezone.make_aware(
+                datetime.datetime(2024, 1, 1, 2, 3, 4)
+        )
+        stocks = [
+                RawStockAction.objects.create(
+                    sender=f"sender{index}",
+                    action_type="buy",
+                    update_datetime=now + datetime.timedelta(seconds=index),
+                    canceled=False,
+                    stock_number="LUCK",
+                )
+                for index in range(12)
+        ]
+        sync_task = SyncTask.objects.create(
+                name="prefetch",
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.utils.sync_raw_stock_action",
+                batch_size=4,
+                order_by=["update_datetime", "pk"],
+        )
+        prefetcher = Prefetcher(sync_task, depth=2)
+        try:
+            last_sync, batch = prefetcher.get({}, 4)
+            self.assertEqual(last_sync, {})
+            self.assertEqual(batch, stocks[:4])
+            # a wrong prediction restarts the pipeline
+            cursor = get_value(stocks[8], sync_task.order_by, datetime2str=True)
+            _, batch = prefetcher.get(cursor, 4)
+            self.assertEqual(batch, stocks[8:12])
+        finally:
+            prefetcher.close()
+        call_command("sync_model", drain=True, prefetch=2)
+        self.assertEqual(StockAction.objects.count(), 12)
+        sync_task.refresh_from_db()
+        self.assertEqual(
+                sync_task.last_sync,
+                get_value(RawStockAction.objects.get(pk=stocks[-1].pk), sync_task.order_by, datetime2str=True),
+        )
+        self.assertEqual(SyncRun.objects.filter(sync_task=sync_task).count(), 4)
+
+
+@unittest.skipUnless("target" in settings.DATABASES, "set DATABASES[\"target\"] to run a second target_db")
+class MultiDatabaseTest(TransactionTestCase):
+    """
+    a SyncTask on default syncing into target_db, the cursor of an atomic task is checkpointed on target_db
+    """
+    databases = {"default", "target"} if "target" in settings.DATABASES else {"default"}
+
+    def test_checkpoint(self):
+        now = timezone.make_aware(
+                datetime.datetime(2024, 1, 1, 2, 3, 4)
+        )
+        for index in range(5):
+            RawStockAction.objects.create(
+                    sender=f"sender{index}",
+                    action_type="buy",
+                    update_datetime=now + datetime.timedelta(seconds=index),
+                    canceled=False,
+                    stock_number="LUCK",
+            )
+        sync_task = SyncTask.objects.create(
+                name="checkpoint",
+                source=ContentType.objects.get_for_model(RawStockAction),
+                target=ContentType.objects.get_for_model(StockAction),
+                sync_method="sync_model.utils.bulk_sync",
+                batch_size=2,
+                order_by=["update_datetime", "pk"],
+                field_map={"id": "id", "update_datetime": "update_datetime", "sender": "sender"},
+                target_db="target",
+                atomic=True,
+        )
+        call_command("sync_model")
+        sync_task.refresh_from_db()
+        self.assertEqual(StockAction.objects.using("target").count(), 2)
+        checkpoint = SyncCheckpoint.objects.using("target").get(name=f"synctask.{sync_task.pk}")
+        self.assertEqual(checkpoint.last_sync, sync_task.last_sync)
+        # a crash after the commit of target_db and before the cursor was saved on default
+        SyncTask.objects.filter(pk=sync_task.pk).update(last_sync={})
+        call_command("sync_model")
+        # resumed from the checkpoint: the next batch, not the first rows again
+        self.assertEqual(SyncRun.objects.order_by("pk").last().cursor_before, checkpoint.last_sync)
+        self.assertEqual(StockAction.objects.using("target").count(), 3)
+        checkpoint.refresh_from_db()
+        self.assertEqual(SyncTask.objects.get(pk=sync_task.pk).last_sync, checkpoint.last_sync)
+        # a batch failing after its writes rolls back the rows and the checkpoint together
+
+        def broken_bulk_sync(queryset, target_model, sync_task):
+            bulk_sync(queryset, target_model, sync_task)
+            raise RuntimeError("broken")
+
+        with mock.patch(
+                "sync_model.management.commands.sync_model.get_sync_function", return_value=broken_bulk_sync,
+        ), self.assertRaises(RuntimeError):
+            call_command("sync_model")
+        self.assertEqual(StockAction.objects.using("target").count(), 3)
+        self.assertEqual(SyncCheckpoint.objects.using("target").get().last_sync, checkpoint.last_sync)
+        self.assertEqual(SyncTask.objects.get(pk=sync_task.pk).last_sync, checkpoint.last_sync)
+        call_command("sync_model", drain=True)
+        self.assertEqual(StockAction.objects.using("target").count(), 5)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+limit the load of the sync on each source database
+
+configured in the django settings, per source_db alias:
+
+    SYNC_MODEL_RATE_LIMITS = {
+        "broker": {
+            "rows_per_second": 5000,  # token bucket refilled at this rate
+            "burst": 20000,  # size of the bucket, rows_per_second by default
+            "concurrency": 2,  # batches reading the database at the same time
+        },
+    }
+the limits are shared by the threads of a process, not between processes
+"""
+
+
+import logging
+import threading
+import time
+
+from typing import Dict, Optional, Tuple
+
+from django.conf import settings
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    the rows of a batch are only known after the batch, so a batch may overdraw the bucket
+    and the next batch waits until the debt is refilled
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+        self.updated = now
+
+    def consume(self, tokens: float) -> None:
+        with self.lock:
+            self.refill()
+            self.tokens -= tokens
+
+    def get_wait(self) -> float:
+        """
+        seconds until the bucket is not in debt
+        """
+        with self.lock:
+            self.refill()
+            return max(-self.tokens / self.rate, 0.0)
+
+    def wait(self) -> float:
+        seconds = self.get_wait()
+        if seconds > 0:
+            time.sleep(seconds)
+        return seconds
+
+
+class SourceLimiter:
+
+    def __init__(
+            self,
+            rows_per_second: Optional[float] = None,
+            burst: Optional[float] = None,
+            concurrency: Optional[int] = None):
+        self.bucket = TokenBucket(rows_per_second, burst) if rows_per_second else None
+        self.semaphore = threading.BoundedSemaphore(concurrency) if concurrency else None
+
+    def acquire(self) -> None:
+        """
+        wait until the debt of the previous batches is refilled, then take a slot of the database
+        """
+        if self.bucket is not None:
+            seconds = self.bucket.wait()
+            if seconds:
+                LOGGER.debug("throttle %.3f seconds", seconds)
+        if self.semaphore is not None:
+            self.semaphore.acquire()  # pylint: disable=consider-using-with
+
+    def release(self) -> None:
+        if self.semaphore is not None:
+            self.semaphore.release()
+
+    def consume(self, rows: int) -> None:
+        if self.bucket is not None and rows:
+            self.bucket.consume(rows)
+
+
+class SourceSlot:
+    """
+    the slot of one batch, released once the batch is read and not held during the write into target_db
+    release can be called again, only the first call gives the slot back
+    """
+
+    def __init__(self, limiter: SourceLimiter):
+        self.limiter = limiter
+        self.held = False
+
+    def acquire(self) -> None:
+        self.limiter.acquire()
+        self.held = True
+
+    def release(self) -> None:
+        if self.held:
+            self.held = False
+            self.limiter.release()
+
+
+LIMITERS: Dict[str, Tuple[dict, SourceLimiter]] = {}
+LIMITERS_LOCK = threading.Lock()
+
+
+def get_limiter(source_db: str) -> SourceLimiter:
+    """
+    the limiter of a source database, rebuilt when its settings change
+    """
+    config = getattr(settings, "SYNC_MODEL_RATE_LIMITS", {}).get(source_db, {})
+    with LIMITERS_LOCK:
+        if source_db not in LIMITERS or LIMITERS[source_db][0] != config:
+            LIMITERS[source_db] = (dict(config), SourceLimiter(**config))
+        return LIMITERS[source_db][1]
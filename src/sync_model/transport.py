@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+offline transport: export the batches of a task into files and replay them into a target_db
+which can not reach the source_db
+
+a directory holds the export of one task:
+
+    manifest.json       the task, the order_by and the cursor range of every chunk
+    chunk-000000.gz     one batch, gzip of length prefixed records
+    chunk-000001.gz
+    ...
+
+a record is a 4 bytes big endian length followed by one row serialized by the django python serializer as json.
+The export starts after the last chunk of the manifest (or the task cursor), so running it again appends the new rows.
+The cursor is inclusive, so the last row of the previous chunk is excluded by its pk and every row is exported once.
+The import replays the chunk starting at the task cursor, then the next ones, one transaction per chunk for an
+atomic task, so an interrupted import resumes at the first chunk not applied.
+The chunks are streamed, a chunk is never loaded into memory at once.
+"""
+
+
+import gzip
+import json
+import logging
+import os
+import struct
+import time
+
+from typing import Iterator, List, Optional
+
+from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Model
+from django.utils import timezone
+
+from .checkpoint import load_checkpoint, save_checkpoint
+from .exceptions import StepTooSmallException
+from .ledger import record_run
+from .models import SyncTask
+from .types import SyncResult, TransportChunk, TransportManifest
+from .utils import get_load_fields, get_queryset, get_source_model, get_sync_function, get_value
+
+
+LOGGER = logging.getLogger(__name__)
+MANIFEST = "manifest.json"
+MANIFEST_VERSION = 1
+LENGTH = struct.Struct(">I")
+EXPORT_CHUNK_SIZE = 2000
+
+
+def check_task(sync_task: SyncTask) -> None:
+    if sync_task.capture != "poll" or sync_task.shards > 1:
+        raise ValueError(f"A sync task {sync_task} can only be transported with poll capture and without shards")
+
+
+def load_manifest(directory: str) -> Optional[TransportManifest]:
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as manifest_file:
+        manifest: TransportManifest = json.load(manifest_file)
+    if manifest["version"] != MANIFEST_VERSION:
+        raise ValueError(f"the manifest {path} has an unsupported version {manifest['version']}")
+    return manifest
+
+
+def save_manifest(directory: str, manifest: TransportManifest) -> None:
+    """
+    replace the manifest at once, an interrupted export keeps the previous chunks
+    """
+    path = os.path.join(directory, MANIFEST)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def get_manifest(sync_task: SyncTask, directory: str) -> TransportManifest:
+    """
+    the manifest of the directory, a new one starting at the task cursor if there is none
+    """
+    source_model = get_source_model(sync_task)
+    source = source_model._meta.label_lower
+    manifest = load_manifest(directory)
+    if manifest is None:
+        return {
+                "version": MANIFEST_VERSION,
+                "task": sync_task.name,
+                "source": source,
+                "order_by": list(sync_task.order_by),
+                "start": sync_task.last_sync,
+                "chunks": [],
+        }
+    if manifest["source"] != source or manifest["order_by"] != list(sync_task.order_by):
+        raise ValueError(
+                f"the export {directory} of {manifest['source']} by {manifest['order_by']} does not match {sync_task}"
+        )
+    return manifest
+
+
+def write_records(path: str, records: Iterator[bytes]) -> None:
+    with gzip.open(path, "wb") as chunk_file:
+        for record in records:
+            chunk_file.write(LENGTH.pack(len(record)))
+            chunk_file.write(record)
+
+
+def read_records(path: str) -> Iterator[bytes]:
+    with gzip.open(path, "rb") as chunk_file:
+        while True:
+            header = chunk_file.read(LENGTH.size)
+            if not header:
+                return
+            if len(header) < LENGTH.size:
+                raise ValueError(f"the chunk {path} is truncated")
+            (length,) = LENGTH.unpack(header)
+            record = chunk_file.read(length)
+            if len(record) < length:
+                raise ValueError(f"the chunk {path} is truncated")
+            yield record
+
+
+def export_chunk(sync_task: SyncTask, directory: str, manifest: TransportManifest) -> Optional[TransportChunk]:
+    """
+    write the batch after the last chunk into a new chunk, None if there is no row
+    """
+    source_model = get_source_model(sync_task)
+    previous = manifest["chunks"][-1] if manifest["chunks"] else None
+    after = manifest["start"] if previous is None else previous["last"]
+    queryset = get_queryset(sync_task, last_sync=after)
+    if previous is not None:
+        queryset = queryset.exclude(pk=previous["last_pk"])
+    if sync_task.source_fields:
+        fields = get_load_fields(source_model, sync_task)
+    else:
+        fields = [field.name for field in source_model._meta.concrete_fields]
+    serializer = serializers.get_serializer("python")()
+    rows = queryset[0:sync_task.batch_size].iterator(
+            chunk_size=sync_task.chunk_size or EXPORT_CHUNK_SIZE,
+    )
+    chunk: TransportChunk = {
+            "file": f"chunk-{len(manifest['chunks']):06d}.gz",
+            "after": after,
+            "last": after,
+            "last_pk": "",
+            "rows": 0,
+            "finished": False,
+    }
+
+    def records() -> Iterator[bytes]:
+        last_row = None
+        for row in rows:
+            chunk["rows"] += 1
+            last_row = row
+            yield json.dumps(serializer.serialize([row], fields=fields)[0], cls=DjangoJSONEncoder).encode()
+        if last_row is not None:
+            chunk["last"] = get_value(last_row, sync_task.order_by, datetime2str=True)
+            chunk["last_pk"] = source_model._meta.pk.value_to_string(last_row)
+
+    path = os.path.join(directory, chunk["file"])
+    write_records(f"{path}.tmp", records())
+    if chunk["rows"] == 0:
+        os.remove(f"{path}.tmp")
+        return None
+    chunk["finished"] = chunk["rows"] < sync_task.batch_size
+    if not chunk["finished"] and chunk["last"] == after:
+        os.remove(f"{path}.tmp")
+        raise StepTooSmallException
+    os.replace(f"{path}.tmp", path)
+    manifest["chunks"].append(chunk)
+    save_manifest(directory, manifest)
+    LOGGER.info("%s export %d rows into %s, last_sync: %s", sync_task, chunk["rows"], path, chunk["last"])
+    return chunk
+
+
+def export(
+        sync_task: SyncTask,
+        directory: str,
+        max_chunks: Optional[int] = None,
+        deadline: Optional[float] = None) -> List[TransportChunk]:
+    """
+    export the batches after the last chunk until a batch is not full
+    the cursor of the task is not moved, the rows are synced by the import
+    """
+    check_task(sync_task)
+    os.makedirs(directory, exist_ok=True)
+    manifest = get_manifest(sync_task, directory)
+    chunks: List[TransportChunk] = []
+    while True:
+        chunk = export_chunk(sync_task, directory, manifest)
+        if chunk is None:
+            break
+        chunks.append(chunk)
+        if chunk["finished"]:
+            break
+        if max_chunks and len(chunks) >= max_chunks:
+            break
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+    return chunks
+
+
+def read_chunk(sync_task: SyncTask, directory: str, chunk: TransportChunk) -> Iterator[Model]:
+    """
+    the source instances of a chunk, not saved to any database
+    """
+    for record in read_records(os.path.join(directory, chunk["file"])):
+        for deserialized in serializers.deserialize("python", [json.loads(record)], using=sync_task.source_db):
+            yield deserialized.object
+
+
+def import_chunk(sync_task: SyncTask, directory: str, chunk: TransportChunk) -> SyncResult:
+    """
+    replay a chunk with the sync method of the task and move the cursor to its last row
+    """
+    sync_function = get_sync_function(sync_task.sync_method)
+    sync_result = sync_function(
+            read_chunk(sync_task, directory, chunk),
+            sync_task.target.model_class(),
+            sync_task,
+    )
+    sync_result["finished"] = chunk["finished"]
+    sync_task.last_sync = chunk["last"]
+    save_checkpoint(sync_task, sync_task)
+    return sync_result
+
+
+def import_chunks(
+        sync_task: SyncTask,
+        directory: str,
+        max_chunks: Optional[int] = None,
+        deadline: Optional[float] = None) -> List[SyncResult]:
+    """
+    replay the chunks from the one starting at the task cursor
+    sync methods which read the source_db again (sync_in_database) fall back to bulk_sync on the rows
+    """
+    check_task(sync_task)
+    manifest = load_manifest(directory)
+    if manifest is None:
+        raise ValueError(f"the directory {directory} has no {MANIFEST}")
+    get_manifest(sync_task, directory)
+    load_checkpoint(sync_task, sync_task)
+    chunks = manifest["chunks"]
+    if sync_task.last_sync != manifest["start"] and all(
+            chunk["after"] != sync_task.last_sync and chunk["last"] != sync_task.last_sync
+            for chunk in chunks):
+        raise ValueError(f"the export {directory} does not contain the cursor {sync_task.last_sync} of {sync_task}")
+    results: List[SyncResult] = []
+    for chunk in chunks:
+        if chunk["after"] != sync_task.last_sync:
+            continue
+        cursor_before = sync_task.last_sync
+        start = timezone.now()
+        try:
+            if sync_task.atomic:
+                with transaction.atomic(using=sync_task.target_db):
+                    sync_result = import_chunk(sync_task, directory, chunk)
+            else:
+                sync_result = import_chunk(sync_task, directory, chunk)
+        except Exception:
+            record_run(sync_task, None, cursor_before, cursor_before, start=start)
+            raise
+        record_run(sync_task, None, cursor_before, sync_task.last_sync, sync_result)
+        LOGGER.info("%s import %s, last_sync: %s", sync_task, chunk["file"], sync_task.last_sync)
+        results.append(sync_result)
+        if max_chunks and len(results) >= max_chunks:
+            break
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+    return results
@@ -4,14 +4,72 @@
 
 
 import datetime
-from typing import TypedDict, Optional
+from typing import Any, List, Optional, TypedDict
 
 from django.db.models import Model
 
 
-class SyncResult(TypedDict):
+class BaseSyncResult(TypedDict):
     finished: bool
     count: int
     start: datetime.datetime
     end: datetime.datetime
     last_sync_model: Optional[Model]
+
+
+class SyncResult(BaseSyncResult, total=False):
+    # the rows not written because their fingerprint did not change, see SyncTask.fingerprint
+    skipped: int
+
+
+class BacklogEstimate(TypedDict):
+    rows: Optional[int]
+    # planner: the database row estimate, count: exact count, at_least: more than `rows`
+    method: str
+    time_lag: Optional[float]
+
+
+class VerifyReport(TypedDict):
+    # target pks whose source row passed the cursor but is absent in the target
+    missing: List[Any]
+    # target pks without a matching source row
+    extra: List[Any]
+    # pks present on both sides with different field_map values
+    changed: List[Any]
+    # missing or changed pks after the cursor, they will be synced by the next batches
+    pending: List[Any]
+    # number of pk ranges whose fingerprints were compared
+    ranges: int
+
+
+class ExplainReport(TypedDict):
+    # the text printed by queryset.explain()
+    plan: str
+    # the full scans and the sorts of the plan
+    warnings: List[str]
+    # the fields of the suggested index, None if an index already starts with them
+    index: Optional[List[str]]
+
+
+class TransportChunk(TypedDict):
+    # the file name of the chunk in the export directory
+    file: str
+    # the cursor the batch was read after, and the cursor of its last row
+    after: dict
+    last: dict
+    # the pk of the last row, the next chunk starts at `last` without this row
+    last_pk: str
+    rows: int
+    # the batch was not full, the export caught up
+    finished: bool
+
+
+class TransportManifest(TypedDict):
+    version: int
+    task: str
+    # app_label.model_name of the source model
+    source: str
+    order_by: List[str]
+    # the cursor of the task when the first chunk was exported
+    start: dict
+    chunks: List[TransportChunk]
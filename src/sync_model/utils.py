@@ -9,26 +9,56 @@ useful utils to sync model instance
 
 
 import datetime
+import functools
+import importlib
+import json
 import logging
+import threading
 import warnings
 
-from typing import NewType, List, Optional
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, NewType, List, Optional, Tuple, Type, Union
 
-from django.db.models import Q, Model
+from django.db import connections
+from django.db.models import NOT_PROVIDED, BooleanField, DateTimeField, Expression, F, Q, Model, QuerySet, Value
+from django.db.models.functions import Mod
 from django.utils import timezone
 
+from .fingerprint import filter_changed, save_fingerprints
 from .models import (
-        SyncTask, StockAction
+        SyncChangeLog, SyncShard, SyncTask, StockAction
         )
-from .types import SyncResult
+from .types import BacklogEstimate, SyncResult
 
 
 OrderBy = NewType("OrderBy", List[str])
 LOGGER = logging.getLogger(__name__)
+BULK_CHUNK_SIZE = 1000
+BACKLOG_COUNT_LIMIT = 100000
+MIN_BATCH_SIZE = 2
 
 
-def get_queryset(sync_task: SyncTask):
-    """get filtered and ordered queryset from sync_task"""
+def get_source_model(sync_task: SyncTask) -> Type[Model]:
+    source_model: Optional[Type[Model]] = sync_task.source.model_class()
+    if source_model is None:
+        raise ValueError(f"A sync task {sync_task} use an deleted model")
+    return source_model
+
+
+def get_models(sync_task: SyncTask) -> Tuple[Type[Model], Type[Model]]:
+    source_model: Optional[Type[Model]] = sync_task.source.model_class()
+    target_model: Optional[Type[Model]] = sync_task.target.model_class()
+    if source_model is None or target_model is None:
+        raise ValueError(f"A sync task {sync_task} use an deleted model")
+    return source_model, target_model
+
+
+def get_queryset(sync_task: SyncTask, shard: Optional[SyncShard] = None, last_sync: Optional[dict] = None):
+    """
+    get filtered and ordered queryset from sync_task
+    if shard is given, only the rows of this shard after the shard's cursor
+    if last_sync is given, the rows after it instead of the cursor
+    """
     source_model: Optional[type[Model]] = sync_task.source.model_class()
     if source_model is None:
         raise ValueError(f"A sync task {sync_task} use an deleted model")
@@ -36,10 +66,180 @@ def get_queryset(sync_task: SyncTask):
     queryset = all_queryset.filter(
             **sync_task.filter_by
     ).order_by(*sync_task.order_by)
-    filter_q = get_Q(sync_task.order_by, sync_task.last_sync)
+    if sync_task.source_fields:
+        queryset = queryset.only(*get_load_fields(source_model, sync_task))
+    cursor_sync = sync_task.last_sync
+    if shard is not None:
+        queryset = queryset.alias(
+                sync_shard=Mod(F(sync_task.shard_by), sync_task.shards),
+        ).filter(sync_shard=shard.index)
+        cursor_sync = shard.last_sync
+    if last_sync is None:
+        last_sync = cursor_sync
+    filter_q = get_keyset_filter(
+            source_model, sync_task.order_by, last_sync,
+            connections[sync_task.source_db],
+    )
     return queryset.filter(filter_q)
 
 
+def get_load_fields(source_model: Type[Model], sync_task: SyncTask) -> List[str]:
+    """
+    source_fields plus the order_by keys, so get_value will not trigger a query per instance
+    """
+    fields = list(sync_task.source_fields)
+    for key in sync_task.order_by:
+        field = key.lstrip("-")
+        if field == "pk":
+            field = source_model._meta.pk.name
+        if field not in fields:
+            fields.append(field)
+    return fields
+
+
+def get_shards(sync_task: SyncTask, create: bool = True) -> List[Optional[SyncShard]]:
+    """
+    get (and create) the shards of a sync_task, [None] if the task is not sharded
+    create=False: read only, the missing shards are unsaved shards at the start
+    a shard beyond sync_task.shards means shards was lowered after the shards had cursors, see SyncTask.clean
+    """
+    if sync_task.shards <= 1:
+        return [None]
+    shards = {
+            shard.index: shard
+            for shard in SyncShard.objects.filter(sync_task=sync_task)
+    }
+    if max(shards, default=0) >= sync_task.shards:
+        raise ValueError(
+                f"A sync task {sync_task} has {len(shards)} shard cursors but {sync_task.shards} shards, "
+                "delete its SyncShard rows to sync it again from the start"
+        )
+    for index in range(sync_task.shards):
+        if index in shards:
+            continue
+        if create:
+            shards[index], _ = SyncShard.objects.get_or_create(sync_task=sync_task, index=index)
+        else:
+            shards[index] = SyncShard(sync_task=sync_task, index=index)
+    return [shards[index] for index in range(sync_task.shards)]
+
+
+@functools.lru_cache(maxsize=None)
+def get_sync_function(sync_method: str) -> Callable[..., SyncResult]:
+    """
+    import the sync_method once per process
+    e.g.
+        >>> get_sync_function("sync_model.utils.bulk_sync")
+        <function bulk_sync>
+    """
+    module, function = sync_method.rsplit(".", 1)
+    return getattr(
+        importlib.import_module(module),
+        function
+    )
+
+
+def get_adapted_batch_size(sync_task: SyncTask, sync_result: SyncResult) -> int:
+    """
+    move batch_size toward target_batch_duration, by at most x2 or /2 each batch
+    a batch that is not full only shrinks, it says nothing about a bigger batch
+    """
+    duration = max((sync_result["end"] - sync_result["start"]).total_seconds(), 0.001)
+    ratio = sync_task.target_batch_duration / duration
+    if ratio >= 1 and sync_result["count"] < sync_task.batch_size:
+        return sync_task.batch_size
+    ratio = min(max(ratio, 0.5), 2)
+    return min(
+            max(int(sync_task.batch_size * ratio), MIN_BATCH_SIZE),
+            sync_task.max_batch_size,
+    )
+
+
+def estimate_backlog(
+        sync_task: SyncTask,
+        shard: Optional[SyncShard] = None,
+        limit: int = BACKLOG_COUNT_LIMIT) -> BacklogEstimate:
+    """
+    estimate the rows after the cursor without queryset.count()
+    * postgresql, mysql: the planner row estimate of the keyset query (EXPLAIN)
+    * other databases: count at most `limit` rows of the index range
+    * trigger capture: count at most `limit` change log entries after the cursor
+    time_lag: seconds between now and the cursor if the leading order_by key is an ascending datetime
+    """
+    if sync_task.capture == "trigger":
+        source_model = get_source_model(sync_task)
+        rows = SyncChangeLog.objects.using(sync_task.source_db).filter(
+                get_change_filter(sync_task.last_sync),
+                table_name=source_model._meta.db_table,
+        )[:limit].count()
+        return {
+                "rows": rows,
+                "method": "at_least" if rows >= limit else "count",
+                "time_lag": None,
+        }
+    queryset = get_queryset(sync_task, shard)
+    connection = connections[sync_task.source_db]
+    rows: Optional[int] = None
+    method = "count"
+    if connection.vendor == "postgresql":
+        plan = json.loads(queryset.explain(format="json"))
+        if isinstance(plan, list):
+            # the raw EXPLAIN output, django returns its only element
+            plan = plan[0]
+        rows = int(plan["Plan"]["Plan Rows"])
+        method = "planner"
+    elif connection.vendor == "mysql":
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN {sql}", params)
+            columns = [column[0] for column in cursor.description]
+            rows = max(
+                    (int(row[columns.index("rows")] or 0) for row in cursor.fetchall()),
+                    default=0,
+            )
+        method = "planner"
+    else:
+        rows = queryset[:limit].count()
+        if rows >= limit:
+            method = "at_least"
+    return {
+            "rows": rows,
+            "method": method,
+            "time_lag": get_time_lag(sync_task, shard),
+    }
+
+
+def get_change_filter(last_sync: dict) -> Q:
+    """
+    the SyncChangeLog entries after the cursor {"seq": id} or {"txid": txid, "seq": id} of a trigger task
+    the entries without txid (not written by postgresql) come first, in id order
+    """
+    seq = last_sync.get("seq", 0)
+    txid = last_sync.get("txid")
+    if txid is None:
+        return Q(txid__isnull=True, id__gt=seq) | Q(txid__isnull=False)
+    return Q(txid__gt=txid) | Q(txid=txid, id__gt=seq)
+
+
+def get_time_lag(sync_task: SyncTask, shard: Optional[SyncShard] = None) -> Optional[float]:
+    """
+    seconds from the cursor to now, when the leading order_by key is an ascending datetime field
+    """
+    last_sync = sync_task.last_sync if shard is None else shard.last_sync
+    source_model = sync_task.source.model_class()
+    if not sync_task.order_by or not last_sync or source_model is None:
+        return None
+    first_key = sync_task.order_by[0]
+    if first_key.startswith("-") or "__" in first_key or first_key == "pk":
+        return None
+    if not isinstance(source_model._meta.get_field(first_key), DateTimeField):
+        return None
+    value = last_sync.get(first_key)
+    if not value:
+        return None
+    return (timezone.now() - datetime.datetime.fromisoformat(value)).total_seconds()
+
+
 def get_value(instance: Model, order_by: OrderBy, datetime2str: bool) -> dict:
     """
     get last sync value from instance according order_by
@@ -97,6 +297,174 @@ def get_Q(order_by: OrderBy, last_sync: dict) -> Q:  # pylint: disable=invalid-n
     return result
 
 
+class RowValueCompare(Expression):
+    """
+    compare two row values, e.g. ("update_datetime", "id") >= (%s, %s)
+    """
+    conditional = True
+    output_field = BooleanField()
+
+    def __init__(self, lhs: list, rhs: list, operator: str):
+        super().__init__()
+        self.lhs = lhs
+        self.rhs = rhs
+        self.operator = operator
+
+    def get_source_expressions(self):
+        return [*self.lhs, *self.rhs]
+
+    def set_source_expressions(self, exprs):
+        self.lhs = exprs[:len(self.lhs)]
+        self.rhs = exprs[len(self.lhs):]
+
+    def as_sql(self, compiler, connection):  # pylint: disable=arguments-differ
+        params: list = []
+        sides = []
+        for side in (self.lhs, self.rhs):
+            sqls = []
+            for expr in side:
+                sql, expr_params = compiler.compile(expr)
+                sqls.append(sql)
+                params.extend(expr_params)
+            sides.append(f"({', '.join(sqls)})")
+        return f"{sides[0]} {self.operator} {sides[1]}", params
+
+
+def supports_row_values(connection) -> bool:
+    """
+    whether the backend can compare row values and use it as an index range
+    """
+    if connection.vendor == "sqlite":
+        return connection.Database.sqlite_version_info >= (3, 15)
+    return connection.vendor in ("postgresql", "mysql")
+
+
+def get_keyset_filter(
+        model: Type[Model],
+        order_by: OrderBy,
+        last_sync: dict,
+        connection) -> Union[Q, Expression]:
+    """
+    get an index friendly filter from order_by and last_sync data
+
+    * all keys share a direction: (a, b) >= (x, y)
+    * mixed directions: a >= x AND get_Q(...), so the leading column can still seek
+    * otherwise (null value, related lookups): fallback to get_Q
+    """
+    if (
+            not last_sync or not order_by
+            or any(last_sync[key] is None or "__" in key for key in order_by)
+    ):
+        return get_Q(order_by, last_sync)
+    descending = {key.startswith("-") for key in order_by}
+    if len(descending) == 1 and supports_row_values(connection):
+        fields = [
+                model._meta.pk if key.lstrip("-") == "pk" else model._meta.get_field(key.lstrip("-"))
+                for key in order_by
+        ]
+        return RowValueCompare(
+                [F(key.lstrip("-")) for key in order_by],
+                [
+                    Value(last_sync[key], output_field=field)
+                    for key, field in zip(order_by, fields)
+                ],
+                "<=" if descending.pop() else ">=",
+        )
+    first_key = order_by[0]
+    direction = "lte" if first_key.startswith("-") else "gte"
+    return Q(**{
+        f"{first_key.lstrip('-')}__{direction}": last_sync[first_key]
+    }) & get_Q(order_by, last_sync)
+
+
+class ForeignKeyResolver:
+    """
+    map the natural keys of a batch to the pks of a related model on the target,
+    for the sync methods building foreign keys
+
+    e.g.
+        >>> BROKERS = ForeignKeyResolver(Broker, "name", using="default", create=True)
+        >>> broker_ids = BROKERS.resolve(raw.sender for raw in batch)
+        {"alice": 1, "bob": 2}
+    the keys are resolved with one `in` query per chunk, the missing keys are bulk created if create is True,
+    the resolved keys are kept in a LRU cache of cache_size keys shared by the threads.
+    key_field should be unique, so concurrent creators do not duplicate the rows.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self,
+            model: Type[Model],
+            key_field: str,
+            using: str = "default",
+            create: bool = False,
+            defaults: Optional[dict] = None,
+            cache_size: int = 100000,
+            chunk_size: int = BULK_CHUNK_SIZE):
+        self.model = model
+        self.key_field = key_field
+        self.using = using
+        self.create = create
+        self.defaults = defaults or {}
+        self.cache_size = cache_size
+        self.chunk_size = chunk_size
+        self.cache: "OrderedDict[Any, Any]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def resolve(self, keys: Iterable[Any]) -> Dict[Any, Any]:
+        """
+        return {key: pk}, the keys which do not exist (and are not created) are left out
+        """
+        result: Dict[Any, Any] = {}
+        missing: List[Any] = []
+        # dedupe in linear time before taking the lock, in the order of the keys
+        unique_keys = dict.fromkeys(keys)
+        with self.lock:
+            for key in unique_keys:
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    result[key] = self.cache[key]
+                else:
+                    missing.append(key)
+        if not missing:
+            return result
+        found = self.fetch(missing)
+        if self.create and len(found) < len(missing):
+            manager = self.model.objects.using(self.using)  # type: ignore[attr-defined]
+            manager.bulk_create([
+                self.model(**{self.key_field: key}, **self.defaults)
+                for key in missing if key not in found
+            ], batch_size=self.chunk_size, ignore_conflicts=True)
+            found.update(self.fetch([key for key in missing if key not in found]))
+        with self.lock:
+            for key, pk in found.items():
+                self.cache[key] = pk
+                self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        result.update(found)
+        return result
+
+    def fetch(self, keys: List[Any]) -> Dict[Any, Any]:
+        manager = self.model.objects.using(self.using)  # type: ignore[attr-defined]
+        found: Dict[Any, Any] = {}
+        for index in range(0, len(keys), self.chunk_size):
+            found.update(manager.filter(**{
+                f"{self.key_field}__in": keys[index:index + self.chunk_size],
+            }).values_list(self.key_field, "pk"))
+        return found
+
+    def invalidate(self, keys: Optional[Iterable[Any]] = None) -> None:
+        """
+        forget the given keys, or all keys, e.g. after the related rows were deleted or renamed
+        """
+        with self.lock:
+            if keys is None:
+                self.cache.clear()
+                return
+            for key in keys:
+                self.cache.pop(key, None)
+
+
 def sync_raw_stock_action(
         queryset,
         target_model: StockAction,
@@ -127,3 +495,227 @@ def sync_raw_stock_action(
         sync_result["finished"] = True
     sync_result["end"] = timezone.now()
     return sync_result
+
+
+def bulk_sync(
+        queryset,
+        target_model: Type[Model],
+        sync_task: SyncTask) -> SyncResult:
+    """
+    generic sync method driven by sync_task.field_map
+
+    e.g.
+        field_map = {"id": "id", "update_datetime": "update_datetime", "sender": "sender"}
+    the target primary key must be mapped. Rows are written with one bulk upsert per chunk on
+    sync_task.target_db, or with ignore_conflicts if sync_task.update_existing is False.
+    With sync_task.fingerprint, the rows whose mapped fields did not change are skipped.
+    """
+    if not sync_task.field_map:
+        raise ValueError(f"A sync task {sync_task} use bulk_sync without field_map")
+    pk_name = target_model._meta.pk.name
+    if pk_name not in sync_task.field_map:
+        raise ValueError(f"field_map of {sync_task} should contain the primary key {pk_name}")
+    sync_result: SyncResult = {
+            "finished": False,
+            "count": 0,
+            "start": timezone.now(),
+            "last_sync_model": None,
+            "end": timezone.now(),
+    }
+    chunk = []
+    for source_instance in queryset:
+        chunk.append(target_model(**{
+            target_field: getattr(source_instance, source_field)
+            for target_field, source_field in sync_task.field_map.items()
+        }))
+        sync_result["last_sync_model"] = source_instance
+        sync_result["count"] += 1
+        if len(chunk) >= BULK_CHUNK_SIZE:
+            write_chunk(chunk, target_model, sync_task, sync_result)
+            chunk = []
+    if chunk:
+        write_chunk(chunk, target_model, sync_task, sync_result)
+    if sync_result["count"] < sync_task.batch_size:
+        sync_result["finished"] = True
+    sync_result["end"] = timezone.now()
+    return sync_result
+
+
+def write_chunk(
+        instances: List[Model],
+        target_model: Type[Model],
+        sync_task: SyncTask,
+        sync_result: Optional[SyncResult] = None) -> None:
+    """
+    write target instances with one statement if the backend support upsert
+    with sync_task.fingerprint, only the changed instances are written and the others are counted as skipped
+    """
+    digests: Dict[str, str] = {}
+    if sync_task.fingerprint:
+        changed, digests = filter_changed(instances, sync_task)
+        if sync_result is not None:
+            sync_result["skipped"] = sync_result.get("skipped", 0) + len(instances) - len(changed)
+        instances = changed
+        if not instances:
+            return
+    write_instances(instances, target_model, sync_task)
+    save_fingerprints(sync_task, digests)
+
+
+def write_instances(instances: List[Model], target_model: Type[Model], sync_task: SyncTask) -> None:
+    pk_name = target_model._meta.pk.name
+    update_fields = [
+            field for field in sync_task.field_map
+            if field != pk_name
+    ]
+    manager = target_model.objects.using(sync_task.target_db)  # type: ignore[attr-defined]
+    features = connections[sync_task.target_db].features
+    if not sync_task.update_existing or not update_fields:
+        manager.bulk_create(instances, ignore_conflicts=True)
+    elif features.supports_update_conflicts_with_target:
+        manager.bulk_create(
+                instances,
+                update_conflicts=True,
+                unique_fields=[pk_name],
+                update_fields=update_fields,
+        )
+    elif features.supports_update_conflicts:
+        manager.bulk_create(
+                instances,
+                update_conflicts=True,
+                update_fields=update_fields,
+        )
+    else:
+        existing = set(manager.filter(
+            pk__in=[instance.pk for instance in instances]
+        ).values_list("pk", flat=True))
+        manager.bulk_create([
+            instance for instance in instances
+            if instance.pk not in existing
+        ])
+        manager.bulk_update([
+            instance for instance in instances
+            if instance.pk in existing
+        ], update_fields)
+
+
+def sync_in_database(
+        queryset,
+        target_model: Type[Model],
+        sync_task: SyncTask) -> SyncResult:
+    """
+    set based sync method driven by sync_task.field_map, when source_db is target_db
+
+    the batch is written with one INSERT ... SELECT ... ON CONFLICT (ON DUPLICATE KEY on mysql),
+    bounded by the keyset of the last row of the batch, so the rows never leave the database.
+    The target fields out of field_map get their python default once per batch.
+    It falls back to bulk_sync for another target_db, an unsupported backend or a batch which is not a queryset.
+    """
+    connection = connections[sync_task.target_db]
+    if (
+            not isinstance(queryset, QuerySet) or queryset.query.high_mark is None
+            or sync_task.source_db != sync_task.target_db
+            or connection.vendor not in ("postgresql", "sqlite", "mysql")
+            or (connection.vendor != "mysql" and not connection.features.supports_update_conflicts_with_target)
+    ):
+        return bulk_sync(queryset, target_model, sync_task)
+    if not sync_task.field_map:
+        raise ValueError(f"A sync task {sync_task} use sync_in_database without field_map")
+    pk_name = target_model._meta.pk.name
+    if pk_name not in sync_task.field_map:
+        raise ValueError(f"field_map of {sync_task} should contain the primary key {pk_name}")
+    sync_result: SyncResult = {
+            "finished": False,
+            "count": 0,
+            "start": timezone.now(),
+            "last_sync_model": None,
+            "end": timezone.now(),
+    }
+    batch_size = queryset.query.high_mark - queryset.query.low_mark
+    unsliced = queryset.all()
+    unsliced.query.clear_limits()
+    last_sync_model = unsliced[batch_size - 1:batch_size].first()
+    if last_sync_model is None:
+        sync_result["finished"] = True
+        last_sync_model = unsliced.reverse().first()
+    if last_sync_model is None:
+        sync_result["end"] = timezone.now()
+        return sync_result
+    order_by = sync_task.order_by
+    reversed_order_by = [key[1:] if key.startswith("-") else f"-{key}" for key in order_by]
+    last_value = get_value(last_sync_model, order_by, datetime2str=False)
+    bounded = unsliced.filter(get_keyset_filter(
+        unsliced.model, OrderBy(reversed_order_by),
+        {reversed_key: last_value[key] for key, reversed_key in zip(order_by, reversed_order_by)},
+        connection,
+    ))
+    sync_result["count"] = bounded.count()
+    sync_result["last_sync_model"] = last_sync_model
+    insert_select(bounded, target_model, sync_task)
+    sync_result["end"] = timezone.now()
+    return sync_result
+
+
+def insert_select(queryset, target_model: Type[Model], sync_task: SyncTask) -> None:
+    """
+    INSERT INTO target (...) SELECT ... FROM (queryset) with the upsert clause of the backend
+    """
+    connection = connections[sync_task.target_db]
+    quote = connection.ops.quote_name
+    pk_name = target_model._meta.pk.name
+    mapped = [
+            target_model._meta.get_field(field)
+            for field in sync_task.field_map
+    ]
+    selected = queryset.order_by().values(**{
+        f"sync_{index}": F(sync_task.field_map[field.name])
+        for index, field in enumerate(mapped)
+    })
+    select_sql, select_params = selected.query.sql_with_params()
+    columns = [f"sync_source.{quote(f'sync_{index}')}" for index in range(len(mapped))]
+    # the constants are selected before the subquery, an unmapped field gets the value of Model.__init__
+    params = []
+    constants = []
+    now = timezone.now()
+    for field in target_model._meta.concrete_fields:
+        if field in mapped or field.primary_key or getattr(field, "generated", False):
+            continue
+        if getattr(field, "auto_now", False) or getattr(field, "auto_now_add", False):
+            value = now
+        elif field.has_default():
+            value = field.get_default()
+        elif field.null or field.db_default is not NOT_PROVIDED:
+            # left to the database
+            continue
+        else:
+            value = field.get_default()
+        constants.append(field)
+        columns.append("%s")
+        params.append(field.get_db_prep_save(value, connection))
+    update_fields = [
+            field for field in mapped if field.name != pk_name
+    ] + [field for field in constants if getattr(field, "auto_now", False)]
+    params.extend(select_params)
+    insert_columns = ", ".join(quote(field.column) for field in mapped + constants)
+    sql = (
+            f"INSERT INTO {quote(target_model._meta.db_table)} ({insert_columns}) "
+            f"SELECT {', '.join(columns)} FROM ({select_sql}) sync_source WHERE 1 = 1"
+    )
+    if connection.vendor == "mysql":
+        if not sync_task.update_existing or not update_fields:
+            sql = sql.replace("INSERT INTO", "INSERT IGNORE INTO", 1)
+        else:
+            sql += " ON DUPLICATE KEY UPDATE " + ", ".join(
+                    f"{quote(field.column)} = VALUES({quote(field.column)})"
+                    for field in update_fields
+            )
+    elif not sync_task.update_existing or not update_fields:
+        sql += " ON CONFLICT DO NOTHING"
+    else:
+        sql += f" ON CONFLICT ({quote(target_model._meta.pk.column)}) DO UPDATE SET " + ", ".join(
+                f"{quote(field.column)} = EXCLUDED.{quote(field.column)}"
+                for field in update_fields
+        )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+reconcile the target of a sync task with its source
+
+the pk space is split into ranges, each range is summarized on both databases by
+(count, sum of pk, sum of a hash of the field_map columns). Only the ranges whose summaries
+differ are split again, so the cost grows with the drift instead of the table size.
+"""
+
+
+import logging
+
+from typing import Any, Dict, List, Optional, Set, Tuple, Type
+
+from django.db import connections
+from django.db.models import Count, Expression, IntegerField, Max, Min, Model, QuerySet, Sum, TextField, Value
+from django.db.models.functions import MD5, Cast, Concat, StrIndex, Substr
+
+from .fingerprint import forget_fingerprints
+from .models import SyncChangeLog, SyncTask
+from .types import VerifyReport
+from .utils import get_change_filter, get_models, get_queryset, get_shards, get_sync_function
+
+
+LOGGER = logging.getLogger(__name__)
+LEAF_SIZE = 1000
+HEX_DIGITS = "0123456789abcdef"
+HASH_DIGITS = 7
+
+
+def get_compared_fields(sync_task: SyncTask, target_model: Type[Model]) -> Tuple[List[str], List[str]]:
+    """
+    the target fields and the source fields compared row by row, the pk first
+    without field_map only the pks are compared
+    """
+    pk_name = target_model._meta.pk.name
+    if not sync_task.field_map:
+        return ["pk"], ["pk"]
+    if pk_name not in sync_task.field_map:
+        raise ValueError(f"field_map of {sync_task} should contain the primary key {pk_name}")
+    target_fields = [pk_name] + [field for field in sync_task.field_map if field != pk_name]
+    return target_fields, [sync_task.field_map[field] for field in target_fields]
+
+
+def get_target_filter(sync_task: SyncTask, source_model: Type[Model]) -> Optional[Dict[str, Any]]:
+    """
+    filter_by of the source mapped onto the target fields through field_map, the target rows written by this task
+    None if a filtered source field is not in field_map, the rows of other tasks writing the same target
+    can not be told apart
+    """
+    target_names = {source: target for target, source in sync_task.field_map.items()}
+    target_filter: Dict[str, Any] = {}
+    for lookup, value in sync_task.filter_by.items():
+        field, separator, rest = lookup.partition("__")
+        if field == "pk":
+            field = source_model._meta.pk.name
+        if field not in target_names:
+            return None
+        target_filter[f"{target_names[field]}{separator}{rest}"] = value
+    return target_filter
+
+
+def get_row_hash(fields: List[str]) -> Expression:
+    """
+    an integer from the first hex digits of MD5 over the text of the fields
+    only built from the portable functions, so the hash is computed by the database
+    """
+    parts: List[Expression] = []
+    for field in fields:
+        parts.extend([Cast(field, TextField()), Value("|")])
+    digest = MD5(Concat(*parts))
+    number: Expression = Value(0)
+    for index in range(HASH_DIGITS):
+        digit = StrIndex(Value(HEX_DIGITS), Substr(digest, index + 1, 1)) - 1
+        number = number + digit * 16 ** (HASH_DIGITS - 1 - index)
+    return number
+
+
+def get_fingerprint(queryset: QuerySet, pk_field: str, row_hash: Optional[Expression], low: int, high: int) -> tuple:
+    aggregates: Dict[str, Any] = {"rows": Count(pk_field), "pk_sum": Sum(pk_field)}
+    if row_hash is not None:
+        aggregates["hash_sum"] = Sum(row_hash)
+    result = queryset.filter(**{
+        f"{pk_field}__gte": low, f"{pk_field}__lte": high,
+    }).aggregate(**aggregates)
+    return tuple(result[key] for key in aggregates)
+
+
+def get_pending(sync_task: SyncTask, source_pk: str, pks: List[Any]) -> Set[Any]:
+    """
+    the pks whose source rows are not synced yet: after the cursor, or in the change log of a trigger task
+    """
+    if not pks:
+        return set()
+    if sync_task.capture == "trigger":
+        source_model, _ = get_models(sync_task)
+        logged = set(SyncChangeLog.objects.using(sync_task.source_db).filter(
+            get_change_filter(sync_task.last_sync),
+            table_name=source_model._meta.db_table,
+            row_pk__in=[str(pk) for pk in pks],
+        ).values_list("row_pk", flat=True))
+        return {pk for pk in pks if str(pk) in logged}
+    pending: Set[Any] = set()
+    for shard in get_shards(sync_task):
+        pending.update(get_queryset(sync_task, shard).filter(**{
+            f"{source_pk}__in": pks,
+        }).values_list(source_pk, flat=True))
+    return pending
+
+
+def verify(sync_task: SyncTask, leaf_size: int = LEAF_SIZE) -> VerifyReport:
+    """
+    compare the filtered source rows with the target rows of a sync task
+    the target pk should be an integer and mapped from a source field (or equal to the source pk)
+    """
+    source_model, target_model = get_models(sync_task)
+    if not isinstance(target_model._meta.pk, IntegerField):
+        raise ValueError(f"A sync task {sync_task} can only be verified with an integer target pk")
+    target_fields, source_fields = get_compared_fields(sync_task, target_model)
+    source_hash: Optional[Expression] = None
+    target_hash: Optional[Expression] = None
+    if connections[sync_task.source_db].vendor == connections[sync_task.target_db].vendor:
+        source_hash = get_row_hash(source_fields)
+        target_hash = get_row_hash(target_fields)
+    else:
+        LOGGER.warning("%s: the databases differ, only the pks are compared by range", sync_task)
+    source_pk = source_fields[0]
+    source_queryset = source_model.objects.using(sync_task.source_db).filter(  # type: ignore[attr-defined]
+            **sync_task.filter_by
+    )
+    target_queryset = target_model.objects.using(sync_task.target_db).all()  # type: ignore[attr-defined]
+    target_filter = get_target_filter(sync_task, source_model)
+    if target_filter is None:
+        LOGGER.warning("%s: filter_by is not mapped by field_map, the extra rows are not reported", sync_task)
+    else:
+        target_queryset = target_queryset.filter(**target_filter)
+    report: VerifyReport = {
+            "missing": [],
+            "extra": [],
+            "changed": [],
+            "pending": [],
+            "ranges": 0,
+    }
+    source_bounds = source_queryset.aggregate(low=Min(source_pk), high=Max(source_pk))
+    target_bounds = target_queryset.aggregate(low=Min("pk"), high=Max("pk"))
+    lows = [bounds["low"] for bounds in (source_bounds, target_bounds) if bounds["low"] is not None]
+    highs = [bounds["high"] for bounds in (source_bounds, target_bounds) if bounds["high"] is not None]
+    if not lows:
+        return report
+    ranges = [(min(lows), max(highs))]
+    while ranges:
+        low, high = ranges.pop()
+        report["ranges"] += 1
+        source_fingerprint = get_fingerprint(source_queryset, source_pk, source_hash, low, high)
+        target_fingerprint = get_fingerprint(target_queryset, "pk", target_hash, low, high)
+        if source_fingerprint == target_fingerprint:
+            continue
+        if max(source_fingerprint[0], target_fingerprint[0]) > leaf_size and low < high:
+            middle = (low + high) // 2
+            ranges.extend([(middle + 1, high), (low, middle)])
+            continue
+        compare_rows(
+                sync_task, report, low, high,
+                source_queryset.filter(**{f"{source_pk}__gte": low, f"{source_pk}__lte": high}),
+                source_fields,
+                target_queryset.filter(pk__gte=low, pk__lte=high),
+                target_fields,
+                target_filter is not None,
+        )
+    LOGGER.info(
+            "%s verified %d ranges: %d missing, %d extra, %d changed, %d pending",
+            sync_task, report["ranges"], len(report["missing"]), len(report["extra"]),
+            len(report["changed"]), len(report["pending"]),
+    )
+    return report
+
+
+def compare_rows(  # pylint: disable=too-many-arguments
+        sync_task: SyncTask,
+        report: VerifyReport,
+        low: int,
+        high: int,
+        source_queryset: QuerySet,
+        source_fields: List[str],
+        target_queryset: QuerySet,
+        target_fields: List[str],
+        report_extra: bool = True) -> None:
+    """
+    compare a small range row by row
+    the extra rows are only reported if the target_queryset holds the rows of this task alone
+    """
+    source_rows = {row[0]: row for row in source_queryset.values_list(*source_fields)}
+    target_rows = {row[0]: row for row in target_queryset.values_list(*target_fields)}
+    LOGGER.debug("%s compare rows %d-%d", sync_task, low, high)
+    missing = sorted(pk for pk in source_rows if pk not in target_rows)
+    changed = sorted(pk for pk in source_rows if pk in target_rows and source_rows[pk] != target_rows[pk])
+    pending = get_pending(sync_task, source_fields[0], missing + changed)
+    report["missing"].extend(pk for pk in missing if pk not in pending)
+    report["changed"].extend(pk for pk in changed if pk not in pending)
+    report["pending"].extend(sorted(pending))
+    if report_extra:
+        report["extra"].extend(sorted(pk for pk in target_rows if pk not in source_rows))
+
+
+def repair(sync_task: SyncTask, report: VerifyReport, delete_extra: bool = False) -> None:
+    """
+    sync the missing and changed rows again with the sync method, delete the extra target rows if delete_extra
+    the cursor is not moved. The changed rows are only fixed if the sync method updates existing rows.
+    """
+    source_model, target_model = get_models(sync_task)
+    _, source_fields = get_compared_fields(sync_task, target_model)
+    sync_function = get_sync_function(sync_task.sync_method)
+    pks = sorted(report["missing"] + report["changed"])
+    extra = report["extra"] if delete_extra else []
+    if sync_task.fingerprint:
+        forget_fingerprints(sync_task, pks + extra)
+    for index in range(0, len(pks), sync_task.batch_size):
+        queryset = source_model.objects.using(sync_task.source_db).filter(  # type: ignore[attr-defined]
+                **sync_task.filter_by
+        ).filter(**{
+            f"{source_fields[0]}__in": pks[index:index + sync_task.batch_size],
+        }).order_by(*sync_task.order_by)
+        sync_function(queryset, target_model, sync_task)
+    for index in range(0, len(extra), LEAF_SIZE):
+        target_model.objects.using(sync_task.target_db).filter(  # type: ignore[attr-defined]
+                pk__in=extra[index:index + LEAF_SIZE],
+        ).delete()
+    LOGGER.info("%s repair %d rows, delete %d rows", sync_task, len(pks), len(extra))